@@ -0,0 +1,329 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import multiprocessing
+import platform
+import tempfile
+import time
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError: # Windows: peak RSS non disponibile
+    resource = None
+
+# Add src to path to import utils
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from src.kapra_anonymization import run_kapra_anonymization, build_p_groups, form_k_groups, k_group_release
+from src.kapra_incremental import IncrementalKapra, start_incremental
+from src.naive_anonymization import split_k_group
+from src.k_anon import partition_indices, partition_dataset
+from src.record_store import RecordStore, rows_per_chunk
+from src.release import Release
+from src.sax_utils import SaxCodeCache, sax_codes_to_strings, pattern_loss_batch
+from src.kapra_utils import group_envelopes
+from src.dataset import ARCHETYPES, archetype_series
+
+# Series lengths of the long-series benchmark
+SERIES_LENGTHS = [8, 64, 512, 2048, 10000]
+
+# History sizes of the incremental benchmark (records before the append)
+INCREMENTAL_HISTORY_SIZES = [10**4, 10**5, 10**6]
+
+# Dataset sizes and series lengths of the benchmark suite
+SUITE_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+SUITE_LENGTHS = [8, 64]
+SUITE_ALGORITHMS = ['kapra', 'naive', 'mondrian']
+
+# Largest dataset for the record-dict reference partition_dataset (one
+# DataFrame per split), benchmarked only to compare with partition_indices
+PARTITION_DATASET_MAX_RECORDS = 10**4
+
+def synthetic_series(n_rows, length, seed=42, dtype=np.int64):
+    """
+    Synthetic series (int 0-50) and their archetype index (Rising, Falling,
+    Peak, Flat), drawn with dataset.archetype_series. Same seed, same data.
+    """
+    rng = np.random.default_rng(seed)
+    kind = rng.integers(0, len(ARCHETYPES), n_rows)
+    series = np.empty((n_rows, length), dtype=dtype)
+    # a blocchi: i temporanei float restano limitati anche con 10^7 record
+    step = rows_per_chunk(length, max(1, n_rows))
+    for start in range(0, n_rows, step):
+        series[start:start + step] = archetype_series(rng, kind[start:start + step], length)
+    return series, kind
+
+def make_long_series_dataset(path, n_rows, length, seed=42):
+    """
+    Write a synthetic dataset with the schema of dataset_raw.csv and series of
+    the given length: ID, H1..H<length> (int 0-50), Performance_SD.
+    """
+    series, kind = synthetic_series(n_rows, length, seed)
+    df = pd.DataFrame(series, columns=[f'H{i+1}' for i in range(length)])
+    df.insert(0, 'ID', np.arange(1, n_rows + 1))
+    df['Performance_SD'] = np.array(['Low', 'Medium', 'High'])[kind % 3]
+    df.to_csv(path, index=False)
+
+def time_stages(path, K, P, SAX_LEVEL, N_SEGMENTS):
+    """Wall time (seconds) of the main stages on the dataset at path, then of a full KAPRA run."""
+    timings = {}
+    t = time.perf_counter()
+    store = RecordStore.from_csv(path, n_segments=N_SEGMENTS)
+    timings['load'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    sax_cache = SaxCodeCache(store.series, n_segments=N_SEGMENTS)
+    codes = sax_cache.codes(SAX_LEVEL)
+    timings['sax'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    pattern_loss_batch(store.series, sax_codes_to_strings(codes), np.full(len(store), SAX_LEVEL))
+    timings['pattern_loss'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    groups = np.arange(len(store)) % max(1, len(store) // K)
+    group_envelopes(store.series, groups, groups.max() + 1)
+    timings['envelopes'] = time.perf_counter() - t
+
+    with tempfile.TemporaryDirectory(prefix='kapra_bench_') as tmp:
+        t = time.perf_counter()
+        run_kapra_anonymization(K=K, P=P, SAX_LEVEL=SAX_LEVEL, N_SEGMENTS=N_SEGMENTS, verbose=False,
+                                data_path=path, output_path=os.path.join(tmp, 'release.npz'))
+        timings['kapra'] = time.perf_counter() - t
+    return timings
+
+def benchmark_series_length(lengths=SERIES_LENGTHS, n_rows=2000, K=8, P=2, SAX_LEVEL=8, N_SEGMENTS=4, output_csv=None):
+    """
+    Runtime of every stage against the series length T.
+
+    The scaling exponent is the slope of log(time) over log(T) between the
+    two longest series: about 1 when the stage is linear in T.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='kapra_bench_') as tmp:
+        for length in lengths:
+            path = os.path.join(tmp, f'series_{length}.csv')
+            make_long_series_dataset(path, n_rows, length)
+            timings = time_stages(path, K, P, SAX_LEVEL, N_SEGMENTS)
+            print(f"T={length:>6}: " + ", ".join(f"{k} {v:.3f}s" for k, v in timings.items()))
+            results.append({'T': length, 'records': n_rows, **timings})
+            os.remove(path)
+
+    df = pd.DataFrame(results)
+    if len(df) >= 2:
+        last = df.iloc[-2:]
+        slopes = {c: np.log(last[c].iloc[1] / last[c].iloc[0]) / np.log(last['T'].iloc[1] / last['T'].iloc[0])
+                  for c in df.columns if c not in ('T', 'records')}
+        print("Scaling exponents (time ~ T^e): " + ", ".join(f"{k} {v:.2f}" for k, v in slopes.items()))
+    if output_csv:
+        df.to_csv(output_csv, index=False)
+        print(f"Benchmark results saved to {output_csv}")
+    return df
+
+def benchmark_incremental(history_sizes=INCREMENTAL_HISTORY_SIZES, batch_size=1000, length=8, K=8, P=2,
+                          SAX_LEVEL=8, N_SEGMENTS=4, output_csv=None):
+    """
+    Runtime of an append of batch_size records, and of the retraction of
+    batch_size // 10 records of the history, against the history size
+    (each one with its load and save of the state).
+
+    The scaling exponent is the slope of log(time) over log(history) between
+    the two largest histories: about 0 when the work does not depend on the
+    history. A retraction also rereads every member of the groups it
+    repairs (the 'republished' records), so its time follows the size of
+    those groups.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='kapra_bench_') as tmp:
+        for n_history in history_sizes:
+            path = os.path.join(tmp, f'history_{n_history}.csv')
+            make_long_series_dataset(path, n_history + batch_size, length)
+            df = pd.read_csv(path)
+            df.iloc[:n_history].to_csv(path, index=False)
+            state_path = os.path.join(tmp, f'state_{n_history}')
+            start_incremental(K, P, SAX_LEVEL, N_SEGMENTS, verbose=False, data_path=path,
+                              output_path=os.path.join(tmp, 'release.csv'), state_path=state_path)
+            timings = {}
+            t = time.perf_counter()
+            state = IncrementalKapra.load(state_path)
+            state.append(df.iloc[n_history:], verbose=False)
+            state.save()
+            timings['append'] = time.perf_counter() - t
+
+            retracted = df['ID'].iloc[:n_history].sample(batch_size // 10, random_state=42)
+            t = time.perf_counter()
+            state = IncrementalKapra.load(state_path)
+            release, _ = state.retract(retracted, verbose=False)
+            state.save()
+            timings['retract'] = time.perf_counter() - t
+            print(f"history={n_history:>9}: " + ", ".join(f"{k} {v:.3f}s" for k, v in timings.items()) +
+                  f" ({len(release)} records republished by the retraction)")
+            results.append({'history': n_history, 'batch': batch_size, 'republished': len(release), **timings})
+
+    df = pd.DataFrame(results)
+    if len(df) >= 2:
+        last = df.iloc[-2:]
+        slopes = {c: np.log(last[c].iloc[1] / last[c].iloc[0]) / np.log(last['history'].iloc[1] / last['history'].iloc[0])
+                  for c in ('append', 'retract')}
+        print("Scaling exponents (time ~ history^e): " + ", ".join(f"{k} {v:.2f}" for k, v in slopes.items()))
+    if output_csv:
+        df.to_csv(output_csv, index=False)
+        print(f"Benchmark results saved to {output_csv}")
+    return df
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, in MB (None where unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KB, macOS: byte
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _measure(rows, stage, n_records, fn):
+    t = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - t
+    rows.append({'stage': stage, 'time_s': elapsed, 'peak_rss_mb': peak_rss_mb(),
+                 'throughput_rps': n_records / elapsed if elapsed > 0 else None})
+    return out
+
+def benchmark_case(algorithm, n_records, length, seed=42, K=8, P=2, SAX_LEVEL=8, MAX_LEVEL=10, N_SEGMENTS=4):
+    """
+    Time the stages of one algorithm on a synthetic dataset.
+
+    Stages: 'kapra' -> sax, p_grouping (Phase 1 & 2, SAX encoding included),
+    phase3, output; 'naive' -> partition, node_splitting, output; 'mondrian'
+    -> partition_indices and, up to PARTITION_DATASET_MAX_RECORDS records,
+    partition_dataset. Releases are written as .npz in a temporary directory.
+
+    Returns one dict per stage with wall time, peak RSS of the process at the
+    end of the stage (cumulative: run each case in a fresh process, as
+    run_benchmark_suite does) and throughput in records per second.
+    """
+    series, kind = synthetic_series(n_records, length, seed, dtype=np.int32)
+    categories = np.array(['Low', 'Medium', 'High'], dtype=object)
+    store = RecordStore(series, n_segments=N_SEGMENTS,
+                        attributes={'Performance_SD': ((kind % 3).astype(np.int32), categories)})
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='kapra_bench_') as tmp:
+        release_path = os.path.join(tmp, 'release.npz')
+        if algorithm == 'kapra':
+            _measure(rows, 'sax', n_records,
+                     lambda: SaxCodeCache(series, n_segments=N_SEGMENTS).codes(SAX_LEVEL))
+            p_groups = _measure(rows, 'p_grouping', n_records,
+                                lambda: build_p_groups(store, P, SAX_LEVEL, N_SEGMENTS, verbose=False))
+            groups = _measure(rows, 'phase3', n_records,
+                              lambda: form_k_groups(store, p_groups, K, verbose=False))
+            _measure(rows, 'output', n_records,
+                     lambda: k_group_release(store, groups)[0].write(release_path, ['Performance_SD']))
+        elif algorithm == 'naive':
+            partitions = _measure(rows, 'partition', n_records, lambda: partition_indices(series, K))
+            sax_cache = SaxCodeCache(series, n_segments=N_SEGMENTS)
+            leaves = _measure(rows, 'node_splitting', n_records, lambda: [
+                leaf for group_id, group_data in enumerate(partitions, start=1)
+                for leaf in split_k_group(group_id, group_data, series, sax_cache, P, MAX_LEVEL)])
+            def write_naive():
+                release = Release.from_clusters(store, [leaf.data for leaf in leaves],
+                                                patterns=[leaf.pattern for leaf in leaves],
+                                                levels=[leaf.level for leaf in leaves])
+                release.write(release_path, ['Performance_SD'],
+                              group_ids=[leaf.group_id for leaf in leaves], as_int=False)
+            _measure(rows, 'output', n_records, write_naive)
+        elif algorithm == 'mondrian':
+            _measure(rows, 'partition_indices', n_records, lambda: partition_indices(series, K))
+            if n_records <= PARTITION_DATASET_MAX_RECORDS:
+                time_cols = [f'H{i+1}' for i in range(length)]
+                records = pd.DataFrame(series, columns=time_cols).to_dict('records')
+                _measure(rows, 'partition_dataset', n_records,
+                         lambda: partition_dataset(records, K, time_cols))
+        else:
+            raise ValueError(f"Unknown algorithm {algorithm!r}; expected one of {SUITE_ALGORITHMS}")
+    for row in rows:
+        row.update(algorithm=algorithm, records=n_records, length=length, seed=seed)
+    return rows
+
+def scaling_exponents(results):
+    """
+    Empirical scaling exponent of every (algorithm, stage, length): least
+    squares slope of log(time) over log(records). About 1 for a linear stage,
+    about 2 for a quadratic one.
+    """
+    df = pd.DataFrame(results)
+    fits = []
+    for (algorithm, stage, length), g in df.groupby(['algorithm', 'stage', 'length'], sort=False):
+        g = g[g['time_s'] > 0]
+        if g['records'].nunique() < 2:
+            continue
+        slope = np.polyfit(np.log(g['records']), np.log(g['time_s']), 1)[0]
+        fits.append({'algorithm': algorithm, 'stage': stage, 'length': int(length),
+                     'exponent': float(slope), 'sizes': sorted(int(n) for n in g['records'].unique())})
+    return fits
+
+def run_benchmark_suite(sizes=SUITE_SIZES, lengths=SUITE_LENGTHS, algorithms=SUITE_ALGORITHMS, seed=42,
+                        output_json=None, fresh_process=True, **params):
+    """
+    Benchmark suite: every algorithm on synthetic datasets of every size and
+    series length (same seed, same data), then the scaling exponents.
+
+    Each case runs in a fresh process (fresh_process=True) so that its peak
+    RSS is its own. Results are written to output_json (if given) as
+    {'environment', 'parameters', 'results', 'scaling'} and returned as a dict.
+    """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for length in lengths:
+        for n_records in sizes:
+            for algorithm in algorithms:
+                args = (algorithm, int(n_records), int(length), seed)
+                if fresh_process:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        rows = pool.submit(benchmark_case, *args, **params).result()
+                else:
+                    rows = benchmark_case(*args, **params)
+                results.extend(rows)
+                print(f"{algorithm:>8} n={n_records:>9} T={length:>4}: " +
+                      ", ".join(f"{r['stage']} {r['time_s']:.3f}s" for r in rows) +
+                      f" (peak RSS {rows[-1]['peak_rss_mb'] or 0:.0f} MB)")
+
+    scaling = scaling_exponents(results)
+    for fit in scaling:
+        print(f"Scaling {fit['algorithm']}/{fit['stage']} (T={fit['length']}): time ~ n^{fit['exponent']:.2f}")
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'parameters': {'sizes': [int(n) for n in sizes], 'lengths': [int(t) for t in lengths],
+                       'algorithms': list(algorithms), 'seed': seed, **params},
+        'results': results,
+        'scaling': scaling,
+    }
+    if output_json:
+        with open(output_json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to {output_json}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="KAPRA / naive / Mondrian benchmark suite")
+    parser.add_argument('--sizes', type=float, nargs='+', default=SUITE_SIZES, help="dataset sizes (records)")
+    parser.add_argument('--lengths', type=int, nargs='+', default=SUITE_LENGTHS, help="series lengths")
+    parser.add_argument('--algorithms', nargs='+', default=SUITE_ALGORITHMS, choices=SUITE_ALGORITHMS)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='benchmark_results.json', help="results file (JSON)")
+    parser.add_argument('--series-length', action='store_true',
+                        help="run the runtime vs series length benchmark instead")
+    parser.add_argument('--incremental', action='store_true',
+                        help="run the append/retract runtime vs history size benchmark instead")
+    args = parser.parse_args()
+    if args.series_length:
+        benchmark_series_length()
+    elif args.incremental:
+        benchmark_incremental()
+    else:
+        run_benchmark_suite([int(n) for n in args.sizes], args.lengths, args.algorithms, args.seed, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,119 +1,204 @@
 import pandas as pd
 import numpy as np
+import argparse
+import shutil
+import tempfile
+import zipfile
 import os
-import random
+import sys
 
-def generate_dataset():
+# Recupero la cartella dove si trova questo file
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Se non è già presente nella lista di ricerca, la aggiungo
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from record_store import rows_per_chunk
+
+NAMES = ["Francesco", "Alessandro", "Lorenzo", "Mattia", "Leonardo", "Andrea", "Gabriele", "Matteo",
+         "Tommaso", "Edoardo", "Sofia", "Giulia", "Aurora", "Alice", "Ginevra", "Emma", "Giorgia", "Greta", "Beatrice"]
+SURNAMES = ["Rossi", "Russo", "Ferrari", "Esposito", "Bianchi", "Romano", "Colombo", "Ricci",
+            "Marino", "Greco", "Bruno", "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Rizzo"]
+PERFORMANCE_LEVELS = ["Low", "Medium", "High"]
+
+# Pattern Definitions (Archetypes) used to optimize distinctness
+# "Rising" -> Funnel / Linear Up
+# "Falling" -> Funnel / Linear Down
+# "Peak" -> Bell
+# "Flat" -> Cylinder
+ARCHETYPES = ['Rising', 'Falling', 'Peak', 'Flat']
+
+# Curva di ogni archetipo: a + b * f(x), x in [0, 1]
+# (a, b estratti uniformi nei range; per Rising/Falling b = fine - inizio)
+_START_RANGE = np.array([[5, 15], [35, 45], [10, 20], [20, 40]], dtype=float)  # a: inizio / base / valore
+_SECOND_RANGE = np.array([[35, 45], [5, 15], [20, 30], [0, 0]], dtype=float)  # fine / ampiezza
+_SECOND_IS_END = np.array([True, True, False, False])
+
+# Rows generated per chunk (fewer for long series, see record_store.rows_per_chunk)
+GENERATOR_CHUNK_ROWS = 1_000_000
+
+def archetype_series(rng, kinds, length, noise=2.0, shift=5.0):
+    """
+    Series of the given archetypes (indices into ARCHETYPES), vectorized:
+    base curve + intensity shift (uniform +/- shift per series) + Gaussian
+    noise (sigma noise per hour), clamped to [0, 50] and rounded down.
+    Returns a (len(kinds), length) uint8 matrix.
+    """
+    n = len(kinds)
+    x = np.linspace(0, 1, length)
+    basis = np.stack([x, x, np.sin(np.pi * x), np.zeros(length)])
+    a = rng.uniform(_START_RANGE[kinds, 0], _START_RANGE[kinds, 1])
+    b = rng.uniform(_SECOND_RANGE[kinds, 0], _SECOND_RANGE[kinds, 1])
+    b = np.where(_SECOND_IS_END[kinds], b - a, b)
+    series = a[:, None] + b[:, None] * basis[kinds]
+    series += rng.uniform(-shift, shift, (n, 1))
+    series += rng.normal(0, noise, (n, length))
+    return np.clip(series, 0, 50).astype(np.uint8)
+
+def _archetype_weights(archetype_mix):
+    if archetype_mix is None:
+        return np.full(len(ARCHETYPES), 1 / len(ARCHETYPES))
+    if isinstance(archetype_mix, dict):
+        unknown = set(archetype_mix) - set(ARCHETYPES)
+        if unknown:
+            raise ValueError(f"Unknown archetypes {sorted(unknown)}; expected {ARCHETYPES}")
+        archetype_mix = [archetype_mix.get(a, 0) for a in ARCHETYPES]
+    weights = np.asarray(archetype_mix, dtype=float)
+    if weights.shape != (len(ARCHETYPES),) or (weights < 0).any() or weights.sum() == 0:
+        raise ValueError(f"archetype_mix needs {len(ARCHETYPES)} non-negative weights (not all zero), got {archetype_mix}")
+    return weights / weights.sum()
+
+def generate_chunks(n_rows, length=8, archetype_mix=None, noise=2.0, shift=5.0, seed=42, chunk_rows=None):
+    """
+    Generate the dataset chunk by chunk with one np.random.Generator.
+
+    Yields (ids, name_codes, surname_codes, series, performance_codes) for
+    every chunk: codes index NAMES / SURNAMES / PERFORMANCE_LEVELS, series is
+    a uint8 matrix. Same parameters (chunk_rows included), same data.
+    """
+    rng = np.random.default_rng(seed)
+    weights = _archetype_weights(archetype_mix)
+    chunk_rows = rows_per_chunk(length, chunk_rows or GENERATOR_CHUNK_ROWS)
+    for start in range(0, n_rows, chunk_rows):
+        n = min(chunk_rows, n_rows - start)
+        names = rng.integers(0, len(NAMES), n).astype(np.uint8)
+        surnames = rng.integers(0, len(SURNAMES), n).astype(np.uint8)
+        kinds = rng.choice(len(ARCHETYPES), size=n, p=weights)
+        series = archetype_series(rng, kinds, length, noise, shift)
+        # Sensitive Attribute (Performance_SD) based on Total Activity:
+        # Low (< 20/ora in media), Medium (20-30/ora), High (> 30/ora), come Low < 160 / High > 240 su 8 ore
+        total = series.sum(axis=1, dtype=np.int64)
+        performance = np.where(total < 20 * length, 0, np.where(total <= 30 * length, 1, 2)).astype(np.uint8)
+        ids = np.arange(start + 1, start + n + 1, dtype=np.int64)
+        yield ids, names, surnames, series, performance
+
+def _chunk_frame(ids, names, surnames, series, performance):
+    df = pd.DataFrame(series, columns=[f'H{j+1}' for j in range(series.shape[1])])
+    df.insert(0, 'Surname', np.asarray(SURNAMES, dtype=object)[surnames])
+    df.insert(0, 'Name', np.asarray(NAMES, dtype=object)[names])
+    df.insert(0, 'ID', ids)
+    df['Performance_SD'] = np.asarray(PERFORMANCE_LEVELS, dtype=object)[performance]
+    return df
+
+def _write_npz(path, n_rows, length, chunks, compress=False):
+    # una sola voce dell'archivio può essere aperta in scrittura: la matrice
+    # delle serie va nell'archivio subito, le altre colonne (1 byte/riga o
+    # ricalcolabili) passano da file temporanei e vengono copiate alla fine
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    columns = ['Name', 'Surname', 'Performance_SD']
+    spools = {col: tempfile.TemporaryFile() for col in columns}
+    try:
+        with zipfile.ZipFile(path, 'w', compression=compression, allowZip64=True) as archive:
+            with archive.open('series.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_2_0(f, {'descr': '|u1', 'fortran_order': False,
+                                                         'shape': (n_rows, length)})
+                for _, names, surnames, series, performance in chunks:
+                    f.write(series.tobytes())
+                    for col, codes in zip(columns, (names, surnames, performance)):
+                        spools[col].write(codes.tobytes())
+            with archive.open('ID.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_2_0(f, {'descr': '<i8', 'fortran_order': False, 'shape': (n_rows,)})
+                for start in range(0, n_rows, GENERATOR_CHUNK_ROWS):
+                    f.write(np.arange(start + 1, min(start + GENERATOR_CHUNK_ROWS, n_rows) + 1, dtype=np.int64).tobytes())
+            for col, categories in zip(columns, (NAMES, SURNAMES, PERFORMANCE_LEVELS)):
+                with archive.open(f'{col}.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array_header_2_0(f, {'descr': '|u1', 'fortran_order': False,
+                                                             'shape': (n_rows,)})
+                    spools[col].seek(0)
+                    shutil.copyfileobj(spools[col], f)
+                with archive.open(f'{col}__categories.npy', 'w') as f:
+                    np.lib.format.write_array(f, np.array(categories))
+            with archive.open('time_columns.npy', 'w') as f:
+                np.lib.format.write_array(f, np.array([f'H{j+1}' for j in range(length)]))
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+def generate_dataset(n_rows=3000, length=8, archetype_mix=None, noise=2.0, shift=5.0, seed=42,
+                     output_path=None, chunk_rows=None, verbose=True):
     """
     Generate synthetic dataset following docs/dataset-generation.md specifications.
-    Schema: ID, Name, Surname, H1-H8 (int 0-50), Performance_SD (Low/Medium/High)
+    Schema: ID, Name, Surname, H1-H<length> (int 0-50), Performance_SD (Low/Medium/High)
     Patterns: Rising, Falling, Peak, Flat
+
+    Args:
+        n_rows: Number of records.
+        length: Series length (hours).
+        archetype_mix: Weights of ARCHETYPES (list, or dict by name); default uniform.
+        noise: Standard deviation of the Gaussian noise per hour.
+        shift: Maximum intensity shift of a whole series.
+        seed: Seed of the np.random.Generator.
+        output_path: .csv (default: src/dataset_raw.csv) or .npz (uint8 series
+                     matrix, ID, coded Name/Surname/Performance_SD; see read_dataset).
+        chunk_rows: Rows generated and written per chunk (memory stays bounded).
     """
-    
-    n_rows = 3000
-    n_cols = 8 # H1 to H8
-    
-    names = ["Francesco", "Alessandro", "Lorenzo", "Mattia", "Leonardo", "Andrea", "Gabriele", "Matteo", 
-             "Tommaso", "Edoardo", "Sofia", "Giulia", "Aurora", "Alice", "Ginevra", "Emma", "Giorgia", "Greta", "Beatrice"]
-    surnames = ["Rossi", "Russo", "Ferrari", "Esposito", "Bianchi", "Romano", "Colombo", "Ricci", 
-                "Marino", "Greco", "Bruno", "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Rizzo"]
-
-    data = []
-    
-    # 1. Pattern Definitions (Archetypes) used to optimize distinctness
-    # "Rising" -> Funnel / Linear Up
-    # "Falling" -> Funnel / Linear Down
-    # "Peak" -> Bell
-    # "Flat" -> Cylinder
-    
-    def generate_base_pattern(ptype, length=8):
-        x = np.linspace(0, 1, length)
-        
-        if ptype == 'Rising':
-            # Start low (e.g. 5-15) end high (e.g. 35-45)
-            start = np.random.uniform(5, 15)
-            end = np.random.uniform(35, 45)
-            # Linear interpolation
-            slope = end - start
-            return start + slope * x
-            
-        elif ptype == 'Falling':
-             # Start high end low
-            start = np.random.uniform(35, 45)
-            end = np.random.uniform(5, 15)
-            slope = end - start
-            return start + slope * x
-            
-        elif ptype == 'Peak':
-            # Bell curve in the middle
-            # Center roughly at 0.5 (middle of 8 hours)
-            # Use sin(0..pi)
-            base_val = np.random.uniform(10, 20)
-            amp = np.random.uniform(20, 30)
-            s_x = np.linspace(0, np.pi, length)
-            return base_val + amp * np.sin(s_x)
-            
-        elif ptype == 'Flat':
-            # Constant value
-            val = np.random.uniform(20, 40)
-            return np.full(length, val)
-            
-        return np.zeros(length)
-
-    np.random.seed(42)
-
-    for i in range(1, n_rows + 1):
-        # Metadata
-        name = np.random.choice(names)
-        surname = np.random.choice(surnames)
-        
-        # 2. Assign Archetype
-        ptype = np.random.choice(['Rising', 'Falling', 'Peak', 'Flat'])
-        
-        # Generate base curve (Float)
-        ts = generate_base_pattern(ptype, n_cols)
-        
-        # 3. Add Variability (Intensity Shift + Noise)
-        # Shift: +/- 5 to keep within range 0-50 mostly
-        shift = np.random.uniform(-5, 5)
-        # Noise: Gaussian
-        noise = np.random.normal(0, 2, n_cols) # Sigma=2 creates visible but not destructive noise
-        
-        ts_final = ts + shift + noise
-        
-        # Clamp to [0, 50] and Round to Int
-        ts_final = np.clip(ts_final, 0, 50).astype(int)
-        
-        # 4. Calculate Sensitive Attribute (Performance_SD) based on Total Activity
-        # Docs: Low (<160), Medium (160-240), High (>240)
-        total_activity = np.sum(ts_final)
-        if total_activity < 160:
-            perf = "Low"
-        elif total_activity <= 240:
-            perf = "Medium"
-        else:
-            perf = "High"
-            
-        row = {
-            'ID': i,
-            'Name': name,
-            'Surname': surname
-        }
-        for j in range(n_cols):
-            row[f'H{j+1}'] = ts_final[j]
-        
-        # Add sensitive attribute
-        row['Performance_SD'] = perf
-        
-        data.append(row)
-        
-    df = pd.DataFrame(data)
-    
-    # Save
-    output_path = os.path.join(os.path.dirname(__file__), 'dataset_raw.csv')
-    df.to_csv(output_path, index=False)
-    print(f"Generated {n_rows} records following {output_path} schema")
-    print("Columns: ID, Name, Surname, H1-H8, Performance_SD")
+    if output_path is None:
+        output_path = os.path.join(current_dir, 'dataset_raw.csv')
+    ext = os.path.splitext(output_path)[1].lower()
+    if ext not in ('.csv', '.npz'):
+        raise ValueError(f"Unknown dataset format for {output_path}; use .csv or .npz")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    chunks = generate_chunks(n_rows, length, archetype_mix, noise, shift, seed, chunk_rows)
+    if ext == '.npz':
+        _write_npz(output_path, n_rows, length, chunks)
+    else:
+        # header con il primo chunk, poi append
+        with open(output_path, 'w', newline='') as f:
+            for i, chunk in enumerate(chunks):
+                _chunk_frame(*chunk).to_csv(f, index=False, header=i == 0)
+            if n_rows == 0:
+                columns = ['ID', 'Name', 'Surname'] + [f'H{j+1}' for j in range(length)] + ['Performance_SD']
+                pd.DataFrame(columns=columns).to_csv(f, index=False)
+    if verbose:
+        print(f"Generated {n_rows} records following {output_path} schema")
+        print(f"Columns: ID, Name, Surname, H1-H{length}, Performance_SD")
+
+def read_dataset(path):
+    """Load a generated dataset (.csv or .npz) as a DataFrame with the dataset_raw.csv columns."""
+    if os.path.splitext(path)[1].lower() != '.npz':
+        return pd.read_csv(path)
+    with np.load(path) as data:
+        df = pd.DataFrame(data['series'], columns=list(data['time_columns']))
+        for col in reversed(['ID', 'Name', 'Surname']):
+            values = data[col] if col == 'ID' else data[f'{col}__categories'].astype(object)[data[col]]
+            df.insert(0, col, values)
+        df['Performance_SD'] = data['Performance_SD__categories'].astype(object)[data['Performance_SD']]
+    return df
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic time-series dataset generator")
+    parser.add_argument('--rows', type=float, default=3000, help="number of records")
+    parser.add_argument('--length', type=int, default=8, help="series length (hours)")
+    parser.add_argument('--mix', type=float, nargs=len(ARCHETYPES), default=None,
+                        help=f"archetype weights ({' '.join(ARCHETYPES)})")
+    parser.add_argument('--noise', type=float, default=2.0)
+    parser.add_argument('--shift', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help="output file (.csv or .npz)")
+    args = parser.parse_args()
+    generate_dataset(int(args.rows), args.length, args.mix, args.noise, args.shift, args.seed, args.output)
 
 if __name__ == "__main__":
-    generate_dataset()
\ No newline at end of file
+    main()
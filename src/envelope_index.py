@@ -0,0 +1,232 @@
+import heapq
+import itertools
+import os
+import sys
+
+import numpy as np
+
+# Recupero la cartella dove si trova questo file
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from sax_utils import paa_segment_bounds
+from kapra_utils import merge_cost_matrix
+
+class EnvelopeIndex:
+    """
+    KD-tree over group envelopes for nearest merge-partner lookup.
+
+    Every envelope is described by its midpoint vector m = (lower + upper) / 2
+    and half-widths h = (upper - lower) / 2, both reduced with PAA to n_dims
+    coordinates weighted by sqrt(segment length), plus H = ||h||^2. For any
+    two groups the merged width at each timestamp is at least
+    |m_a - m_b| + h_a + h_b, so (summing per PAA segment with Cauchy-Schwarz)
+
+        merged VL >= sqrt((sum_s (|c_a,s - c_b,s| + w_a,s)^2 + H_b) / n)
+
+    where c are the midpoint coordinates and w_a the query's half-width ones.
+    The tree returns partners in order of this lower bound and stops the
+    exact search as soon as the bound exceeds the best merged VL found.
+
+    The tree is static: removed groups are tombstoned and inserted groups sit
+    in a pending list scanned at every query; the tree is rebuilt when either
+    grows too large.
+
+    Args:
+        lowers, uppers (np.array): (capacity, n_timestamps) bound arrays shared
+            with the caller; group ids index their rows.
+        group_ids (array-like): Groups initially in the index.
+        n_dims (int): Number of PAA coordinates of the tree.
+        leaf_size (int): Maximum number of groups per leaf.
+    """
+    def __init__(self, lowers, uppers, group_ids, n_dims=8, leaf_size=128):
+        self.lowers = lowers
+        self.uppers = uppers
+        self.n = lowers.shape[1]
+        self.leaf_size = leaf_size
+        self.n_dims = max(1, min(n_dims, self.n))
+        capacity = lowers.shape[0]
+        self.coords = np.zeros((capacity, self.n_dims))
+        self.half_coords = np.zeros((capacity, self.n_dims))
+        self.half_norm = np.zeros(capacity)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.pending = []
+        for group_id in group_ids:
+            self._describe(group_id)
+        self.alive[list(group_ids)] = True
+        self._build()
+
+    def _describe(self, group_id):
+        mid = (self.lowers[group_id] + self.uppers[group_id]) / 2
+        half = (self.uppers[group_id] - self.lowers[group_id]) / 2
+        starts, lengths = paa_segment_bounds(self.n, self.n_dims)
+        self.coords[group_id] = np.add.reduceat(mid, starts) / np.sqrt(lengths)
+        self.half_coords[group_id] = np.add.reduceat(half, starts) / np.sqrt(lengths)
+        self.half_norm[group_id] = np.sum(half ** 2)
+
+    def _build(self):
+        self.pending = []
+        self.order = np.flatnonzero(self.alive)
+        self.n_tree = len(self.order)
+        self.n_dead = 0
+        self.node_lo, self.node_hi, self.node_min_h = [], [], []
+        self.node_children, self.node_range = [], []
+        if self.n_tree:
+            self._build_node(0, self.n_tree)
+
+    def _build_node(self, start, end):
+        node = len(self.node_lo)
+        ids = self.order[start:end]
+        pts = self.coords[ids]
+        self.node_lo.append(pts.min(axis=0))
+        self.node_hi.append(pts.max(axis=0))
+        self.node_min_h.append(self.half_norm[ids].min())
+        self.node_children.append(None)
+        self.node_range.append((start, end))
+        if end - start > self.leaf_size:
+            # divido sulla dimensione più larga, alla mediana
+            dim = int(np.argmax(self.node_hi[node] - self.node_lo[node]))
+            mid = (end - start) // 2
+            part = np.argpartition(pts[:, dim], mid)
+            self.order[start:end] = ids[part]
+            left = self._build_node(start, start + mid)
+            right = self._build_node(start + mid, end)
+            self.node_children[node] = (left, right)
+        return node
+
+    def insert(self, group_id):
+        """Add a group (its bounds must already be in lowers/uppers)."""
+        self._describe(group_id)
+        self.alive[group_id] = True
+        self.pending.append(group_id)
+        if len(self.pending) > max(self.leaf_size, self.n_tree // 4):
+            self._build()
+
+    def remove(self, group_id):
+        """Remove a group from the index."""
+        self.alive[group_id] = False
+        if group_id in self.pending:
+            self.pending.remove(group_id)
+        else:
+            self.n_dead += 1
+            if self.n_dead > self.n_tree // 2:
+                self._build()
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def _node_bound(self, node, query, query_w):
+        gap = np.maximum(0.0, np.maximum(self.node_lo[node] - query, query - self.node_hi[node]))
+        gap += query_w
+        return np.sqrt((np.dot(gap, gap) + self.node_min_h[node]) / self.n)
+
+    def _point_bounds(self, ids, query, query_w):
+        gap = np.abs(self.coords[ids] - query) + query_w
+        return np.sqrt((np.sum(gap ** 2, axis=1) + self.half_norm[ids]) / self.n)
+
+    def _live(self, ids, group_id):
+        ids = np.asarray(ids, dtype=np.int64)
+        return ids[self.alive[ids] & (ids != group_id)]
+
+    def candidates(self, group_id):
+        """Yield (lower_bound, partner_id) for every other group, by increasing bound."""
+        query, query_w = self.coords[group_id], self.half_coords[group_id]
+        tie = itertools.count()
+        heap = []
+        pending = self._live(self.pending, group_id)
+        for bound, other in zip(self._point_bounds(pending, query, query_w), pending):
+            heap.append((bound, next(tie), -1, int(other)))
+        if self.n_tree:
+            heap.append((self._node_bound(0, query, query_w), next(tie), 0, -1))
+        heapq.heapify(heap)
+        while heap:
+            bound, _, node, other = heapq.heappop(heap)
+            if node < 0:
+                if self.alive[other]:
+                    yield bound, other
+                continue
+            children = self.node_children[node]
+            if children is None:
+                start, end = self.node_range[node]
+                ids = self._live(self.order[start:end], group_id)
+                for b, other in zip(self._point_bounds(ids, query, query_w), ids):
+                    heapq.heappush(heap, (b, next(tie), -1, int(other)))
+            else:
+                for child in children:
+                    heapq.heappush(heap, (self._node_bound(child, query, query_w), next(tie), child, -1))
+
+    def top_candidates(self, group_id, m):
+        """Ids of the m groups with the lowest VL lower bound (ties: lower id)."""
+        query, query_w = self.coords[group_id], self.half_coords[group_id]
+        ids = [self._live(self.pending, group_id)]
+        bounds = [self._point_bounds(ids[0], query, query_w)]
+        n_found = len(ids[0])
+        heap = [(self._node_bound(0, query, query_w), 0)] if self.n_tree else []
+        while heap:
+            bound, node = heapq.heappop(heap)
+            # stop when m candidates are already below every unexplored node
+            if n_found >= m and np.partition(np.concatenate(bounds), m - 1)[m - 1] <= bound:
+                break
+            children = self.node_children[node]
+            if children is None:
+                start, end = self.node_range[node]
+                leaf = self._live(self.order[start:end], group_id)
+                ids.append(leaf)
+                bounds.append(self._point_bounds(leaf, query, query_w))
+                n_found += len(leaf)
+            else:
+                for child in children:
+                    heapq.heappush(heap, (self._node_bound(child, query, query_w), child))
+        ids, bounds = np.concatenate(ids), np.concatenate(bounds)
+        return ids[np.lexsort((ids, bounds))[:m]]
+
+    def _best_of(self, group_id, ids, best):
+        """Update best (cost, id) with the exact merged VL of ids; ties go to the lower id."""
+        if len(ids) == 0:
+            return best
+        costs = merge_cost_matrix(self.lowers, self.uppers, rows=[group_id], cols=ids)[0]
+        i = np.lexsort((ids, costs))[0]
+        if (costs[i], ids[i]) < best:
+            return (costs[i], int(ids[i]))
+        return best
+
+    def nearest(self, group_id, top_m=None):
+        """
+        Partner with the lowest merged VL, as (cost, partner_id), or None.
+
+        By default the search is exact (ties go to the lowest id, like a linear
+        scan). With top_m, only the top_m candidates by lower bound are scored.
+        """
+        best = (float('inf'), -1)
+        if top_m is not None:
+            best = self._best_of(group_id, self.top_candidates(group_id, top_m), best)
+            return best if best[1] != -1 else None
+
+        query, query_w = self.coords[group_id], self.half_coords[group_id]
+        best = self._best_of(group_id, self._live(self.pending, group_id), best)
+        # Exact scores are batched: the first leaf sets an upper bound, then the
+        # traversal only collects the groups whose lower bound does not exceed
+        # it, and these are scored with a single call at the end.
+        collected = []
+        heap = [(self._node_bound(0, query, query_w), 0)] if self.n_tree else []
+        while heap:
+            bound, node = heapq.heappop(heap)
+            # il bound è calcolato con aritmetica diversa: piccola tolleranza sugli arrotondamenti
+            if bound * (1 - 1e-9) > best[0]:
+                break
+            children = self.node_children[node]
+            if children is None:
+                start, end = self.node_range[node]
+                ids = self._live(self.order[start:end], group_id)
+                if best[1] == -1:
+                    best = self._best_of(group_id, ids, best)
+                else:
+                    bounds = self._point_bounds(ids, query, query_w)
+                    collected.append(ids[bounds * (1 - 1e-9) <= best[0]])
+            else:
+                for child in children:
+                    heapq.heappush(heap, (self._node_bound(child, query, query_w), child))
+        if collected:
+            best = self._best_of(group_id, np.concatenate(collected), best)
+        return best if best[1] != -1 else None
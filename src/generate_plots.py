@@ -4,6 +4,8 @@ import seaborn as sns
 import os
 import numpy as np
 
+from release import read_release
+
 def load_data():
     base_dir = os.path.dirname(os.path.abspath(__file__))
     kapra_path = os.path.join(base_dir, "../docs/data/kapra_optimization_results.csv")
@@ -70,12 +72,16 @@ def plot_cluster_example():
     # Load anonymized data
     base_dir = os.path.dirname(os.path.abspath(__file__))
     kapra_anon_path = os.path.join(base_dir, "../docs/data/kapra_anonymized.csv")
+    if not os.path.exists(kapra_anon_path):
+        # release binaria (bound numerici)
+        kapra_anon_path = os.path.join(base_dir, "../docs/data/kapra_anonymized.npz")
     
     if not os.path.exists(kapra_anon_path):
         print("KAPRA anonymized file not found.")
         return
         
-    df = pd.read_csv(kapra_anon_path)
+    # "[min-max]" (CSV) o colonne numeriche H{i}_lo / H{i}_hi (npz/parquet)
+    df = read_release(kapra_anon_path)
     
     # Pick a random group
     if 'GroupID' not in df.columns:
@@ -87,50 +93,22 @@ def plot_cluster_example():
         return
         
     # Select a group with decent size
+    sizes = df['GroupID'].value_counts()
     selected_group = group_ids[0]
     for gid in group_ids:
-        if len(df[df['GroupID'] == gid]) >= 3:
+        if sizes[gid] >= 3:
             selected_group = gid
             break
             
     group_data = df[df['GroupID'] == selected_group]
     
-    # Parse H columns
-    h_cols = [c for c in df.columns if c.startswith('H')]
+    # Envelope bounds (same for all the records of the group)
+    h_cols = [c[:-3] for c in df.columns if c.startswith('H') and c.endswith('_lo')]
+    lowers = group_data.iloc[0][[f'{c}_lo' for c in h_cols]].astype(float).to_numpy()
+    uppers = group_data.iloc[0][[f'{c}_hi' for c in h_cols]].astype(float).to_numpy()
     
     plt.figure(figsize=(10, 6))
     
-    # Plot Envelope
-    # Data is in format "[min-max]"
-    
-    lowers = []
-    uppers = []
-    
-    for col in h_cols:
-        val_str = group_data.iloc[0][col] # Envelope is same for all in group usually? 
-        # Actually in the CSV strictly speaking it puts the same envelope for all? YES.
-        # Format "[min-max]"
-        val_str = val_str.strip("[]")
-        parts = val_str.split('-')
-        if len(parts) == 2: # Simple positive range
-             l, u = float(parts[0]), float(parts[1])
-        elif len(parts) > 2: # Negative numbers case? e.g. -5--2
-             # This parsing is naive, assume positive for now or use regex if needed
-             # Based on previous files, data seems positive/normalized? 
-             # Let's simple parse:
-             # Just use the string split logic carefully or regex
-             import re
-             matches = re.findall(r"[-+]?\d*\.\d+|\d+", val_str)
-             if len(matches) >= 2:
-                 l, u = float(matches[0]), float(matches[1])
-             else:
-                 l, u = 0, 0
-        else:
-             l, u = 0, 0
-             
-        lowers.append(l)
-        uppers.append(u)
-        
     x_axis = range(len(h_cols))
     
     plt.fill_between(x_axis, lowers, uppers, color='gray', alpha=0.3, label='Anonymization Envelope')
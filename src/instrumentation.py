@@ -0,0 +1,114 @@
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+class Instrumentation:
+    """
+    Spans and counters of an anonymization run.
+
+    Pass an instance as instrumentation= to run_kapra_anonymization /
+    run_naive_anonymization:
+    - span(name, **args) times a phase (spans can be nested);
+    - count(name, n) adds n to a counter (SAX encodings, merge-cost
+      evaluations, envelopes, PL evaluations, suppressed records, ...);
+      SAX encodings are the rows actually encoded, not the cached codes read.
+
+    With trace_memory=True every span also records the tracemalloc peak (MB)
+    reached while it was open; tracemalloc slows the run down, so it is off
+    by default. The result can be exported with to_json or, for
+    chrome://tracing / Perfetto, with to_chrome_trace.
+    """
+    enabled = True
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.spans = []
+        self.counters = {}
+        self._origin = time.perf_counter()
+        self._depth = 0 # span aperti
+        self._open = [] # picchi di memoria degli span aperti (trace_memory)
+        self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            if self._open:
+                # il picco raggiunto finora appartiene allo span padre
+                self._open[-1] = max(self._open[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._open.append(0)
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._depth -= 1
+            record = {'name': name, 'start': start - self._origin, 'duration': end - start,
+                      'depth': self._depth, 'args': args}
+            if self.trace_memory:
+                peak = max(self._open.pop(), tracemalloc.get_traced_memory()[1])
+                record['memory_peak_mb'] = peak / 2**20
+                if self._open:
+                    self._open[-1] = max(self._open[-1], peak)
+                elif self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+            self.spans.append(record)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def merge_counters(self, counters):
+        """Add the counters of another run (e.g. a worker process)."""
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def to_dict(self):
+        """Spans (in completion order, times in seconds from creation) and counters."""
+        return {'spans': self.spans, 'counters': dict(self.counters)}
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+
+    def to_chrome_trace(self, path):
+        """
+        Write the spans as Chrome trace events (complete "X" events, times in
+        microseconds) and the counters as one "C" event at the end of the run.
+        """
+        pid = os.getpid()
+        events = []
+        for s in sorted(self.spans, key=lambda s: s['start']):
+            args = dict(s['args'])
+            if 'memory_peak_mb' in s:
+                args['memory_peak_mb'] = s['memory_peak_mb']
+            events.append({'name': s['name'], 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': s['start'] * 1e6, 'dur': s['duration'] * 1e6, 'args': args})
+        end = max((s['start'] + s['duration'] for s in self.spans), default=0.0)
+        if self.counters:
+            events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0,
+                           'ts': end * 1e6, 'args': dict(self.counters)})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+class NullInstrumentation:
+    """Disabled instrumentation (the default): spans and counters do nothing."""
+    enabled = False
+    _null_span = contextlib.nullcontext()
+
+    def span(self, name, **args):
+        return self._null_span
+
+    def count(self, name, n=1):
+        pass
+
+    def merge_counters(self, counters):
+        pass
+
+NULL_INSTRUMENTATION = NullInstrumentation()
@@ -64,6 +64,29 @@ def partition_dataset(dataset, k, time_cols):
         # se non ho abbastanza dati, non posso dividere
         return [dataset]
 
+def partition_indices(series, k, idx=None):
+    """
+    Same partitioning as partition_dataset, on the rows of a series matrix.
+    Returns a list of index arrays (the partitions, in the same order) instead
+    of lists of dicts, so no record is copied while splitting.
+    """
+    if idx is None:
+        idx = np.arange(len(series))
+    # caso base: non posso dividere se ho meno di 2*k dati
+    if len(idx) < 2 * k:
+        return [idx]
+    
+    vals = series[idx]
+    spread = vals.max(axis=0) - vals.min(axis=0)
+    best_col = int(np.argmax(spread)) # a parità di range vince la prima colonna
+    if spread[best_col] == 0:
+        return [idx]
+    
+    # ordinamento stabile, come list.sort
+    idx = idx[np.argsort(vals[:, best_col], kind='stable')]
+    mid = len(idx) // 2
+    return partition_indices(series, k, idx[:mid]) + partition_indices(series, k, idx[mid:])
+
 def calculate_partition_cost(partitions, time_cols):
     """
     Calculates the average Value Loss (VL) of the partitions.
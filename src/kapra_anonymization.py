@@ -1,14 +1,20 @@
 import pandas as pd
 import numpy as np
 import time
+import heapq
+import tempfile
 import os
 import sys
 
 # Add src to path to import utils
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from src.sax_utils import ts_to_sax, calculate_pattern_loss, sax_to_values
-from src.kapra_utils import calculate_envelope_and_vl
+from src.sax_utils import SaxCodeCache, sax_codes_to_strings, group_sax_codes, isax_levels, isax_demote
+from src.kapra_utils import Envelope, merge_cost_matrix, group_envelopes
+from src.envelope_index import EnvelopeIndex
+from src.record_store import RecordStore, STORE_CHUNK_ROWS, select_time_columns, rows_per_chunk
+from src.release import Release, RELEASE_CHUNK_ROWS
+from src.instrumentation import NULL_INSTRUMENTATION
 
 # --- Configuration ---
 # Defaults (can be overridden by function args)
@@ -16,143 +22,337 @@ DEFAULT_K = 8
 DEFAULT_P = 2
 DEFAULT_SAX_LEVEL = 8
 DEFAULT_N_SEGMENTS = 4
+# Phase 3 switches from a vectorized scan to the envelope index from this many P-groups
+PARTNER_INDEX_MIN_GROUPS = 5000
 
 def load_data(filepath):
     """Load the dataset."""
     return pd.read_csv(filepath)
 
-def get_time_series(df):
-    """Extract time series columns (H1..H8) as a numpy array."""
-    ts_cols = [c for c in df.columns if c.startswith('H')]
-    return df[ts_cols].values
+def get_time_series(df, time_cols=None):
+    """Extract the time series columns (default H1..Hn, see select_time_columns) as a numpy array."""
+    return df[select_time_columns(df.columns, time_cols)].values
 
-def calculate_group_vl(group_records):
-    """Calculate Value Loss for a group of records."""
-    if len(group_records) == 0:
-        return 0.0
-    ts_data = np.array([r['timeseries'] for r in group_records])
-    _, _, vl = calculate_envelope_and_vl(ts_data)
-    return vl
+class KGroupMerger:
+    """
+    Phase 3 engine: greedy merge of P-groups until every group has >= K records.
+
+    At each step the smallest undersized group (ties: the oldest) is merged
+    with the group giving the lowest merged VL (ties: the oldest), exactly as a
+    rescan of the whole group list would do. Undersized groups sit in a heap;
+    best-partner costs are cached and only recomputed when the cached partner
+    has been merged away (a new group can only improve a cached best, and is
+    checked against the cached ones when it is created).
 
-def calculate_merge_cost(group1_records, group2_records):
+    Groups are identified by creation order: ids 0..G-1 are the initial
+    P-groups, every merge creates the next id. Membership is tracked with a
+    union-find parent array and a linked list of P-group ids per group, so no
+    record list is copied while merging.
+
+    Partners are found with a vectorized scan, or with an EnvelopeIndex when
+    use_index is True (default: from PARTNER_INDEX_MIN_GROUPS groups on).
+    Both are exact; top_m restricts the index search to the top_m candidates
+    by VL lower bound (approximate, faster on very large inputs).
     """
-    Calculate the cost of merging two groups.
-    Cost is defined as the increase in VL or the resulting VL.
-    Here we use the resulting VL of the combined group.
+    def __init__(self, envelopes, use_index=None, top_m=None):
+        n_groups = len(envelopes)
+        capacity = max(1, 2 * n_groups)
+        n = len(envelopes[0].lower) if n_groups else 0
+        self.n_initial = n_groups
+        self.n_created = n_groups
+        self.lowers = np.zeros((capacity, n))
+        self.uppers = np.zeros((capacity, n))
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        for i, env in enumerate(envelopes):
+            self.lowers[i] = env.lower
+            self.uppers[i] = env.upper
+            self.counts[i] = env.count
+        self.alive[:n_groups] = True
+        # union-find over group ids: parent[i] == i for live groups
+        self.parent = np.arange(capacity)
+        # ordered membership: linked list of initial P-group ids
+        self.head = np.arange(capacity)
+        self.tail = np.arange(capacity)
+        self.next = np.full(max(1, n_groups), -1)
+        # P-group whose pattern/level represents each group (domination logic)
+        self.dominant = np.arange(capacity)
+        # merge forest: (group_to_merge, partner, new_group) in merge order
+        self.merges = []
+        # hot-path counters (see Instrumentation): merge costs computed by the
+        # vectorized scan, nearest-partner queries to the envelope index
+        self.cost_evaluations = 0
+        self.index_queries = 0
+        # cached best partner of each group (-1: none)
+        self.best_cost = np.full(capacity, np.inf)
+        self.best_id = np.full(capacity, -1)
+        self.top_m = top_m
+        if use_index is None:
+            use_index = top_m is not None or n_groups >= PARTNER_INDEX_MIN_GROUPS
+        self.index = EnvelopeIndex(self.lowers, self.uppers, range(n_groups)) if use_index and n_groups else None
+
+    def find(self, group_id):
+        """Live group that currently contains group_id (path compression)."""
+        root = group_id
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[group_id] != root:
+            self.parent[group_id], group_id = root, self.parent[group_id]
+        return root
+
+    def live_groups(self):
+        """Ids of the live groups, in creation order."""
+        return np.flatnonzero(self.alive[:self.n_created])
+
+    def members(self, group_id):
+        """Initial P-group ids of a group, in merge order."""
+        out = []
+        node = self.head[group_id]
+        while node != -1:
+            out.append(node)
+            node = self.next[node]
+        return out
+
+    def _merge_costs(self, group_id, cols):
+        self.cost_evaluations += len(cols)
+        return merge_cost_matrix(self.lowers, self.uppers, rows=[group_id], cols=cols)[0]
+
+    def best_partner(self, group_id):
+        """(cost, partner id) of the cheapest merge for group_id, or None."""
+        if self.index is not None:
+            self.index_queries += 1
+            return self.index.nearest(group_id, self.top_m)
+        cached = self.best_id[group_id]
+        if cached != -1 and self.alive[cached]:
+            return self.best_cost[group_id], int(cached)
+        cols = self.live_groups()
+        cols = cols[cols != group_id]
+        if len(cols) == 0:
+            return None
+        costs = self._merge_costs(group_id, cols)
+        best = int(np.argmin(costs))
+        self.best_cost[group_id], self.best_id[group_id] = costs[best], cols[best]
+        return costs[best], int(cols[best])
+
+    def merge(self, group_id, partner_id):
+        """Merge two live groups into a new one and return its id."""
+        new_id = self.n_created
+        self.n_created += 1
+        self.lowers[new_id] = np.minimum(self.lowers[group_id], self.lowers[partner_id])
+        self.uppers[new_id] = np.maximum(self.uppers[group_id], self.uppers[partner_id])
+        self.counts[new_id] = self.counts[group_id] + self.counts[partner_id]
+        self.alive[[group_id, partner_id]] = False
+        self.alive[new_id] = True
+        self.parent[[group_id, partner_id]] = new_id
+
+        # records of group_id first, then the partner's
+        self.next[self.tail[group_id]] = self.head[partner_id]
+        self.head[new_id] = self.head[group_id]
+        self.tail[new_id] = self.tail[partner_id]
+
+        # Domination logic: the larger group keeps its pattern (partner on ties)
+        if self.counts[partner_id] >= self.counts[group_id]:
+            self.dominant[new_id] = self.dominant[partner_id]
+        else:
+            self.dominant[new_id] = self.dominant[group_id]
+
+        self.best_id[[group_id, partner_id]] = -1
+        self.merges.append((group_id, partner_id, new_id))
+        if self.index is not None:
+            self.index.remove(group_id)
+            self.index.remove(partner_id)
+            self.index.insert(new_id)
+        return new_id
+
+    def _prime(self, group_ids):
+        """Cache the best partner of many groups with one chunked cost matrix."""
+        cols = self.live_groups()
+        group_ids = np.asarray(group_ids, dtype=np.int64)
+        if len(cols) < 2:
+            return
+        # blocchi di righe: solo l'argmin di ogni riga resta in memoria
+        for start in range(0, len(group_ids), 256):
+            block = group_ids[start:start + 256]
+            self.cost_evaluations += len(block) * len(cols)
+            costs = merge_cost_matrix(self.lowers, self.uppers, rows=block, cols=cols)
+            costs[block[:, None] == cols[None, :]] = np.inf
+            best = np.argmin(costs, axis=1)
+            self.best_cost[block] = costs[np.arange(len(block)), best]
+            self.best_id[block] = cols[best]
+
+    def _offer(self, new_id):
+        """A new group replaces a cached best partner only if strictly cheaper."""
+        if self.index is not None:
+            return
+        waiting = np.flatnonzero((self.best_id[:self.n_created] != -1) & self.alive[:self.n_created])
+        if len(waiting) == 0:
+            return
+        self.cost_evaluations += len(waiting)
+        costs = merge_cost_matrix(self.lowers, self.uppers, rows=waiting, cols=[new_id])[:, 0]
+        better = costs < self.best_cost[waiting]
+        self.best_cost[waiting[better]] = costs[better]
+        self.best_id[waiting[better]] = new_id
+
+    def run(self, K):
+        """
+        Merge until every live group has at least K records.
+        Returns False if a single undersized group is left with no partner.
+        """
+        heap = [(int(self.counts[g]), int(g)) for g in self.live_groups() if self.counts[g] < K]
+        heapq.heapify(heap)
+        if self.index is None:
+            self._prime([g for _, g in heap])
+        while heap:
+            _, group_id = heapq.heappop(heap)
+            if not self.alive[group_id]:
+                continue
+            best = self.best_partner(group_id)
+            if best is None:
+                return False
+            new_id = self.merge(group_id, best[1])
+            self._offer(new_id)
+            if self.counts[new_id] < K:
+                heapq.heappush(heap, (int(self.counts[new_id]), new_id))
+        return True
+
+    def envelope(self, group_id):
+        return Envelope(self.lowers[group_id].copy(), self.uppers[group_id].copy(),
+                        int(self.counts[group_id]))
+
+    def build_groups(self, p_groups):
+        """
+        Group dicts of the live groups, with the record indices of their
+        P-groups and their id in the merge forest (forest_id).
+        """
+        groups = []
+        for group_id in self.live_groups():
+            dom = p_groups[self.dominant[group_id]]
+            members = np.concatenate([p_groups[m]['members'] for m in self.members(group_id)])
+            groups.append({
+                'sax': dom['sax'],
+                'members': members,
+                'level': dom['level'],
+                'type': 'merged' if group_id >= self.n_initial else p_groups[group_id]['type'],
+                'envelope': self.envelope(group_id),
+                'forest_id': int(group_id)
+            })
+        return groups
+
+class PGroups:
     """
-    combined = group1_records + group2_records
-    return calculate_group_vl(combined)
+    Result of Phase 1 & 2 (the P-groups), which does not depend on K.
 
-def run_kapra_anonymization(K=DEFAULT_K, P=DEFAULT_P, SAX_LEVEL=DEFAULT_SAX_LEVEL, N_SEGMENTS=DEFAULT_N_SEGMENTS, verbose=True):
-    start_time = time.time()
-    
-    # 1. Load Data
-    data_path = os.path.join(os.path.dirname(__file__), '../docs/data/dataset_raw.csv')
-    if not os.path.exists(data_path):
-         data_path = os.path.join(os.path.dirname(__file__), '../../docs/data/dataset_raw.csv')
-    
-    if verbose:
-        print(f"--- KAPRA Algorithm (K={K}, P={P}, MaxLevel={SAX_LEVEL}) ---")
-        print(f"Loading data from {data_path}...")
-    
-    try:
-        df = load_data(data_path)
-    except FileNotFoundError:
-        print(f"Error: {data_path} not found.")
-        return None
+    groups: list of {'sax', 'members', 'level', 'type', 'envelope'} dicts;
+    level, code: SAX level and codes of every record (the store arrays they
+    were computed in, or a copy once cached, see snapshot).
+    """
+    def __init__(self, groups, level, code):
+        self.groups = groups
+        self.level = level
+        self.code = code
 
-    ts_data = get_time_series(df)
-    
-    # Prepare records with metadata
-    records = []
-    for idx, row in df.iterrows():
-        ts = ts_data[idx]
-        records.append({
-            'original_index': idx,
-            'timeseries': ts,
-            'row_data': row,
-            'sax': '', 
-            'level': SAX_LEVEL, # Track distinct level per record/group
-            'group_id': None
-        })
-        
-    if verbose:
-        print(f"Total records: {len(records)}")
-        print("\n--- Phase 1 & 2: Initial Grouping & Recycling (Bottom-Up) ---")
+    def snapshot(self):
+        """Copy of the per-record arrays, safe to keep while the store is reused."""
+        return PGroups(self.groups, np.array(self.level), np.array(self.code))
+
+    def apply(self, store):
+        """Write the per-record SAX level/codes of the P-groups back to the store."""
+        if self.level is not store.level:
+            store.level[:] = self.level
+            store.code[:] = self.code
+
+def p_group_key(store, P, SAX_LEVEL, N_SEGMENTS, isax=False):
+    """Cache key of the P-groups of a dataset: everything Phase 1 & 2 depend on."""
+    return (store.fingerprint(), P, SAX_LEVEL, N_SEGMENTS, isax)
+
+def sax_level_ladder(SAX_LEVEL, isax=False):
+    """
+    Levels tried by Phase 1 & 2: MAX_LEVEL first, then one step down at a time
+    to level 3 (iSAX mode halves the cardinality at each step instead).
+    """
+    if isax:
+        return isax_levels(SAX_LEVEL)
+    return [SAX_LEVEL] + list(range(SAX_LEVEL - 1, 2, -1))
+
+def build_p_groups(store, P, SAX_LEVEL, N_SEGMENTS=DEFAULT_N_SEGMENTS, isax=False, verbose=True,
+                   chunk_rows=None, workdir=None, instrumentation=NULL_INSTRUMENTATION):
+    """
+    Phase 1 & 2: initial SAX grouping at SAX_LEVEL and recycling of the bad
+    records at lower levels, then the envelope of every P-group.
+    Fills store.level / store.code and returns the PGroups.
+    instrumentation receives a span per level and for the envelopes.
+    """
+    ts_data = store.series
+    # store riusato (es. sweep con un altro P): nessun record deve restare nel
+    # gruppo di una run precedente, altrimenti finirebbe in un envelope pubblicato
+    store.level[:] = 0
+    store.code[:] = 0
+    store.group[:] = -1
     
     # In true KAPRA/Algorithm 2:
     # We start with ALL records at MAX_LEVEL.
     # We identify Bad Leaves (groups < P).
     # We iteratively lower the level for Bad Leaves only, trying to merge them.
     
+    levels = sax_level_ladder(SAX_LEVEL, isax)
+    
+    # SAX codes of every record, computed once per dataset and filled per level.
+    # Note: the series are constant, only the alphabet size changes.
+    sax_cache = SaxCodeCache(ts_data, n_segments=N_SEGMENTS, chunk_rows=chunk_rows, workdir=workdir)
+    def level_codes(level, record_idx):
+        if not isax:
+            return sax_cache.codes(level)[record_idx]
+        # iSAX: coarser codes come from the finest ones with a bit shift
+        return isax_demote(sax_cache.codes(SAX_LEVEL)[record_idx], SAX_LEVEL, level)
+    
     # Initial Grouping at MAX_LEVEL
-    current_level = SAX_LEVEL
+    current_level = levels[0]
     
-    # Helper to group records by their SAX at a specific level
-    def group_records_by_sax(record_list, level):
-        groups = {}
-        for r in record_list:
-            # Recompute SAX at 'level'
-            # Note: r['timeseries'] is constant. 
-            sax = ts_to_sax(r['timeseries'], level=level, n_segments=N_SEGMENTS)
-            r['sax'] = sax # Update current sax
-            r['level'] = level
-            if sax not in groups:
-                groups[sax] = []
-            groups[sax].append(r)
-        return groups
+    # Helper to group records (index array) by their SAX at a specific level.
+    # Words are packed into integer keys and grouped with one sort; returns the
+    # groups with >= P records as (sax, members) and the remaining (bad) records.
+    def group_records_by_sax(record_idx, level):
+        encoded = sax_cache.encoded
+        codes = level_codes(level, record_idx)
+        # solo le righe codificate davvero (i livelli già in cache non contano)
+        instrumentation.count('sax_encodings', sax_cache.encoded - encoded)
+        # Update current pattern/level of the records
+        store.level[record_idx] = level
+        store.code[record_idx] = codes
+        _, order, starts, sizes = group_sax_codes(codes, level)
+        members = record_idx[order]
+        good = sizes >= P
+        words = sax_codes_to_strings(codes[order[starts[good]]])
+        good_groups = [(sax, members[s:s + n]) for sax, s, n in zip(words, starts[good], sizes[good])]
+        return good_groups, members[np.repeat(~good, sizes)]
 
     # 1. Initial State: All records are "bad" (candidates) or "good"
     # Actually, we group all.
-    all_groups = group_records_by_sax(records, current_level)
-    
-    final_p_groups = [] # List of {'sax':..., 'records':..., 'level':...}
-    bad_records = []
+    with instrumentation.span('phase1_2.level', level=current_level, records=len(store)):
+        good_groups, bad_records = group_records_by_sax(np.arange(len(store)), current_level)
     
     # Separate Good and Bad groups at MAX_LEVEL
-    for sax, recs in all_groups.items():
-        if len(recs) >= P:
-            final_p_groups.append({
-                'sax': sax, 
-                'records': recs, 
-                'level': current_level,
-                'type': 'good-leaf'
-            })
-        else:
-            bad_records.extend(recs)
+    final_p_groups = [{'sax': sax, 'members': members, 'level': current_level, 'type': 'good-leaf'}
+                      for sax, members in good_groups] # List of {'sax':..., 'members':..., 'level':...}
             
     if verbose:
         print(f"Level {current_level}: {len(final_p_groups)} good groups found. {len(bad_records)} records remaining in bad leaves.")
         
     # 2. Recycle Loop (Algorithm 2)
     # While bad records exist, lower level, regroup, extract good groups.
-    current_level -= 1
-    
-    while bad_records and current_level >= 3: # Assuming min SAX level typically 3 or 2
+    for current_level in levels[1:]: # Assuming min SAX level typically 3 or 2
+        if len(bad_records) == 0:
+            break
         # Regroup bad records at lower level
-        groups = group_records_by_sax(bad_records, current_level)
-        
-        new_bad_records = []
-        
-        for sax, recs in groups.items():
-            if len(recs) >= P:
-                final_p_groups.append({
-                    'sax': sax, 
-                    'records': recs, 
-                    'level': current_level,
-                    'type': 'good-leaf-recycled'
-                })
-            else:
-                new_bad_records.extend(recs)
-                
-        bad_records = new_bad_records
+        with instrumentation.span('phase1_2.level', level=current_level, records=len(bad_records)):
+            good_groups, bad_records = group_records_by_sax(bad_records, current_level)
+        final_p_groups.extend({'sax': sax, 'members': members, 'level': current_level, 'type': 'good-leaf-recycled'}
+                              for sax, members in good_groups)
         if verbose and len(bad_records) > 0:
              print(f"Level {current_level}: Found new good groups. {len(bad_records)} records still bad.")
-             
-        current_level -= 1
         
     # Handle remaining bad records (suppression or merge to root)
-    if bad_records:
+    if len(bad_records) > 0:
         if verbose:
             print(f"Warning: {len(bad_records)} records could not form P-groups even at lowest level.")
         # Option A: Suppress (Paper says "Suppress all time-series contained in bad leaves")
@@ -163,174 +363,273 @@ def run_kapra_anonymization(K=DEFAULT_K, P=DEFAULT_P, SAX_LEVEL=DEFAULT_SAX_LEVE
         if len(bad_records) >= P:
              final_p_groups.append({
                 'sax': '*', 
-                'records': bad_records, 
+                'members': bad_records, 
                 'level': 0, # Symbolic
                 'type': 'suppressed-but-kept'
             })
         else:
              # Strict suppression (exclude from output)
-             pass
+             instrumentation.count('records_suppressed', len(bad_records))
              
     current_groups = final_p_groups
+    # Envelope summaries: Phase 3 merges groups without touching their records
+    # (one streaming pass over the series, by P-group id)
+    for group_id, g in enumerate(current_groups):
+        store.group[g['members']] = group_id
+    with instrumentation.span('phase1_2.envelopes', groups=len(current_groups)):
+        envelopes = group_envelopes(ts_data, store.group, len(current_groups),
+                                    rows_per_chunk(ts_data.shape[1], chunk_rows or STORE_CHUNK_ROWS))
+    instrumentation.count('envelopes', len(envelopes))
+    for g, env in zip(current_groups, envelopes):
+        g['envelope'] = env
     if verbose:
         print(f"Total Groups after Phase 2: {len(current_groups)}")
-    
+    return PGroups(current_groups, store.level, store.code)
+
+def k_group_ladder(store, p_groups, K_values, partner_top_m=None, verbose=True, instrumentation=NULL_INSTRUMENTATION):
+    """
+    Phase 3 for an increasing list of K: the greedy merge for K_values[i+1]
+    continues from the partition of K_values[i] instead of restarting from
+    the P-groups, so every grouping is a coarsening of the previous one.
+
+    Yields (K, groups, merges) for each K, where merges are the
+    (group_to_merge, partner, new_group) steps of the merge forest added for
+    that K (group ids in KGroupMerger creation order). Fills store.level /
+    store.code, and store.group with the grouping of the last K yielded.
+    """
     # ==========================================
     # Phase 3: Formation of K-groups
     # ==========================================
     if verbose:
         print("\n--- Phase 3: Formation of K-groups ---")
+    p_groups.apply(store)
+    # i record soppressi da queste P-group non hanno gruppo (anche se lo avevano in una run precedente)
+    store.group[:] = -1
     
     # Standard Greedy Merge to satisfy K
-    while True:
-        invalid_indices = [i for i, g in enumerate(current_groups) if len(g['records']) < K]
-        if not invalid_indices:
-            break 
-            
-        invalid_indices.sort(key=lambda i: len(current_groups[i]['records']))
-        idx_to_merge = invalid_indices[0]
-        group_to_merge = current_groups[idx_to_merge]
-        
-        best_partner_idx = -1
-        min_merge_cost = float('inf')
-        
-        for i, other_group in enumerate(current_groups):
-            if i == idx_to_merge:
-                continue
-            
-            cost = calculate_merge_cost(group_to_merge['records'], other_group['records'])
-            if cost < min_merge_cost:
-                min_merge_cost = cost
-                best_partner_idx = i
-                
-        if best_partner_idx != -1:
-            partner_group = current_groups[best_partner_idx]
-            
-            # Merging
-            # Logic: Combined records.
-            # Pattern: The paper doesn't specify deeply for Phase 3 pattern.
-            # We keep the pattern of the dominating group for reporting or a generalized one?
-            # If we merge a Level 10 group and a Level 5 group, what is the result?
-            # KAPRA aims to retain pattern. Reporting the separate patterns in the same K-group is valid in (k,P).
-            # (k,P) allows groups to have sub-groups with different P-patterns.
-            # BUT the output CSV structure usually implies 1 pattern per "Group".
-            # If we must output 1 pattern, we pick the dominant one.
-            
-            merged_records = group_to_merge['records'] + partner_group['records']
-            
-            # Domination logic
-            if len(partner_group['records']) >= len(group_to_merge['records']):
-                dom_sax = partner_group['sax']
-                dom_level = partner_group['level']
-            else:
-                dom_sax = group_to_merge['sax']
-                dom_level = group_to_merge['level']
-                
-            new_group = {
-                'sax': dom_sax,
-                'records': merged_records,
-                'level': dom_level,
-                'type': 'merged'
-            }
-            
-            idx1, idx2 = sorted([idx_to_merge, best_partner_idx], reverse=True)
-            current_groups.pop(idx1)
-            current_groups.pop(idx2)
-            current_groups.append(new_group)
-            
-        else:
-            if verbose:
+    merger = KGroupMerger([g['envelope'] for g in p_groups.groups], top_m=partner_top_m)
+    for K in K_values:
+        n_merges = len(merger.merges)
+        costs, queries = merger.cost_evaluations, merger.index_queries
+        with instrumentation.span('phase3', K=K, groups=int(len(merger.live_groups()))):
+            if not merger.run(K) and verbose:
                 print("Warning: Cannot merge remaining group.")
-            break
+            current_groups = merger.build_groups(p_groups.groups)
+        # un envelope nuovo per ogni merge
+        instrumentation.count('envelopes', len(merger.merges) - n_merges)
+        instrumentation.count('merge_cost_evaluations', merger.cost_evaluations - costs)
+        instrumentation.count('partner_index_queries', merger.index_queries - queries)
+        for group_id, g in enumerate(current_groups):
+            store.group[g['members']] = group_id
 
+        if verbose:
+            print(f"Final K-groups (K={K}): {len(current_groups)}")
+        yield K, current_groups, merger.merges[n_merges:]
+
+def form_k_groups(store, p_groups, K, partner_top_m=None, verbose=True, instrumentation=NULL_INSTRUMENTATION):
+    """
+    Phase 3: greedy merge of the P-groups until every group has >= K records.
+    The P-groups are not modified, so the same PGroups can be merged for
+    several K. Fills store.level / store.code / store.group and returns the
+    K-groups.
+    """
+    _, current_groups, _ = next(k_group_ladder(store, p_groups, [K], partner_top_m, verbose, instrumentation))
+    return current_groups
+
+def k_group_release(store, current_groups):
+    """Release of the K-groups (Phase 3 envelopes) with its average VL per group and PL per record."""
+    # Envelopes come from Phase 3 (one per group); each record keeps its own
+    # P-subgroup pattern/level from the store
+    release = Release(store, [g['members'] for g in current_groups],
+                      [g['envelope'].lower for g in current_groups],
+                      [g['envelope'].upper for g in current_groups])
+    
+    avg_vl_groups = np.mean(release.group_vl()) if current_groups else 0
+    avg_pl = release.pattern_loss() / len(release) if len(release) > 0 else 0
+    return release, avg_vl_groups, avg_pl
+
+def run_kapra_anonymization(K=DEFAULT_K, P=DEFAULT_P, SAX_LEVEL=DEFAULT_SAX_LEVEL, N_SEGMENTS=DEFAULT_N_SEGMENTS, verbose=True, isax=False,
+                            partner_top_m=None, out_of_core=False, workdir=None, chunk_rows=STORE_CHUNK_ROWS,
+                            data_path=None, output_path=None, output_format='csv', time_cols=None,
+                            store=None, write_release=True, p_group_cache=None, instrumentation=None):
+    """
+    Run KAPRA on data_path (default: docs/data/dataset_raw.csv) and write the
+    release to output_path (default: docs/data/kapra_anonymized.<output_format>).
+    The release format follows the extension of output_path: .csv ("[l-u]"
+    intervals), .npz or .parquet (numeric H{i}_lo / H{i}_hi bounds, typed
+    GroupID, pattern codes and level; see release.read_release).
+
+    With isax=True, SAX_LEVEL must be a power of two: records are encoded once
+    at SAX_LEVEL symbols with nested (iSAX) breakpoints and the recycling loop
+    halves the cardinality at each step, deriving coarser words by bit shifts.
+    partner_top_m switches Phase 3 to approximate partner selection among the
+    top-m candidates of the envelope index (default: exact).
+
+    With out_of_core=True the dataset is read chunk_rows rows at a time into
+    memory-mapped files in workdir (default: a temporary directory removed at
+    the end): series, SAX codes and per-record level/code/group arrays stay on
+    disk, Phase 3 only keeps the group envelopes in memory and the release is
+    written in a streaming pass. The result is identical to the in-memory run.
+
+    time_cols selects the series columns (default H<number>; a regular
+    expression or an explicit list, see record_store.select_time_columns).
+    Every stage is linear in the series length, and chunks hold at most
+    MAX_CHUNK_CELLS values, so long series are processed fewer rows at a time.
+
+    store replaces data_path with an already loaded RecordStore (e.g. one
+    shared by sweep.run_sweep); its level/code/group arrays are overwritten.
+    With write_release=False only the metrics are computed.
+
+    Phase 1 & 2 do not depend on K: with a p_group_cache dict, the P-groups
+    are memoized by p_group_key (dataset fingerprint, P, SAX_LEVEL,
+    N_SEGMENTS, isax) and runs that differ only in K go straight to Phase 3.
+
+    instrumentation (an instrumentation.Instrumentation) receives spans for
+    load, every Phase 1 & 2 level, Phase 3 and output, and counters for SAX
+    encodings, merge-cost evaluations, envelopes, PL evaluations and
+    suppressed records. Disabled by default.
+    """
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(__file__), f'../docs/data/kapra_anonymized.{output_format}')
+    results = _run_kapra([K], [output_path], None, P, SAX_LEVEL, N_SEGMENTS, verbose, isax, partner_top_m,
+                         out_of_core, workdir, chunk_rows, data_path, time_cols, store, write_release, p_group_cache,
+                         instrumentation)
+    return results[0] if results else None
+
+def run_kapra_ladder(K_values=(5, 10, 20, 50), P=DEFAULT_P, SAX_LEVEL=DEFAULT_SAX_LEVEL, N_SEGMENTS=DEFAULT_N_SEGMENTS,
+                     verbose=True, isax=False, partner_top_m=None, out_of_core=False, workdir=None,
+                     chunk_rows=STORE_CHUNK_ROWS, data_path=None, output_dir=None, output_format='csv',
+                     time_cols=None, store=None, write_release=True, p_group_cache=None, instrumentation=None):
+    """
+    Releases for several K from one run: Phase 1 & 2 run once and the Phase 3
+    merge for each K continues from the grouping of the previous one (see
+    k_group_ladder), so every coarser release is a union of groups of the
+    finer one. K_values must be strictly increasing.
+
+    Writes kapra_anonymized_K<k>.<output_format> for each K in output_dir
+    (default: docs/data), plus kapra_merge_forest.csv (K, Group, Partner,
+    Merged: the merges added for each K, as KGroupMerger ids) and
+    kapra_group_ladder.csv (K, GroupID, ForestID: the forest id of every
+    GroupID of each release). The other arguments are those of
+    run_kapra_anonymization.
+
+    Returns one result dict per K ('Time' is the time elapsed since the start
+    of the run when that release was ready).
+    """
+    K_values = list(K_values)
+    if not K_values or any(k2 <= k1 for k1, k2 in zip(K_values, K_values[1:])):
+        raise ValueError(f"K_values must be a non-empty, strictly increasing list, got {K_values}")
+    if output_dir is None:
+        output_dir = os.path.join(os.path.dirname(__file__), '../docs/data')
+    if write_release:
+        os.makedirs(output_dir, exist_ok=True)
+    output_paths = [os.path.join(output_dir, f'kapra_anonymized_K{K}.{output_format}') for K in K_values]
+    return _run_kapra(K_values, output_paths, output_dir, P, SAX_LEVEL, N_SEGMENTS, verbose, isax, partner_top_m,
+                      out_of_core, workdir, chunk_rows, data_path, time_cols, store, write_release, p_group_cache,
+                      instrumentation)
+
+def _run_kapra(K_values, output_paths, forest_dir, P, SAX_LEVEL, N_SEGMENTS, verbose, isax, partner_top_m,
+               out_of_core, workdir, chunk_rows, data_path, time_cols, store, write_release, p_group_cache,
+               instrumentation):
+    # Implementazione comune di run_kapra_anonymization / run_kapra_ladder
+    start_time = time.time()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    
+    # 1. Load Data
+    if data_path is None:
+        data_path = os.path.join(os.path.dirname(__file__), '../docs/data/dataset_raw.csv')
+        if not os.path.exists(data_path):
+             data_path = os.path.join(os.path.dirname(__file__), '../../docs/data/dataset_raw.csv')
+    
     if verbose:
-        print(f"Final K-groups: {len(current_groups)}")
+        print(f"--- KAPRA Algorithm (K={', '.join(map(str, K_values))}, P={P}, MaxLevel={SAX_LEVEL}) ---")
+        if store is None:
+            print(f"Loading data from {data_path}...")
     
-    # ==========================================
-    # Generate Output & Metrics
-    # ==========================================
+    tmp_dir = None
+    if out_of_core and workdir is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix='kapra_')
+        workdir = tmp_dir.name
+    if not out_of_core:
+        workdir, chunk_rows = None, None
     
-    final_csv_rows = []
-    total_vl = 0
-    total_pl = 0
-    total_records = 0
+    # Columnar store: series matrix + per-record level/code arrays, groups are index arrays
+    if store is None:
+        try:
+            with instrumentation.span('load', path=data_path):
+                store = RecordStore.from_csv(data_path, time_cols=time_cols, n_segments=N_SEGMENTS, workdir=workdir,
+                                             chunk_rows=chunk_rows or STORE_CHUNK_ROWS)
+        except FileNotFoundError:
+            print(f"Error: {data_path} not found.")
+            return []
+    ts_data = store.series
+    # righe per chunk limitate anche dalla lunghezza delle serie
+    stream_rows = rows_per_chunk(ts_data.shape[1], chunk_rows or STORE_CHUNK_ROWS)
+        
+    if verbose:
+        print(f"Total records: {len(store)}")
+        print("\n--- Phase 1 & 2: Initial Grouping & Recycling (Bottom-Up) ---")
     
-    for group_id, group in enumerate(current_groups):
-        records = group['records']
-        ts_data = np.array([r['timeseries'] for r in records])
+    # ==========================================
+    # Phase 1 & 2 (memoized by p_group_cache), then Phase 3
+    # ==========================================
+    key = p_group_key(store, P, SAX_LEVEL, N_SEGMENTS, isax) if p_group_cache is not None else None
+    p_groups = p_group_cache.get(key) if key is not None else None
+    if p_groups is None:
+        with instrumentation.span('phase1_2', P=P, SAX_LEVEL=SAX_LEVEL, records=len(store)):
+            p_groups = build_p_groups(store, P, SAX_LEVEL, N_SEGMENTS, isax, verbose,
+                                      chunk_rows=stream_rows if out_of_core else None, workdir=workdir,
+                                      instrumentation=instrumentation)
+        if key is not None:
+            p_groups = p_group_cache[key] = p_groups.snapshot()
+    elif verbose:
+        print("P-groups of this dataset/P/level/segments reused from the cache")
+    results, forest, ladder = [], [], []
+    for (K, current_groups, merges), output_path in zip(
+            k_group_ladder(store, p_groups, K_values, partner_top_m, verbose, instrumentation), output_paths):
+        forest.extend((K, *m) for m in merges)
+        ladder.extend((K, group_id, g['forest_id']) for group_id, g in enumerate(current_groups))
         
-        # Envelope & VL
-        lower, upper, vl = calculate_envelope_and_vl(ts_data)
+        # ==========================================
+        # Generate Output & Metrics
+        # ==========================================
         
-        # group_pattern = group['sax'] # OLD: Dominant pattern
-        # group_level = group['level'] # OLD: Dominant level
+        with instrumentation.span('metrics', K=K):
+            release, avg_vl_groups, avg_pl = k_group_release(store, current_groups)
+        instrumentation.count('pl_evaluations', len(release))
         
-        for r in records:
-            # Use the specific P-subgroup pattern/level for this record
-            r_pattern = r['sax']
-            r_level = r['level']
-            
-            # PL calculation depends on the level of the pattern
-            if r_level >= 3:
-                try:
-                    pl = calculate_pattern_loss(r['timeseries'], r_pattern, r_level)
-                except:
-                    pl = 0
-            else:
-                pl = 1.0 
-                
-            total_pl += pl
-            
-            csv_row = {
-                'GroupID': group_id + 1,
-                'Performance_SD': r['row_data']['Performance_SD'],
-                'Pattern': r_pattern, # Use individual pattern
-                'Level': r_level,   # Use individual level
-                'Value_Loss': vl
-            }
-            
-            for h_idx in range(len(lower)):
-                l_val = lower[h_idx]
-                u_val = upper[h_idx]
-                csv_row[f'H{h_idx+1}'] = f"[{int(l_val)}-{int(u_val)}]"
-                
-            final_csv_rows.append(csv_row)
-            
-        total_records += len(records)
+        end_time = time.time()
+        execution_time = end_time - start_time
         
-    end_time = time.time()
-    execution_time = end_time - start_time
-    
-    if current_groups:
-        avg_vl_groups = np.mean([calculate_group_vl(g['records']) for g in current_groups])
-    else:
-        avg_vl_groups = 0
+        if verbose:
+            print(f"\n--- Final Metrics (K={K}) ---")
+            print(f"Execution Time: {execution_time:.4f} seconds")
+            print(f"Average Value Loss (per group): {avg_vl_groups:.4f}")
+            print(f"Average Pattern Loss (per record): {avg_pl:.4f}")
         
-    avg_pl = total_pl / total_records if total_records > 0 else 0
-    
-    if verbose:
-        print("\n--- Final Metrics ---")
-        print(f"Execution Time: {execution_time:.4f} seconds")
-        print(f"Average Value Loss (per group): {avg_vl_groups:.4f}")
-        print(f"Average Pattern Loss (per record): {avg_pl:.4f}")
-    
-    # Save CSV
-    output_df = pd.DataFrame(final_csv_rows)
-    cols = ['GroupID'] + [f'H{i+1}' for i in range(8)] + ['Performance_SD', 'Pattern']
-    output_df = output_df[cols]
-    
-    output_path = os.path.join(os.path.dirname(__file__), '../docs/data/kapra_anonymized.csv')
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    output_df.to_csv(output_path, index=False)
-
-    return {
-        'K': K,
-        'P': P,
-        'SAX_LEVEL': SAX_LEVEL,
-        'Time': execution_time,
-        'VL': avg_vl_groups,
-        'PL': avg_pl
-    }
+        # Save release (streamed in chunks, bounds truncated to integers)
+        if write_release:
+            with instrumentation.span('output', K=K, path=output_path):
+                release.write(output_path, ['Performance_SD'], chunk_rows=chunk_rows or RELEASE_CHUNK_ROWS)
+        
+        results.append({
+            'K': K,
+            'P': P,
+            'SAX_LEVEL': SAX_LEVEL,
+            'Time': execution_time,
+            'VL': avg_vl_groups,
+            'PL': avg_pl
+        })
+    if write_release and forest_dir is not None:
+        # merge forest (id dei gruppi di KGroupMerger) e GroupID di ogni release -> id nella foresta
+        pd.DataFrame(forest, columns=['K', 'Group', 'Partner', 'Merged']).to_csv(
+            os.path.join(forest_dir, 'kapra_merge_forest.csv'), index=False)
+        pd.DataFrame(ladder, columns=['K', 'GroupID', 'ForestID']).to_csv(
+            os.path.join(forest_dir, 'kapra_group_ladder.csv'), index=False)
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    return results
 
 def main():
     run_kapra_anonymization()
@@ -0,0 +1,817 @@
+import pandas as pd
+import numpy as np
+import time
+import heapq
+import os
+import sys
+
+# Recupero la cartella dove si trova questo file
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Se non è già presente nella lista di ricerca, la aggiungo
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from kapra_anonymization import (build_p_groups, form_k_groups, k_group_release, sax_level_ladder,
+                                 DEFAULT_K, DEFAULT_P, DEFAULT_SAX_LEVEL, DEFAULT_N_SEGMENTS)
+from record_store import RecordStore, select_time_columns
+from kapra_utils import merge_cost_matrix, group_envelopes
+from release import Release, format_intervals, PATTERN_WILDCARD
+from sax_utils import SaxCodeCache, isax_demote, pack_sax_codes
+from instrumentation import NULL_INSTRUMENTATION
+
+# Column identifying a record in append batches and retraction requests
+RECORD_ID = 'ID'
+
+# Group tables of a state, in its directory next to the record log
+STATE_FILE = 'state.npz'
+
+# P-subgroup of a record in the log that is still buffered / has been retracted
+BUFFERED = -1
+RETRACTED = -2
+
+def _vl(lowers, uppers):
+    # VL di uno o più envelope (una riga per envelope)
+    n = lowers.shape[-1]
+    if n == 0:
+        return np.zeros(lowers.shape[:-1])
+    return np.sqrt(np.sum((uppers - lowers) ** 2, axis=-1) / n)
+
+class RecordLog:
+    """
+    Append-only record columns of an incremental state: one raw file per
+    column in the state directory, as in an out-of-core RecordStore. Rows
+    never move; a retracted record is only marked in its p_group column.
+
+    Columns are memory-mapped copy-on-write: changes to existing rows stay in
+    memory (and are replayed when an append remaps the files) until commit
+    writes them, and rows appended after the last commit are overwritten by
+    the next append of a reopened log. An unsaved state leaves the files as
+    they were.
+    """
+    def __init__(self, directory, columns, n_rows=0):
+        self.directory = directory
+        # nome -> (dtype, larghezza; None per le colonne 1-D)
+        self.columns = dict(columns)
+        self.n_rows = int(n_rows)
+        self._maps = {}
+        self._dirty = []
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.bin')
+
+    def _shape(self, name, n):
+        width = self.columns[name][1]
+        return (n,) if width is None else (n, width)
+
+    def __getitem__(self, name):
+        if name not in self._maps:
+            dtype = self.columns[name][0]
+            if self.n_rows == 0:
+                self._maps[name] = np.zeros(self._shape(name, 0), dtype=dtype)
+            else:
+                self._maps[name] = np.memmap(self._path(name), dtype=dtype, mode='c',
+                                             shape=self._shape(name, self.n_rows))
+        return self._maps[name]
+
+    def write(self, name, rows, values):
+        """Set a column on the given rows (on disk at the next commit)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        column = self[name]
+        column[rows] = values
+        self._dirty.append((name, rows, np.array(column[rows])))
+
+    def append(self, values):
+        """Append rows (column name -> values, scalars broadcast); returns their row numbers."""
+        n = len(values[RECORD_ID])
+        for name, (dtype, width) in self.columns.items():
+            data = np.ascontiguousarray(np.broadcast_to(np.asarray(values[name], dtype=dtype), self._shape(name, n)))
+            path = self._path(name)
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                # righe oltre n_rows: append non salvato di una sessione precedente
+                f.seek(self.n_rows * int(np.prod(self._shape(name, 1))) * np.dtype(dtype).itemsize)
+                f.write(data.tobytes())
+                f.truncate()
+        rows = np.arange(self.n_rows, self.n_rows + n, dtype=np.int64)
+        self.n_rows += n
+        self._maps = {}
+        for name, changed, column_values in self._dirty:
+            self[name][changed] = column_values
+        return rows
+
+    def commit(self):
+        """Write the pending changes of existing rows to the files."""
+        for name in {name for name, _, _ in self._dirty}:
+            column = np.memmap(self._path(name), dtype=self.columns[name][0], mode='r+',
+                               shape=self._shape(name, self.n_rows))
+            for changed_name, changed, column_values in self._dirty:
+                if changed_name == name:
+                    column[changed] = column_values
+            column.flush()
+            del column
+        self._dirty = []
+
+class RecordIdIndex:
+    """
+    Log row of every record ID, as sorted runs of (ID, row) pairs in .npy
+    files of the state directory. Every append adds a run, merged with the
+    previous one while that is at most twice its size: there are O(log n)
+    runs and a lookup binary-searches each of them.
+    """
+    def __init__(self, directory, names=()):
+        self.directory = directory
+        self.names = list(names)
+        self.runs = [np.load(os.path.join(directory, name), mmap_mode='r') for name in self.names]
+        self._seq = max((int(name[len('ids_'):-len('.npy')]) for name in self.names), default=-1) + 1
+        # run sostituiti da un merge: cancellati solo dopo il salvataggio dello stato
+        self._obsolete = []
+
+    def add(self, ids, rows):
+        """Index the log rows of an append."""
+        if len(ids) == 0:
+            return
+        order = np.argsort(ids, kind='stable')
+        run = np.stack([np.asarray(ids, dtype=np.int64)[order], np.asarray(rows, dtype=np.int64)[order]])
+        while self.runs and self.runs[-1].shape[1] <= 2 * run.shape[1]:
+            merged = np.concatenate([self.runs.pop(), run], axis=1)
+            run = merged[:, np.argsort(merged[0], kind='stable')]
+            self._obsolete.append(self.names.pop())
+        name = f'ids_{self._seq}.npy'
+        self._seq += 1
+        np.save(os.path.join(self.directory, name), run)
+        self.names.append(name)
+        self.runs.append(np.load(os.path.join(self.directory, name), mmap_mode='r'))
+
+    def lookup(self, ids):
+        """Log rows of the given IDs (all of them for an ID appended more than once)."""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        found = [np.zeros(0, dtype=np.int64)]
+        for run in self.runs:
+            lo = np.searchsorted(run[0], ids, side='left')
+            n = np.searchsorted(run[0], ids, side='right') - lo
+            # posizioni lo..hi-1 di ogni ID, in un solo array
+            positions = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())
+            found.append(np.asarray(run[1][positions]))
+        return np.unique(np.concatenate(found))
+
+    def cleanup(self):
+        """Delete the runs replaced by merges (once the state no longer refers to them)."""
+        for name in self._obsolete:
+            os.remove(os.path.join(self.directory, name))
+        self._obsolete = []
+
+def _record_ids(values):
+    ids = np.asarray(values)
+    if ids.dtype.kind not in 'iu':
+        raise ValueError(f"Record IDs must be integers, got {ids.dtype}")
+    return ids.astype(np.int64)
+
+class IncrementalKapra:
+    """
+    Persisted state of a KAPRA release, to anonymize newly arriving records
+    and retract records without rerunning the algorithm over the full history.
+
+    The state lives in a directory and keeps:
+    - P-subgroups: SAX level, codes (the pattern), record count and K-group;
+    - K-groups: envelope bounds, record count (GroupID = index + 1; a group
+      emptied or merged away by a retraction keeps count 0) and the head and
+      tail of the linked list of its records (next column of the log, as in
+      KGroupMerger);
+    - the record log (RecordLog): ID, series and factorized attributes of
+      every record received, with its P-subgroup (BUFFERED, RETRACTED) and
+      published pattern/level, indexed by ID (RecordIdIndex);
+    - buffer: the log rows of the records that could not be placed yet.
+
+    append assigns each new record to a P-subgroup whose pattern it matches
+    (its SAX word at that level), choosing the one whose K-group envelope
+    grows the least, and buffers the records that match no pattern. Once the
+    buffer holds K records, KAPRA runs on the buffer alone and the new
+    (k, P)-groups are added to the state. retract removes records and repairs
+    only the groups they were in.
+
+    Records are reached through the member lists of the groups touched, so an
+    append costs O(batch + buffer) and a retraction O(retracted records +
+    members of the groups repaired); the Phase 3 partner search of a group
+    left with fewer than K records also scans the envelopes of the live
+    K-groups. save writes the changed rows of the log and the group tables,
+    load maps the log and indexes the patterns: both are O(groups), not
+    O(records).
+    """
+    def __init__(self, directory, K, P, SAX_LEVEL, N_SEGMENTS, isax, time_cols, attribute_columns, categories,
+                 p_level, p_code, p_count, p_group, k_lower, k_upper, k_count, k_head, k_tail,
+                 buffer, n_records, n_rows=0, id_runs=()):
+        self.directory = directory
+        self.K, self.P, self.SAX_LEVEL, self.N_SEGMENTS, self.isax = K, P, SAX_LEVEL, N_SEGMENTS, isax
+        self.time_cols = list(time_cols)
+        self.attribute_columns = list(attribute_columns)
+        self.levels = sax_level_ladder(SAX_LEVEL, isax)
+        self.p_level = np.asarray(p_level, dtype=np.int16)
+        self.p_code = np.asarray(p_code, dtype=np.uint8).reshape(len(self.p_level), N_SEGMENTS)
+        self.p_count = np.asarray(p_count, dtype=np.int64)
+        self.p_group = np.asarray(p_group, dtype=np.int64)
+        self.k_lower = np.asarray(k_lower, dtype=float).reshape(-1, len(self.time_cols))
+        self.k_upper = np.asarray(k_upper, dtype=float).reshape(-1, len(self.time_cols))
+        self.k_count = np.asarray(k_count, dtype=np.int64)
+        self.k_head = np.asarray(k_head, dtype=np.int64)
+        self.k_tail = np.asarray(k_tail, dtype=np.int64)
+        self.buffer = np.asarray(buffer, dtype=np.int64)
+        # record ricevuti finora (anche ritirati): numerazione degli ID mancanti
+        self.n_records = int(n_records)
+        # valori distinti degli attributi, in ordine di codice
+        self.categories = {col: list(categories[col]) for col in self.attribute_columns}
+        self._lookups = {col: {v: i for i, v in enumerate(self.categories[col])} for col in self.attribute_columns}
+        columns = {RECORD_ID: (np.int64, None), 'series': (np.float64, len(self.time_cols)),
+                   'p_group': (np.int64, None), 'level': (np.int16, None), 'code': (np.uint8, N_SEGMENTS),
+                   'next': (np.int64, None)}
+        columns.update({f'attr_{col}': (np.int32, None) for col in self.attribute_columns})
+        self.log = RecordLog(directory, columns, n_rows)
+        self.ids = RecordIdIndex(directory, id_runs)
+        # P-subgroup ids per (level, parola SAX impaccata); il gruppo '*' (level 0) non ha pattern
+        self._index = {}
+        self._index_p_groups(np.arange(len(self.p_level)))
+
+    def _index_p_groups(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[(self.p_level[ids] > 0) & (self.p_count[ids] > 0)]
+        for level in np.unique(self.p_level[ids]):
+            level_ids = ids[self.p_level[ids] == level]
+            for g, key in zip(level_ids.tolist(), pack_sax_codes(self.p_code[level_ids], int(level)).tolist()):
+                self._index.setdefault((int(level), key), []).append(g)
+
+    def _unindex_p_group(self, g):
+        if self.p_level[g] == 0:
+            return
+        key = (int(self.p_level[g]), pack_sax_codes(self.p_code[g], int(self.p_level[g])).tolist()[0])
+        self._index[key].remove(g)
+        if not self._index[key]:
+            del self._index[key]
+
+    @classmethod
+    def from_groups(cls, store, p_groups, current_groups, directory, K, P, SAX_LEVEL,
+                    N_SEGMENTS=DEFAULT_N_SEGMENTS, isax=False):
+        """
+        State, in directory, of a KAPRA run (the PGroups of build_p_groups and
+        the K-groups of form_k_groups on store). Records suppressed by the run
+        (in no group) start in the buffer.
+        """
+        n = len(store.time_cols)
+        attribute_columns = store.attribute_columns()
+        state = cls(directory, K, P, SAX_LEVEL, N_SEGMENTS, isax, store.time_cols, attribute_columns,
+                    {col: [] for col in attribute_columns}, [], np.zeros((0, N_SEGMENTS)), [], [],
+                    np.zeros((0, n)), np.zeros((0, n)), [], [], [], [], len(store))
+        has_ids = store.frame is not None and RECORD_ID in store.frame.columns
+        ids = _record_ids(store.attribute(RECORD_ID)) if has_ids else np.arange(1, len(store) + 1)
+        rows = state._append_records(store.series, ids, {col: store.attribute(col) for col in attribute_columns})
+        state.buffer = state._add_groups(store, p_groups, current_groups, rows)
+        return state
+
+    @property
+    def n_groups(self):
+        return len(self.k_count)
+
+    def save(self):
+        """Commit the record log and write the group tables (replaced atomically)."""
+        self.log.commit()
+        arrays = {
+            'params': np.array([self.K, self.P, self.SAX_LEVEL, self.N_SEGMENTS, int(self.isax), self.n_records,
+                                self.log.n_rows]),
+            'time_cols': np.array(self.time_cols, dtype=str),
+            'attribute_columns': np.array(self.attribute_columns, dtype=str),
+            'p_level': self.p_level, 'p_code': self.p_code, 'p_count': self.p_count, 'p_group': self.p_group,
+            'k_lower': self.k_lower, 'k_upper': self.k_upper, 'k_count': self.k_count,
+            'k_head': self.k_head, 'k_tail': self.k_tail, 'buffer': self.buffer,
+            'id_runs': np.array(self.ids.names, dtype=str),
+        }
+        for col in self.attribute_columns:
+            values = np.asarray(self.categories[col])
+            # niente pickle nell'archivio: valori non numerici salvati come stringhe
+            arrays[f'categories__{col}'] = values.astype(str) if values.dtype == object else values
+        path = os.path.join(self.directory, STATE_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        self.ids.cleanup()
+
+    @classmethod
+    def load(cls, directory):
+        """Open a state written by save."""
+        with np.load(os.path.join(directory, STATE_FILE), allow_pickle=False) as data:
+            K, P, SAX_LEVEL, N_SEGMENTS, isax, n_records, n_rows = data['params'].tolist()
+            attribute_columns = data['attribute_columns'].tolist()
+            categories = {col: data[f'categories__{col}'].tolist() for col in attribute_columns}
+            return cls(directory, K, P, SAX_LEVEL, N_SEGMENTS, bool(isax), data['time_cols'].tolist(),
+                       attribute_columns, categories, data['p_level'], data['p_code'], data['p_count'],
+                       data['p_group'], data['k_lower'], data['k_upper'], data['k_count'], data['k_head'],
+                       data['k_tail'], data['buffer'], n_records, n_rows, data['id_runs'].tolist())
+
+    def _encode(self, col, values):
+        # codici di un attributo; i valori nuovi si aggiungono alle categorie
+        lookup = self._lookups[col]
+        for value in pd.unique(values):
+            if value not in lookup:
+                lookup[value] = len(lookup)
+                self.categories[col].append(value)
+        return pd.Series(values).map(lookup).to_numpy(dtype=np.int32)
+
+    def _append_records(self, series, ids, attributes):
+        # nuovi record in coda al log, tutti nel buffer finché non vengono assegnati
+        values = {RECORD_ID: ids, 'series': series, 'p_group': BUFFERED, 'level': 0, 'code': 0, 'next': -1}
+        for col in self.attribute_columns:
+            values[f'attr_{col}'] = self._encode(col, attributes[col])
+        rows = self.log.append(values)
+        self.ids.add(ids, rows)
+        return rows
+
+    def _store(self, rows):
+        # RecordStore dei record rows del log
+        attributes = {col: (np.asarray(self.log[f'attr_{col}'][rows]), np.array(self.categories[col], dtype=object))
+                      for col in self.attribute_columns}
+        return RecordStore(np.asarray(self.log['series'][rows]), time_cols=self.time_cols,
+                           n_segments=self.N_SEGMENTS, attributes=attributes)
+
+    def _link(self, k, rows):
+        # accoda i record rows alla lista del K-group k
+        if len(rows) == 0:
+            return
+        self.log.write('next', rows, np.r_[rows[1:], -1])
+        if self.k_tail[k] >= 0:
+            self.log.write('next', [self.k_tail[k]], rows[0])
+        else:
+            self.k_head[k] = rows[0]
+        self.k_tail[k] = rows[-1]
+
+    def _members(self, k):
+        # record del K-group k, nell'ordine della sua lista
+        # vista ndarray della memmap: accesso per elemento senza l'overhead di np.memmap
+        next_row = self.log['next'].view(np.ndarray)
+        rows = []
+        row = int(self.k_head[k])
+        while row >= 0:
+            rows.append(row)
+            row = int(next_row[row])
+        return np.array(rows, dtype=np.int64)
+
+    def _add_groups(self, store, p_groups, current_groups, rows):
+        """
+        Add the P-subgroups and K-groups of a KAPRA run on the log records
+        rows (record i of store is row rows[i]). Returns the rows of the
+        records left in no group.
+        """
+        groups = p_groups.groups
+        p_offset, k_offset = len(self.p_level), self.n_groups
+        first = np.array([g['members'][0] for g in groups], dtype=np.int64)
+        p_level = np.array([g['level'] for g in groups], dtype=np.int16)
+        p_code = np.asarray(store.code[first]).copy() if len(groups) else np.zeros((0, self.N_SEGMENTS), np.uint8)
+        p_code[p_level == 0] = PATTERN_WILDCARD
+        p_group_of = np.full(len(store), BUFFERED, dtype=np.int64)
+        for i, g in enumerate(groups):
+            p_group_of[g['members']] = p_offset + i
+        n = len(self.time_cols)
+        self.p_level = np.concatenate([self.p_level, p_level])
+        self.p_code = np.concatenate([self.p_code, p_code])
+        self.p_count = np.concatenate([self.p_count, [len(g['members']) for g in groups]]).astype(np.int64)
+        self.p_group = np.concatenate([self.p_group, np.asarray(store.group[first]) + k_offset])
+        self.k_lower = np.concatenate([self.k_lower, np.array([g['envelope'].lower for g in current_groups]).reshape(-1, n)])
+        self.k_upper = np.concatenate([self.k_upper, np.array([g['envelope'].upper for g in current_groups]).reshape(-1, n)])
+        self.k_count = np.concatenate([self.k_count, [g['envelope'].count for g in current_groups]]).astype(np.int64)
+        self.k_head = np.concatenate([self.k_head, np.full(len(current_groups), -1, dtype=np.int64)])
+        self.k_tail = np.concatenate([self.k_tail, np.full(len(current_groups), -1, dtype=np.int64)])
+        self._index_p_groups(np.arange(p_offset, len(self.p_level)))
+
+        grouped = np.flatnonzero(np.asarray(store.group) >= 0)
+        self.log.write('p_group', rows[grouped], p_group_of[grouped])
+        self.log.write('level', rows[grouped], store.level[grouped])
+        self.log.write('code', rows[grouped], store.code[grouped])
+        # liste dei K-group nell'ordine di release
+        for j, g in enumerate(current_groups):
+            self._link(k_offset + j, rows[g['members']])
+        return rows[np.asarray(store.group) == -1]
+
+    def _level_codes(self, series, instrumentation):
+        # codici SAX dei record a ogni livello della scala di Phase 1 & 2 (come build_p_groups)
+        sax_cache = SaxCodeCache(series, n_segments=self.N_SEGMENTS)
+        if self.isax:
+            finest = sax_cache.codes(self.SAX_LEVEL)
+            codes = [isax_demote(finest, self.SAX_LEVEL, level) for level in self.levels]
+        else:
+            codes = [sax_cache.codes(level) for level in self.levels]
+        instrumentation.count('sax_encodings', sax_cache.encoded)
+        return codes
+
+    def _assign(self, series, max_growth, instrumentation):
+        """
+        Place the records one by one (in batch order). Returns the P-subgroup
+        of each record (-1: no matching pattern, or growth above max_growth)
+        and the K-groups whose envelope changed.
+        """
+        assigned = np.full(len(series), -1, dtype=np.int64)
+        if len(series) == 0:
+            return assigned, []
+        codes = self._level_codes(series, instrumentation)
+        keys = [pack_sax_codes(c, level).tolist() for c, level in zip(codes, self.levels)]
+        k_vl = {}
+        changed = set()
+        for i, x in enumerate(np.asarray(series, dtype=float)):
+            # candidati dal livello più fine: a parità di crescita vince il pattern più preciso
+            candidates = [g for level, level_keys in zip(self.levels, keys)
+                          for g in self._index.get((level, level_keys[i]), ())]
+            if not candidates:
+                continue
+            kg = self.p_group[candidates]
+            lowers = np.minimum(self.k_lower[kg], x)
+            uppers = np.maximum(self.k_upper[kg], x)
+            for g in kg.tolist():
+                if g not in k_vl:
+                    k_vl[g] = _vl(self.k_lower[g], self.k_upper[g])
+            growth = _vl(lowers, uppers) - np.array([k_vl[g] for g in kg.tolist()])
+            best = int(np.argmin(growth))
+            if max_growth is not None and growth[best] > max_growth:
+                continue
+            g, p = int(kg[best]), candidates[best]
+            if (lowers[best] != self.k_lower[g]).any() or (uppers[best] != self.k_upper[g]).any():
+                changed.add(g)
+            self.k_lower[g], self.k_upper[g] = lowers[best], uppers[best]
+            k_vl[g] += growth[best]
+            self.k_count[g] += 1
+            self.p_count[p] += 1
+            assigned[i] = p
+        return assigned, sorted(changed)
+
+    def _flush(self, instrumentation):
+        """
+        Run KAPRA on the buffer once it holds K records; the new groups are
+        added to the state. Returns False if no valid group could be formed.
+        """
+        if len(self.buffer) < self.K:
+            return False
+        with instrumentation.span('flush', records=len(self.buffer)):
+            store = self._store(self.buffer)
+            p_groups = build_p_groups(store, self.P, self.SAX_LEVEL, self.N_SEGMENTS, self.isax, verbose=False,
+                                      instrumentation=instrumentation)
+            if sum(len(g['members']) for g in p_groups.groups) < self.K:
+                return False
+            groups = form_k_groups(store, p_groups, self.K, verbose=False, instrumentation=instrumentation)
+        self.buffer = self._add_groups(store, p_groups, groups, self.buffer)
+        return True
+
+    def append(self, frame, max_growth=None, verbose=True, instrumentation=None):
+        """
+        Anonymize a batch of new records (a DataFrame with the time columns and
+        the attribute columns of the state; IDs are integers, and records
+        without an ID column are numbered after the ones received so far)
+        against the current release.
+
+        Every record that matches the pattern of a P-subgroup joins the one
+        whose K-group envelope VL grows the least (ties: the finer pattern,
+        then the older group); with max_growth, records that would grow a VL
+        by more than that are buffered instead. Records that fit nowhere wait
+        in the buffer until enough of them form new (k, P)-groups.
+
+        Returns (release, report): release holds the records published by this
+        append (the placed ones and those released from the buffer) with the
+        current envelopes of their groups; report lists the GroupIDs (group
+        index + 1) of the release groups ('release_groups'), of the existing
+        groups whose published envelope changed ('changed_groups') and of the
+        new groups ('new_groups').
+        """
+        instrumentation = instrumentation or NULL_INSTRUMENTATION
+        time_cols = select_time_columns(frame.columns, self.time_cols)
+        missing = [c for c in self.attribute_columns if c not in frame.columns]
+        if missing:
+            raise ValueError(f"Attribute columns not in the batch: {missing}")
+        series = np.asarray(frame[time_cols].values, dtype=float)
+        ids = (_record_ids(frame[RECORD_ID].to_numpy()) if RECORD_ID in frame.columns
+               else self.n_records + np.arange(1, len(frame) + 1))
+        n_groups = self.n_groups
+
+        with instrumentation.span('assign', records=len(frame)):
+            assigned, changed = self._assign(series, max_growth, instrumentation)
+        placed = np.flatnonzero(assigned >= 0)
+
+        rows = self._append_records(series, ids, {col: frame[col].to_numpy() for col in self.attribute_columns})
+        self.n_records += len(frame)
+        # record piazzati: pattern/level del loro P-subgroup, in coda alla lista del loro K-group
+        p = assigned[placed]
+        self.log.write('p_group', rows[placed], p)
+        self.log.write('level', rows[placed], self.p_level[p])
+        self.log.write('code', rows[placed], self.p_code[p])
+        record_group = self.p_group[p]
+        order = np.argsort(record_group, kind='stable')
+        group_ids, starts = np.unique(record_group[order], return_index=True)
+        members = dict(zip(group_ids.tolist(), np.split(rows[placed][order], starts[1:]))) if len(placed) else {}
+        for k, group_rows in members.items():
+            self._link(k, group_rows)
+        self.buffer = np.concatenate([self.buffer, rows[assigned < 0]])
+        instrumentation.count('records_buffered', len(frame) - len(placed))
+        self._flush(instrumentation)
+        for k in range(n_groups, self.n_groups):
+            members[k] = self._members(k)
+
+        release, group_ids = self._release(members)
+        report = {
+            'records': len(frame),
+            'placed': len(placed),
+            'released': len(release),
+            'buffered': len(self.buffer),
+            'changed_groups': [g + 1 for g in changed],
+            'new_groups': list(range(n_groups + 1, self.n_groups + 1)),
+            'release_groups': group_ids,
+        }
+        if verbose:
+            print(f"Appended {len(frame)} records: {len(placed)} placed in existing groups, "
+                  f"{len(release) - len(placed)} released from the buffer, {len(self.buffer)} buffered")
+            print(f"Groups with a changed envelope: {len(changed)}, new groups: {len(report['new_groups'])}")
+        return release, report
+
+    def _release(self, members):
+        """
+        Release of the given K-groups (members: K-group -> log rows to
+        publish) with their current envelopes, and its GroupIDs.
+        """
+        group_ids = np.array(sorted(members), dtype=np.int64)
+        rows = (np.concatenate([members[k] for k in group_ids.tolist()]) if len(group_ids)
+                else np.zeros(0, dtype=np.int64))
+        store = self._store(rows)
+        store.level[:] = self.log['level'][rows]
+        store.code[:] = self.log['code'][rows]
+        ends = np.cumsum([len(members[k]) for k in group_ids.tolist()], dtype=np.int64)
+        local = [np.arange(end - len(members[k]), end) for k, end in zip(group_ids.tolist(), ends.tolist())]
+        return Release(store, local, self.k_lower[group_ids], self.k_upper[group_ids]), (group_ids + 1).tolist()
+
+    def release(self):
+        """Release of every record, as it stands after the appends and retractions; returns (release, GroupIDs)."""
+        return self._release({k: self._members(k) for k in np.flatnonzero(self.k_count > 0).tolist()})
+
+    def _group_members(self, members, k):
+        # record del K-group k, letti dalla sua lista una volta sola per operazione
+        if k not in members:
+            members[k] = self._members(k)
+        return members[k]
+
+    def _merge_k_groups(self, undersized, members, before):
+        """
+        Phase 3 on the undersized K-groups only: the smallest one (ties: the
+        oldest) is merged with the live group giving the lowest merged VL, the
+        larger of the two keeps its GroupID (the partner on ties) and the
+        list of the other is spliced onto its own. The bounds of a kept group
+        not yet in before are recorded there before they widen. Returns the
+        (absorbed, kept) merges.
+        """
+        heap = [(int(self.k_count[g]), int(g)) for g in undersized]
+        heapq.heapify(heap)
+        merges = []
+        while heap:
+            count, g = heapq.heappop(heap)
+            if count != self.k_count[g] or not 0 < count < self.K:
+                continue
+            cols = np.flatnonzero(self.k_count > 0)
+            cols = cols[cols != g]
+            if len(cols) == 0:
+                break
+            partner = int(cols[np.argmin(merge_cost_matrix(self.k_lower, self.k_upper, rows=[g], cols=cols)[0])])
+            kept, absorbed = (partner, g) if self.k_count[partner] >= self.k_count[g] else (g, partner)
+            # envelope pubblicato del gruppo che assorbe, prima che si allarghi
+            before.setdefault(kept, (self.k_lower[kept].copy(), self.k_upper[kept].copy()))
+            self.k_lower[kept] = np.minimum(self.k_lower[kept], self.k_lower[absorbed])
+            self.k_upper[kept] = np.maximum(self.k_upper[kept], self.k_upper[absorbed])
+            self.k_count[kept] += self.k_count[absorbed]
+            self.k_count[absorbed] = 0
+            absorbed_rows = self._group_members(members, absorbed)
+            self.p_group[np.unique(self.log['p_group'][absorbed_rows])] = kept
+            members[kept] = np.concatenate([self._group_members(members, kept), absorbed_rows])
+            members[absorbed] = absorbed_rows[:0]
+            self.log.write('next', [self.k_tail[kept]], self.k_head[absorbed])
+            self.k_tail[kept] = self.k_tail[absorbed]
+            self.k_head[absorbed] = self.k_tail[absorbed] = -1
+            merges.append((absorbed, kept))
+            if self.k_count[kept] < self.K:
+                heapq.heappush(heap, (int(self.k_count[kept]), kept))
+        return merges
+
+    def _merge_p_subgroups(self, undersized, members):
+        """
+        Merge every P-subgroup left with fewer than P records into the
+        P-subgroup of its K-group giving the lowest merged VL. The larger of
+        the two keeps its pattern (the partner on ties; '*' never prevails over
+        a pattern) and the records of the other take it. The K-group envelopes
+        do not change. Returns the K-groups whose patterns changed.
+        """
+        touched = set()
+        pending = sorted(int(g) for g in undersized)
+        while pending:
+            g = pending.pop(0)
+            if not 0 < self.p_count[g] < self.P:
+                continue
+            k = int(self.p_group[g])
+            rows = self._group_members(members, k)
+            subgroup = np.asarray(self.log['p_group'][rows])
+            siblings = np.unique(subgroup)
+            siblings = siblings[siblings != g]
+            if len(siblings) == 0:
+                continue
+            candidates = np.r_[siblings, g]
+            order = np.argsort(candidates)
+            local = order[np.searchsorted(candidates[order], subgroup)]
+            envelopes = group_envelopes(self.log['series'][rows], local, len(candidates))
+            lowers = np.array([e.lower for e in envelopes])
+            uppers = np.array([e.upper for e in envelopes])
+            partner = int(siblings[np.argmin(merge_cost_matrix(lowers, uppers, rows=[len(siblings)],
+                                                               cols=np.arange(len(siblings)))[0])])
+            prevails = self.p_count[partner] >= self.p_count[g]
+            if self.p_level[partner] == 0 or self.p_level[g] == 0:
+                prevails = self.p_level[partner] != 0
+            kept, absorbed = (partner, g) if prevails else (g, partner)
+            self._unindex_p_group(absorbed)
+            moved = rows[subgroup == absorbed]
+            if self.p_level[kept] != 0:
+                self.log.write('level', moved, self.p_level[kept])
+                self.log.write('code', moved, self.p_code[kept])
+            self.log.write('p_group', moved, kept)
+            self.p_count[kept] += self.p_count[absorbed]
+            self.p_count[absorbed] = 0
+            touched.add(k)
+            if self.p_count[kept] < self.P:
+                pending.append(int(kept))
+        return touched
+
+    def retract(self, ids, verbose=True, instrumentation=None):
+        """
+        Remove the records with the given IDs (released or still buffered).
+
+        Only the K-groups that lost records are recomputed: their envelopes
+        are rebuilt from the remaining members; a group left with fewer than
+        K records is merged as in Phase 3 (see _merge_k_groups) and a
+        P-subgroup left with fewer than P records is merged into a sibling
+        (see _merge_p_subgroups). Groups left empty are retired (count 0).
+
+        Returns (release, report): release holds every remaining record of
+        the affected groups, to replace their published rows; report lists
+        the GroupIDs of the release groups ('release_groups'), of the groups
+        whose envelope changed ('changed_groups'), of the retired groups
+        ('retired_groups') and the (retired, kept) GroupID merges ('merges').
+        """
+        instrumentation = instrumentation or NULL_INSTRUMENTATION
+        ids = list(ids)
+        with instrumentation.span('retract', records=len(ids)):
+            rows = self.ids.lookup(_record_ids(ids) if ids else [])
+            p = np.asarray(self.log['p_group'][rows])
+            in_buffer = rows[p == BUFFERED]
+            self.buffer = self.buffer[~np.isin(self.buffer, in_buffer)]
+            hit, lost_p = rows[p >= 0], p[p >= 0]
+            self.log.write('p_group', rows[p != RETRACTED], RETRACTED)
+            np.subtract.at(self.p_count, lost_p, 1)
+            np.subtract.at(self.k_count, self.p_group[lost_p], 1)
+            touched_p = np.unique(lost_p)
+            touched_k = np.unique(self.p_group[touched_p])
+            for g in touched_p[self.p_count[touched_p] == 0]:
+                self._unindex_p_group(g)
+
+            # liste ed envelope dei K-group toccati ricostruiti dai record rimasti
+            before = {int(k): (self.k_lower[k].copy(), self.k_upper[k].copy()) for k in touched_k}
+            members = {}
+            for k in touched_k.tolist():
+                group_rows = self._members(k)
+                group_rows = group_rows[self.log['p_group'][group_rows] != RETRACTED]
+                self.k_head[k] = self.k_tail[k] = -1
+                self._link(k, group_rows)
+                members[k] = group_rows
+                if len(group_rows):
+                    series = np.asarray(self.log['series'][group_rows])
+                    self.k_lower[k], self.k_upper[k] = series.min(axis=0), series.max(axis=0)
+
+            merges = self._merge_k_groups(touched_k[(self.k_count[touched_k] > 0) & (self.k_count[touched_k] < self.K)],
+                                          members, before)
+            patterns = self._merge_p_subgroups(touched_p[(self.p_count[touched_p] > 0) & (self.p_count[touched_p] < self.P)],
+                                               members)
+
+        affected = sorted(k for k in set(before) | patterns if self.k_count[k] > 0)
+        release, group_ids = self._release({k: self._group_members(members, k) for k in affected})
+        changed = [k + 1 for k in affected if k in before and
+                   ((self.k_lower[k] != before[k][0]).any() or (self.k_upper[k] != before[k][1]).any())]
+        report = {
+            'records': len(ids),
+            'removed': len(hit),
+            'removed_from_buffer': len(in_buffer),
+            'release_groups': group_ids,
+            'changed_groups': changed,
+            'retired_groups': sorted({int(k) + 1 for k in touched_k if self.k_count[k] == 0} |
+                                     {a + 1 for a, _ in merges}),
+            'merges': [(a + 1, b + 1) for a, b in merges],
+        }
+        if verbose:
+            print(f"Retracted {len(hit)} released and {report['removed_from_buffer']} buffered records")
+            print(f"Groups republished: {len(group_ids)}, with a changed envelope: {len(changed)}, "
+                  f"retired: {len(report['retired_groups'])}")
+        return release, report
+
+    def envelope_frame(self, group_ids):
+        """Current published envelope ("[l-u]" intervals, as in a CSV release) of the given GroupIDs."""
+        idx = np.asarray(group_ids, dtype=np.int64) - 1
+        intervals = format_intervals(self.k_lower[idx], self.k_upper[idx]).reshape(len(idx), len(self.time_cols))
+        frame = pd.DataFrame(intervals, columns=self.time_cols)
+        frame.insert(0, 'GroupID', idx + 1)
+        return frame
+
+def start_incremental(K=DEFAULT_K, P=DEFAULT_P, SAX_LEVEL=DEFAULT_SAX_LEVEL, N_SEGMENTS=DEFAULT_N_SEGMENTS, isax=False,
+                      partner_top_m=None, verbose=True, data_path=None, output_path=None, state_path=None,
+                      time_cols=None, instrumentation=None):
+    """
+    Full KAPRA run on the history (data_path, default docs/data/dataset_raw.csv)
+    that also persists its state for append_incremental and
+    retract_incremental. The release written to output_path (default
+    docs/data/kapra_anonymized.csv) is the one of run_kapra_anonymization;
+    the state goes to the directory state_path (default docs/data/kapra_state).
+    """
+    start_time = time.time()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    if data_path is None:
+        data_path = os.path.join(current_dir, '../docs/data/dataset_raw.csv')
+    if output_path is None:
+        output_path = os.path.join(current_dir, '../docs/data/kapra_anonymized.csv')
+    if state_path is None:
+        state_path = os.path.join(current_dir, '../docs/data/kapra_state')
+
+    with instrumentation.span('load', path=data_path):
+        store = RecordStore.from_csv(data_path, time_cols=time_cols, n_segments=N_SEGMENTS)
+    with instrumentation.span('phase1_2', P=P, SAX_LEVEL=SAX_LEVEL, records=len(store)):
+        p_groups = build_p_groups(store, P, SAX_LEVEL, N_SEGMENTS, isax, verbose, instrumentation=instrumentation)
+    current_groups = form_k_groups(store, p_groups, K, partner_top_m, verbose, instrumentation)
+    with instrumentation.span('metrics', K=K):
+        release, avg_vl_groups, avg_pl = k_group_release(store, current_groups)
+    with instrumentation.span('output', K=K, path=output_path):
+        release.write(output_path, ['Performance_SD'])
+        IncrementalKapra.from_groups(store, p_groups, current_groups, state_path, K, P, SAX_LEVEL, N_SEGMENTS,
+                                     isax).save()
+    if verbose:
+        print(f"Release written to {output_path}, incremental state to {state_path}")
+    return {'K': K, 'P': P, 'SAX_LEVEL': SAX_LEVEL, 'Time': time.time() - start_time,
+            'VL': avg_vl_groups, 'PL': avg_pl}
+
+def append_incremental(data_path, state_path=None, output_path=None, envelopes_path=None, max_growth=None,
+                       verbose=True, instrumentation=None):
+    """
+    Anonymize the new records of data_path (a CSV batch with the schema of the
+    history) against the state in the directory state_path (default
+    docs/data/kapra_state, updated in place).
+
+    Writes the rows published by this batch to output_path (default
+    docs/data/kapra_anonymized_append.csv; GroupIDs continue those of the
+    release) and the current envelopes of the changed groups to
+    envelopes_path (default docs/data/kapra_changed_envelopes.csv, columns
+    GroupID and the "[l-u]" intervals): previously published rows of those
+    groups must take the new intervals. Returns the report of
+    IncrementalKapra.append plus the elapsed 'Time'.
+    """
+    start_time = time.time()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    if state_path is None:
+        state_path = os.path.join(current_dir, '../docs/data/kapra_state')
+    if output_path is None:
+        output_path = os.path.join(current_dir, '../docs/data/kapra_anonymized_append.csv')
+    if envelopes_path is None:
+        envelopes_path = os.path.join(current_dir, '../docs/data/kapra_changed_envelopes.csv')
+
+    with instrumentation.span('load', path=data_path):
+        state = IncrementalKapra.load(state_path)
+        batch = pd.read_csv(data_path)
+    release, report = state.append(batch, max_growth, verbose, instrumentation)
+    with instrumentation.span('output', path=output_path):
+        release.write(output_path, ['Performance_SD'], group_ids=report['release_groups'])
+        state.envelope_frame(report['changed_groups']).to_csv(envelopes_path, index=False)
+        state.save()
+    report['Time'] = time.time() - start_time
+    return report
+
+def retract_incremental(ids, state_path=None, output_path=None, envelopes_path=None, verbose=True,
+                        instrumentation=None):
+    """
+    Remove the records with the given IDs from the state in the directory
+    state_path (default docs/data/kapra_state, updated in place).
+
+    Writes every remaining record of the affected groups to output_path
+    (default docs/data/kapra_anonymized_retract.csv): their previously
+    published rows, and those of the retired groups in the report, are
+    replaced by these. The current envelopes of the changed groups go to
+    envelopes_path (default docs/data/kapra_changed_envelopes.csv). Returns
+    the report of IncrementalKapra.retract plus the elapsed 'Time'.
+    """
+    start_time = time.time()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    if state_path is None:
+        state_path = os.path.join(current_dir, '../docs/data/kapra_state')
+    if output_path is None:
+        output_path = os.path.join(current_dir, '../docs/data/kapra_anonymized_retract.csv')
+    if envelopes_path is None:
+        envelopes_path = os.path.join(current_dir, '../docs/data/kapra_changed_envelopes.csv')
+
+    with instrumentation.span('load', path=state_path):
+        state = IncrementalKapra.load(state_path)
+    release, report = state.retract(ids, verbose, instrumentation)
+    with instrumentation.span('output', path=output_path):
+        release.write(output_path, ['Performance_SD'], group_ids=report['release_groups'])
+        state.envelope_frame(report['changed_groups']).to_csv(envelopes_path, index=False)
+        state.save()
+    report['Time'] = time.time() - start_time
+    return report
@@ -66,3 +66,139 @@ def calculate_envelope_and_vl(cluster):
         vl = 0.0
 
     return lower_bound, upper_bound, vl
+
+
+# Memory budget (bytes) for the (rows, G, T) intermediates of merge_cost_matrix
+MERGE_COST_MAX_BYTES = 64 * 1024 * 1024
+
+def merge_cost_matrix(lowers, uppers, rows=None, cols=None, max_bytes=MERGE_COST_MAX_BYTES):
+    """
+    VL of every pairwise merge between group envelopes.
+
+    Args:
+        lowers (np.array): (G, n_timestamps) stacked lower bounds.
+        uppers (np.array): (G, n_timestamps) stacked upper bounds.
+        rows (array-like, optional): Groups to score (default: all groups).
+        cols (array-like, optional): Groups to score them against
+                                     (default: all groups).
+        max_bytes (int): Upper bound for the total size of the broadcast
+                         (chunk, G, n_timestamps) intermediates (two are
+                         alive at once); rows are processed in chunks that
+                         fit it.
+
+    Returns:
+        np.array: (len(rows), len(cols)) matrix, cell (i, j) = VL of rows[i]
+                  merged with cols[j] (a group merged with itself gives its own VL).
+    """
+    lowers = np.asarray(lowers, dtype=float)
+    uppers = np.asarray(uppers, dtype=float)
+    n_groups, n = lowers.shape
+    rows = np.arange(n_groups) if rows is None else np.atleast_1d(rows)
+    if cols is not None:
+        col_lowers, col_uppers = lowers[cols], uppers[cols]
+    else:
+        col_lowers, col_uppers = lowers, uppers
+    n_cols = len(col_lowers)
+    costs = np.zeros((len(rows), n_cols))
+    if n == 0 or n_cols == 0 or len(rows) == 0:
+        return costs
+
+    # due blocchi (chunk, G, T), allocati una volta e riusati: merged_lower e width
+    chunk = min(len(rows), max(1, max_bytes // (2 * n_cols * n * lowers.itemsize)))
+    merged_lower_buf = np.empty((chunk, n_cols, n))
+    width_buf = np.empty((chunk, n_cols, n))
+    for start in range(0, len(rows), chunk):
+        block = rows[start:start + chunk]
+        merged_lower = np.minimum(lowers[block][:, None, :], col_lowers[None, :, :], out=merged_lower_buf[:len(block)])
+        width = np.maximum(uppers[block][:, None, :], col_uppers[None, :, :], out=width_buf[:len(block)])
+        width -= merged_lower
+        width **= 2
+        costs[start:start + chunk] = np.sqrt(np.sum(width, axis=2) / n)
+    return costs
+
+class Envelope:
+    """
+    Mergeable summary of a cluster: per-timestamp lower/upper bounds and the
+    number of series. Merging two envelopes only needs their bounds, so group
+    merges and merge-cost previews cost O(n_timestamps) instead of O(records).
+    """
+    def __init__(self, lower, upper, count):
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.count = count
+
+    @classmethod
+    def from_cluster(cls, cluster):
+        """Build the envelope of a cluster, as calculate_envelope_and_vl."""
+        lower, upper, _ = calculate_envelope_and_vl(cluster)
+        count = 1 if np.ndim(cluster) == 1 else len(cluster)
+        return cls(lower, upper, count)
+
+    @staticmethod
+    def _vl(lower, upper):
+        n = len(lower)
+        if n == 0:
+            return 0.0
+        return np.sqrt(np.sum((upper - lower) ** 2) / n)
+
+    @property
+    def vl(self):
+        """Instant Value Loss of the envelope."""
+        return self._vl(self.lower, self.upper)
+
+    def merged(self, other):
+        """New envelope covering both clusters."""
+        return Envelope(np.minimum(self.lower, other.lower),
+                        np.maximum(self.upper, other.upper),
+                        self.count + other.count)
+
+    def merged_vl(self, other):
+        """VL the two clusters would have once merged, without building the merge."""
+        return self._vl(np.minimum(self.lower, other.lower),
+                        np.maximum(self.upper, other.upper))
+
+    def union(self, other):
+        """Merge other into this envelope in place."""
+        np.minimum(self.lower, other.lower, out=self.lower)
+        np.maximum(self.upper, other.upper, out=self.upper)
+        self.count += other.count
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return f"Envelope(count={self.count}, vl={self.vl:.4f})"
+
+def group_envelopes(series, groups, n_groups, chunk_rows=100_000):
+    """
+    Envelopes of many groups in one streaming pass over the series.
+
+    Args:
+        series (np.array): (n_records, n_timestamps) matrix, also a np.memmap;
+                           it is read chunk_rows rows at a time.
+        groups (np.array): Group of every record (-1: in no group).
+        n_groups (int): Number of groups.
+
+    Returns:
+        list: One Envelope per group (empty groups get infinite bounds).
+    """
+    n = series.shape[1]
+    lowers = np.full((n_groups, n), np.inf)
+    uppers = np.full((n_groups, n), -np.inf)
+    counts = np.zeros(n_groups, dtype=np.int64)
+    for start in range(0, series.shape[0], chunk_rows):
+        gid = np.asarray(groups[start:start + chunk_rows])
+        rows = np.flatnonzero(gid >= 0)
+        if len(rows) == 0:
+            continue
+        # ordino il blocco per gruppo e riduco ogni tratto contiguo
+        rows = rows[np.argsort(gid[rows], kind='stable')]
+        gid = gid[rows]
+        block = np.asarray(series[start:start + chunk_rows], dtype=float)[rows]
+        starts = np.flatnonzero(np.r_[True, gid[1:] != gid[:-1]])
+        ids = gid[starts]
+        lowers[ids] = np.minimum(lowers[ids], np.minimum.reduceat(block, starts, axis=0))
+        uppers[ids] = np.maximum(uppers[ids], np.maximum.reduceat(block, starts, axis=0))
+        counts[ids] += np.diff(np.r_[starts, len(rows)])
+    return [Envelope(lowers[g], uppers[g], int(counts[g])) for g in range(n_groups)]
@@ -3,6 +3,7 @@ import numpy as np
 import sys
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Recupero la cartella dove si trova questo file
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -11,13 +12,19 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
     sys.path.append(current_dir)
 
-from sax_utils import ts_to_sax, calculate_pattern_loss
-from k_anon import makeDatasetKAnon
-from kapra_utils import calculate_envelope_and_vl
+from sax_utils import ts_to_sax, calculate_pattern_loss, pattern_loss_batch, SaxCodeCache, SAX_BREAKPOINTS, group_sax_codes, sax_codes_to_strings
+from k_anon import partition_indices
+from record_store import RecordStore, select_time_columns
+from release import Release
+from parallel_utils import share_array, attach_array, balanced_batches
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+
+# Lotti di K-gruppi per processo nella Phase 2 parallela
+PARALLEL_BATCHES_PER_JOB = 4
 
 class Node:
     def __init__(self, data, level, pattern, size, label="intermediate"):
-        self.data = data  # List of records (dicts)
+        self.data = data  # Record indices into the RecordStore
         self.level = level # SAX Word Length (matches 'max-level' concept)
         self.pattern = pattern # SAX String
         self.size = size
@@ -36,13 +43,14 @@ def get_sax_pattern(series, level):
         return "" # Root level
     return ts_to_sax(series, level)
 
-def naive_node_splitting(node, P, max_level, time_cols):
+def naive_node_splitting(node, P, max_level, sax_cache, instrumentation=NULL_INSTRUMENTATION):
     """
     Algoritmo di divisione ricorsiva dei nodi:
-    node = nodo da dividere
+    node = nodo da dividere (node.data: indici dei record)
     P = parametro di privacy
     max_level = livello massimo di SAX
-    time_cols = colonne temporali
+    sax_cache = SaxCodeCache con i codici SAX precalcolati del dataset
+    instrumentation = riceve il contatore sax_encodings (righe codificate dalla cache, non le letture)
     """
     # se il chiamante ha contrassegnato questo come good-leaf (es. child_merge), fermati.
     if node.label == "good-leaf":
@@ -68,15 +76,15 @@ def naive_node_splitting(node, P, max_level, time_cols):
         # loop per aumentare il livello di dettaglio SAX
         while current_level < max_level:
             next_level = current_level + 1
-            patterns = []
-            for row in node.data: # Per ogni record nel nodo
-                ts = [row[c] for c in time_cols] # Prendi la serie temporale [val1, val2, ..., valn]
-                patterns.append(get_sax_pattern(ts, next_level)) # ricalcola il pattern SAX con il livello aumentato
+            # codici SAX di ogni record del nodo al livello aumentato
+            encoded = sax_cache.encoded
+            codes = sax_cache.codes(next_level)[node.data]
+            instrumentation.count('sax_encodings', sax_cache.encoded - encoded)
             
             # Se tutti i pattern sono identici aumento di un livello e aggiorno il pattern e riciclo
-            if len(set(patterns)) == 1:
+            if (codes == codes[0]).all():
                 current_level = next_level
-                current_pattern = patterns[0]
+                current_pattern = sax_cache.words(next_level)[node.data[0]]
             else:
                 # altrimenti rimangono a quello precedente
                 break
@@ -91,22 +99,21 @@ def naive_node_splitting(node, P, max_level, time_cols):
     # Eseguo una scissione tentativa incrementando il livello
     next_level = node.level + 1
     
-    # Raggruppo i record per pattern SAX al livello successivo
-    groups = {}
-    for row in node.data: # per ogni record
-        ts = [row[c] for c in time_cols] # prendi la serie temporale
-        pat = get_sax_pattern(ts, next_level) # ricalcola il pattern SAX con il livello aumentato
-        if pat not in groups: # se il gruppo con quel pattern non esiste lo creo 
-            groups[pat] = []
-        groups[pat].append(row) # aggiungi il record al gruppo
-
+    # Raggruppo i record per pattern SAX al livello successivo:
+    # parole SAX impacchettate in chiavi intere e raggruppate con un solo ordinamento
+    encoded = sax_cache.encoded
+    codes = sax_cache.codes(next_level)[node.data] # codici SAX al livello aumentato
+    instrumentation.count('sax_encodings', sax_cache.encoded - encoded)
+    _, order, starts, sizes = group_sax_codes(codes, next_level)
+    members = node.data[order] # record ordinati per gruppo
+    words = sax_codes_to_strings(codes[order[starts]]) # un pattern per gruppo
     
     valid_children = [] # Size >= P
     small_children = [] # Size < P (TB-nodes)
     
-    for pat, rows in groups.items(): # per ogni GRUPPO
-        child = Node(rows, next_level, pat, len(rows)) # crea un nodo figlio per ogni gruppo
-        if len(rows) >= P: # se la dimensione del gruppo >= P
+    for pat, start, size in zip(words, starts, sizes): # per ogni GRUPPO
+        child = Node(members[start:start + size], next_level, pat, int(size)) # crea un nodo figlio per ogni gruppo
+        if size >= P: # se la dimensione del gruppo >= P
             valid_children.append(child) # lo aggiungo ai figli validi
         else:
             small_children.append(child) # altrimenti lo aggiungo ai figli piccoli
@@ -115,9 +122,7 @@ def naive_node_splitting(node, P, max_level, time_cols):
     
     if total_small_size >= P: # se la somma delle dimensioni dei figli piccoli >= P
         # Crea un nuovo nodo unificandoli (child_merge)
-        merged_data = []
-        for c in small_children:
-            merged_data.extend(c.data)
+        merged_data = np.concatenate([c.data for c in small_children])
         
         # Imposta livello di child_merge = N.level (livello del padre)
         child_merge = Node(merged_data, node.level, node.pattern, len(merged_data), label="intermediate")
@@ -134,7 +139,7 @@ def naive_node_splitting(node, P, max_level, time_cols):
         node.children = valid_children # li aggiungiamo ai figli del nodo
         # 15. Invocazione ricorsiva su tutti i figli validi generati
         for child in node.children:
-            naive_node_splitting(child, P, max_level, time_cols)
+            naive_node_splitting(child, P, max_level, sax_cache, instrumentation)
     else: # Altrimenti (nessun figlio valido generato)
         node.children = [] # ritrattiamo la divisione rendendo il padre una foglia
         node.label = "good-leaf"
@@ -155,163 +160,243 @@ def calculate_distance(ts_data, leaf_pattern, level):
     # Assuming leaf.pattern represents the centroid reconstruction
     try:
         return calculate_pattern_loss(ts_data, leaf_pattern, level)
-    except:
+    except ValueError: # livello senza breakpoints SAX
         return float('inf')
 
-def run_naive_anonymization(K=8, P=2, MAX_LEVEL=10, verbose=True):
+def calculate_distances(ts_data, leaves):
+    """
+    Distanza (Pattern Loss) tra una serie e i pattern di tutte le foglie in un solo batch.
+    Le foglie con un livello senza breakpoints SAX hanno distanza infinita, come in calculate_distance.
+    """
+    dists = np.full(len(leaves), float('inf'))
+    valid = [i for i, l in enumerate(leaves) if l.level in SAX_BREAKPOINTS]
+    if valid:
+        dists[valid] = pattern_loss_batch(ts_data,
+                                          [leaves[i].pattern for i in valid],
+                                          [leaves[i].level for i in valid])
+    return dists
+
+def split_k_group(group_id, group_data, series, sax_cache, P, max_level, instrumentation=NULL_INSTRUMENTATION):
+    """
+    Phase 2 su un K-gruppo: divisione in nodi e riassegnazione delle bad leaf.
+    group_data: indici dei record del gruppo in series / sax_cache.
+    Restituisce le good leaf del gruppo (con group_id).
+    instrumentation riceve i contatori sax_encodings, pl_evaluations e records_suppressed.
+    """
+    initial_level = 1 # inizio a livello 1
+    
+    # calcolo il pattern iniziale dal primo record (rappresentante)
+    # tutti i record al livello 1 hanno stesso pattern "aaaa"
+    first_ts = series[group_data[0]] # prendo la prima serie temporale del gruppo
+    initial_pattern = get_sax_pattern(first_ts, initial_level) # calcolo il pattern iniziale 
+    
+    root = Node(group_data, level=initial_level, pattern=initial_pattern, size=len(group_data)) # creo il nodo radice
+    
+    naive_node_splitting(root, P, max_level, sax_cache, instrumentation) # divido i nodi
+    
+    leaves = collect_leaves(root) # raccolgo le foglie
+    for l in leaves:
+        l.group_id = group_id
+    
+    # divido le foglie in good e bad
+    good_leaves = [l for l in leaves if l.label == "good-leaf"]
+    bad_leaves = [l for l in leaves if l.label == "bad-leaf"]
+    
+    # se ci sono foglie bad
+    if bad_leaves:
+        if not good_leaves:
+             # se tutte le foglie sono bad, le unisco in una sola good leaf
+             merged_all = Node(np.concatenate([l.data for l in bad_leaves]), 2, "*", 0, "good-leaf")
+             merged_all.size = len(merged_all.data)
+             merged_all.group_id = group_id
+             good_leaves = [merged_all]
+        else:
+            for bl in bad_leaves:
+                # trovo la good leaf più vicina alla bad leaf
+                best_target = None
+                
+                # calcolo la serie temporale media della bad leaf
+                bl_mean_ts = np.mean(series[bl.data], axis=0)
+                
+                # Distanza tra la serie media della BadLeaf e il pattern di ogni GoodLeaf
+                # La ricostruzione del pattern della GoodLeaf dipende dal suo livello.
+                # pattern proporzionali danno la stessa PL a meno di arrotondamenti:
+                # a parità di distanza vince la prima good leaf
+                dists = calculate_distances(bl_mean_ts, good_leaves)
+                instrumentation.count('pl_evaluations', len(good_leaves))
+                best_idx = int(np.argmax(dists <= dists.min() + 1e-9))
+                if dists[best_idx] < float('inf'):
+                    best_target = good_leaves[best_idx]
+                
+                if best_target:
+                    best_target.data = np.concatenate([best_target.data, bl.data])
+                    best_target.size += bl.size
+                    # NON aggiornare pattern/livello. Vengono semplicemente assorbiti.
+                else:
+                    # nessuna good leaf confrontabile: i record escono dalla release
+                    instrumentation.count('records_suppressed', bl.size)
+    
+    return good_leaves
+
+# Array condivisi del processo worker (impostati da _init_worker)
+_worker_arrays = {}
+
+def _init_worker(series_spec, paa_spec):
+    """Inizializzazione dei worker: aggancio serie e PAA in memoria condivisa (senza copie)."""
+    for key, spec in (('series', series_spec), ('paa', paa_spec)):
+        _worker_arrays[key] = attach_array(spec)
+
+def _split_k_group_batch(batch, P, max_level, count=False):
+    """
+    Phase 2 su un lotto di K-gruppi [(group_id, group_data)] in un worker.
+    Ogni gruppo usa una SaxCodeCache locale sulle sue righe del PAA condiviso:
+    indici locali durante la divisione, riportati a indici globali alla fine.
+    Con count=True restituisce anche i contatori del lotto.
+    """
+    _, series = _worker_arrays['series']
+    _, paa = _worker_arrays['paa']
+    instrumentation = Instrumentation() if count else NULL_INSTRUMENTATION
+    results = []
+    for group_id, group_data in batch:
+        local_cache = SaxCodeCache.from_paa(paa[group_data])
+        leaves = split_k_group(group_id, np.arange(len(group_data)), series[group_data],
+                               local_cache, P, max_level, instrumentation)
+        for leaf in leaves:
+            leaf.data = group_data[leaf.data]
+            leaf.children = []
+        results.append(leaves)
+    return results, instrumentation.counters if count else {}
+
+def split_k_groups_parallel(partitions, series, sax_cache, P, max_level, n_jobs,
+                            instrumentation=NULL_INSTRUMENTATION):
+    """
+    Phase 2 in parallelo: i K-gruppi sono indipendenti, quindi vengono
+    distribuiti a un pool di n_jobs processi (n_jobs=-1: tutti i core) in lotti
+    di dimensione totale bilanciata. Serie e PAA passano in memoria condivisa;
+    le foglie vengono riunite nell'ordine dei gruppi, quindi il risultato è
+    identico all'esecuzione seriale.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    groups = list(enumerate(partitions, start=1))
+    # più lotti che processi: i lotti grandi non restano da soli alla fine
+    batches = balanced_batches([len(g) for _, g in groups], PARALLEL_BATCHES_PER_JOB * n_jobs)
+
+    series_shm, series_spec = share_array(series)
+    paa_shm, paa_spec = share_array(sax_cache.paa)
+    leaves_by_group = [None] * len(groups)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(series_spec, paa_spec)) as pool:
+            futures = {pool.submit(_split_k_group_batch, [groups[i] for i in batch], P, max_level,
+                                   instrumentation.enabled): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                results, counters = future.result()
+                for i, leaves in zip(futures[future], results):
+                    leaves_by_group[i] = leaves
+                instrumentation.merge_counters(counters)
+    finally:
+        for shm in (series_shm, paa_shm):
+            shm.close()
+            shm.unlink()
+    return [leaf for leaves in leaves_by_group for leaf in leaves]
+
+def run_naive_anonymization(K=8, P=2, MAX_LEVEL=10, verbose=True, data_path=None, output_path=None, output_format='csv',
+                            time_cols=None, n_jobs=None, store=None, write_release=True, instrumentation=None):
+    """
+    Naive (k,P)-anonymization di data_path (default: docs/data/dataset_raw.csv).
+    Il formato della release segue l'estensione di output_path (.csv, .npz, .parquet).
+    time_cols seleziona le colonne delle serie (default H<numero>, vedi
+    record_store.select_time_columns).
+    Con n_jobs > 1 (o -1: tutti i core) la Phase 2 gira su un pool di processi,
+    a lotti di K-gruppi (vedi split_k_groups_parallel), con lo stesso risultato.
+    store: RecordStore già caricato (es. condiviso da sweep.run_sweep), al posto
+    di data_path; con write_release=False calcola solo le metriche.
+    instrumentation (instrumentation.Instrumentation, disattivata di default)
+    riceve gli span load / partition / node_splitting / metrics / output e i
+    contatori sax_encodings, pl_evaluations, envelopes, records_suppressed.
+    """
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    input_path = os.path.join(base_dir, "../docs/data/dataset_raw.csv")
-    output_path = os.path.join(base_dir, "../docs/data/naive_anonymized.csv")
+    input_path = data_path or os.path.join(base_dir, "../docs/data/dataset_raw.csv")
+    if output_path is None:
+        output_path = os.path.join(base_dir, f"../docs/data/naive_anonymized.{output_format}")
     
     if verbose:
         print(f"--- Naive (k,P)-Anonymization Algorithm (K={K}, P={P}, MAX_LEVEL={MAX_LEVEL}) ---")
     start_time = time.time()
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
     
-    # carico i dati
-    try:
-        df = pd.read_csv(input_path)
-    except FileNotFoundError:
-        print(f"Error: {input_path} not found.")
-        sys.exit(1)
-        
-    # droppo EI
-    eis = ['ID', 'Name', 'Surname']
-    df_clean = df.drop(columns=[c for c in eis if c in df.columns])
-    
-    time_cols = [c for c in df.columns if c.startswith('H')]
+    if store is None:
+        # carico i dati
+        with instrumentation.span('load', path=input_path):
+            try:
+                df = pd.read_csv(input_path)
+            except FileNotFoundError:
+                print(f"Error: {input_path} not found.")
+                sys.exit(1)
+                
+            # droppo EI
+            eis = ['ID', 'Name', 'Surname']
+            df_clean = df.drop(columns=[c for c in eis if c in df.columns])
+            
+            time_cols = select_time_columns(df.columns, time_cols)
+            
+            # store colonnare: matrice delle serie, i gruppi sono array di indici
+            store = RecordStore.from_frame(df_clean, time_cols)
+    # codici SAX di tutti i livelli calcolati una sola volta per il dataset
+    sax_cache = SaxCodeCache(store.series)
     
     # divido dataset 
     if verbose:
         print("Phase 1: Partitioning dataset into K-groups (Time Series Clustering)...")
-    dataset_dict = df_clean.to_dict('records') # trasformo il dataset in una lista di dizionari
-    anon_dataset = makeDatasetKAnon(dataset_dict, K, time_cols=time_cols) # divido il dataset in K gruppi
-    
-    if not anon_dataset:
+    if len(store) < K:
         print("Failed Phase 1.")
         return None
+    with instrumentation.span('partition', K=K, records=len(store)):
+        partitions = partition_indices(store.series, K) # divido il dataset in K gruppi
         
     if verbose:
         print(f"Phase 1 Complete.")
     
-    df_ph1 = pd.DataFrame(anon_dataset) 
-    grouped = df_ph1.groupby('GroupID') # raggruppo i record per GroupID
-    
     final_leaves = []
     
     # divido i gruppi in nodi
     if verbose:
         print("Phase 2: Node Splitting per K-group...")
     
-    for group_id, group in grouped: # per ogni gruppo
-        group_data = group.to_dict('records') # trasformo il gruppo in una lista di dizionari
-        initial_level = 1 # inizio a livello 1
-        
-        # calcolo il pattern iniziale dal primo record (rappresentante)
-        # tutti i record al livello 1 hanno stesso pattern "aaaa"
-        first_ts = [group_data[0][c] for c in time_cols] # prendo la prima serie temporale del gruppo
-        initial_pattern = get_sax_pattern(first_ts, initial_level) # calcolo il pattern iniziale 
-        
-        root = Node(group_data, level=initial_level, pattern=initial_pattern, size=len(group_data)) # creo il nodo radice
-        
-        naive_node_splitting(root, P, MAX_LEVEL, time_cols) # divido i nodi
-        
-        leaves = collect_leaves(root) # raccolgo le foglie
-        for l in leaves:
-            l.group_id = group_id
-        
-        # divido le foglie in good e bad
-        good_leaves = [l for l in leaves if l.label == "good-leaf"]
-        bad_leaves = [l for l in leaves if l.label == "bad-leaf"]
-        
-        # se ci sono foglie bad
-        if bad_leaves:
-            if not good_leaves:
-                 # se tutte le foglie sono bad, le unisco in una sola good leaf
-                 merged_all = Node([], 2, "*", 0, "good-leaf")
-                 for l in bad_leaves:
-                     merged_all.data.extend(l.data)
-                 merged_all.size = len(merged_all.data)
-                 merged_all.group_id = group_id
-                 good_leaves = [merged_all]
-            else:
-                for bl in bad_leaves:
-                    # trovo la good leaf più vicina alla bad leaf
-                    best_target = None
-                    min_dist = float('inf')
-                    
-                    # calcolo la serie temporale media della bad leaf
-                    bl_matrix = np.array([[row[c] for c in time_cols] for row in bl.data])
-                    bl_mean_ts = np.mean(bl_matrix, axis=0)
-                    
-                    for gl in good_leaves:
-                        # Distanza tra la serie media della BadLeaf e il pattern della GoodLeaf
-                        # La ricostruzione del pattern della GoodLeaf dipende dal suo livello.
-                        d = calculate_distance(bl_mean_ts, gl.pattern, gl.level)
-                        if d < min_dist:
-                            min_dist = d
-                            best_target = gl
-                    
-                    if best_target:
-                        best_target.data.extend(bl.data)
-                        best_target.size += bl.size
-                        # NON aggiornare pattern/livello. Vengono semplicemente assorbiti.
-        
-        final_leaves.extend(good_leaves)
+    with instrumentation.span('node_splitting', groups=len(partitions), n_jobs=n_jobs or 1):
+        if n_jobs is None or n_jobs == 1:
+            for group_id, group_data in enumerate(partitions, start=1): # per ogni gruppo
+                final_leaves.extend(split_k_group(group_id, group_data, store.series, sax_cache, P, MAX_LEVEL,
+                                                  instrumentation))
+        else:
+            final_leaves = split_k_groups_parallel(partitions, store.series, sax_cache, P, MAX_LEVEL, n_jobs,
+                                                   instrumentation)
         
     # 4. Costruzione del Dataset Finale Anonimizzato
+    # un envelope per foglia, stesso pattern/livello per tutti i record della foglia
     if verbose:
         print("Costruzione del dataset finale anonimizzato...")
-    final_rows = []
-    
-    total_pl = 0
-    total_records = 0
-    
-    for leaf in final_leaves:
-        cluster_data = [[row[c] for c in time_cols] for row in leaf.data]
-        lower, upper, vl = calculate_envelope_and_vl(cluster_data)
-        
-        leaf_pattern = leaf.pattern
-        leaf_level = leaf.level
+    with instrumentation.span('metrics', groups=len(final_leaves)):
+        release = Release.from_clusters(store, [leaf.data for leaf in final_leaves],
+                                        patterns=[leaf.pattern for leaf in final_leaves],
+                                        levels=[leaf.level for leaf in final_leaves])
         
-        for row in leaf.data:
-            new_row = row.copy()
-            for i, col in enumerate(time_cols):
-                new_row[col] = f"[{lower[i]}-{upper[i]}]"
-            
-            new_row['Value_Loss'] = round(vl, 4)
-            new_row['Pattern'] = leaf_pattern
-            new_row['Level'] = leaf_level
-            new_row['GroupID'] = leaf.group_id
-            final_rows.append(new_row)
-            
-            # Metrica Pattern Loss
-            ts = [row[c] for c in time_cols]
-            try:
-                # Se livello < 3 (es. radice non divisa), non possiamo calcolare PL via SAX
-                # Se leaf.level < 3 (es. 2), lo trattiamo come nessun pattern
-                if leaf_level >= 3:
-                     pl = calculate_pattern_loss(ts, leaf_pattern, leaf_level)
-                else:
-                     pl = 1.0 # Max loss for no pattern retention
-                total_pl += pl
-            except Exception as e:
-                pass
-            total_records += 1
-            
-    df_final = pd.DataFrame(final_rows)
-    df_final.sort_values(by=['GroupID'], inplace=True)
+        # VL istantaneo medio per record (VL del gruppo arrotondato, pesato per dimensione)
+        avg_vl = np.repeat(np.round(release.group_vl(), 4), release.sizes).mean() if len(release) > 0 else 0
+        # Metrica Pattern Loss: livello < 3 (es. radice non divisa) = nessun pattern (Max loss)
+        avg_pl = release.pattern_loss() / len(release) if len(release) > 0 else 0
+    instrumentation.count('envelopes', release.n_groups)
+    instrumentation.count('pl_evaluations', len(release))
     
-    # Esportazione
-    cols_to_drop = ['Value_Loss', 'Level'] # Mantenere Pattern? Forse.
-    df_export = df_final.drop(columns=[c for c in cols_to_drop if c in df_final.columns])
-    # df_export = df_final.copy()
-    if 'GroupID' in df_export.columns:
-        cols = ['GroupID'] + [c for c in df_export.columns if c != 'GroupID']
-        df_export = df_export[cols]
-
-    df_export.to_csv(output_path, index=False)
-    if verbose:
-        print(f"Done. Saved to {output_path}")
+    # Esportazione (righe già in ordine di GroupID, a blocchi; bound scritti come sono)
+    if write_release:
+        with instrumentation.span('output', path=output_path):
+            release.write(output_path, store.attribute_columns(),
+                          group_ids=[leaf.group_id for leaf in final_leaves], as_int=False)
+        if verbose:
+            print(f"Done. Saved to {output_path}")
 
     # --- Metriche ---
     if verbose:
@@ -322,11 +407,9 @@ def run_naive_anonymization(K=8, P=2, MAX_LEVEL=10, verbose=True):
     if verbose:
         print(f"Tempo Totale di Esecuzione: {exec_time:.4f} secondi")
     
-    avg_vl = df_final['Value_Loss'].mean()
     if verbose:
         print(f"Average Instant Value Loss (VL): {avg_vl:.4f}")
     
-    avg_pl = total_pl / total_records if total_records > 0 else 0
     if verbose:
         print(f"Average Pattern Loss (PL): {avg_pl:.4f}")
     
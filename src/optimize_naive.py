@@ -1,9 +1,9 @@
 import pandas as pd
-from naive_anonymization import run_naive_anonymization
+from sweep import run_sweep, parameter_grid
 import os
 import sys
 
-def optimize():
+def optimize(n_jobs=-1):
     # results file
     base_dir = os.path.dirname(os.path.abspath(__file__))
     output_csv = os.path.join(base_dir, "../docs/data/naive_optimization_results.csv")
@@ -12,24 +12,12 @@ def optimize():
     p_values = [2, 3, 5, 8]
     max_levels = [3, 5, 8, 10, 15, 20]
     
-    results = []
+    # dataset letto una sola volta, configurazioni in parallelo (solo metriche)
+    grid = parameter_grid(K=k_values, P=p_values, MAX_LEVEL=max_levels)
     
-    total = len(k_values) * len(p_values) * len(max_levels)
-    count = 0
+    print(f"Starting optimization with {len(grid)} combinations...")
     
-    print(f"Starting optimization with {total} combinations...")
-    
-    for k in k_values:
-        for p in p_values:
-            for ml in max_levels:
-                count += 1
-                print(f"[{count}/{total}] Running K={k}, P={p}, MAX_LEVEL={ml}...", end="\r")
-                try:
-                    res = run_naive_anonymization(K=k, P=p, MAX_LEVEL=ml, verbose=False)
-                    if res:
-                        results.append(res)
-                except Exception as e:
-                    print(f"\nError with K={k}, P={p}, ML={ml}: {e}")
+    results = run_sweep('naive', grid, n_jobs=n_jobs)
     
     print("\n")                
     df = pd.DataFrame(results)
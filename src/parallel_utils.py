@@ -0,0 +1,46 @@
+import heapq
+from multiprocessing import shared_memory
+
+import numpy as np
+
+def share_array(arr):
+    """
+    Copy an array into a new shared memory block.
+
+    Returns the SharedMemory object (the owner must close() and unlink() it)
+    and the (name, shape, dtype) spec that workers pass to attach_array.
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def attach_array(spec):
+    """
+    Read-only view of an array shared by share_array, without copying it.
+    Keep the returned SharedMemory object alive as long as the view is used.
+    """
+    name, shape, dtype = spec
+    # i worker di un pool condividono il resource tracker del padre, che
+    # rimuove il blocco con unlink(): qui basta agganciarsi
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    arr.flags.writeable = False
+    return shm, arr
+
+def balanced_batches(sizes, n_batches):
+    """
+    Split items into at most n_batches batches of similar total size
+    (largest item first into the lightest batch).
+
+    Returns a list of index lists; items keep their original order inside
+    each batch, so results can be merged back deterministically.
+    """
+    n_batches = max(1, min(n_batches, len(sizes)))
+    heap = [(0, b) for b in range(n_batches)]
+    batches = [[] for _ in range(n_batches)]
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        load, b = heapq.heappop(heap)
+        batches[b].append(i)
+        heapq.heappush(heap, (load + sizes[i], b))
+    return [sorted(batch) for batch in batches if batch]
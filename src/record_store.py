@@ -0,0 +1,221 @@
+import hashlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# Explicit identifiers: never carried into a release
+EXPLICIT_IDENTIFIERS = ['ID', 'Name', 'Surname']
+
+# Rows read per chunk when loading a dataset out of core
+STORE_CHUNK_ROWS = 100_000
+
+# Values (rows x timestamps) processed per chunk at most, whatever the series length
+MAX_CHUNK_CELLS = 10_000_000
+
+# Default time columns: H1, H2, ... (H followed by the timestamp number)
+TIME_COLUMN_PATTERN = r'H\d+'
+
+def select_time_columns(columns, time_cols=None):
+    """
+    Time series columns of a dataset, in file order.
+
+    Args:
+        columns: Columns of the dataset.
+        time_cols: None (columns named H<number>), a regular expression that
+                   must match the whole column name, or an explicit list.
+    """
+    columns = list(columns)
+    if time_cols is None:
+        time_cols = TIME_COLUMN_PATTERN
+    if isinstance(time_cols, str):
+        pattern = re.compile(time_cols)
+        selected = [c for c in columns if pattern.fullmatch(str(c))]
+    else:
+        selected = list(time_cols)
+        missing = [c for c in selected if c not in columns]
+        if missing:
+            raise ValueError(f"Time columns not in the dataset: {missing}")
+    if not selected:
+        raise ValueError(f"No time columns matching {time_cols!r}")
+    return selected
+
+def rows_per_chunk(n_timestamps, chunk_rows):
+    """Rows per chunk: at most chunk_rows, and at most MAX_CHUNK_CELLS values."""
+    return max(1, min(chunk_rows, MAX_CHUNK_CELLS // max(1, n_timestamps)))
+
+def _convert_series_file(path, n_rows, n_timestamps, dtype, new_dtype, chunk_rows):
+    # riscrive a blocchi una matrice raw (n_rows, n_timestamps) con un altro dtype
+    tmp_path = path + '.tmp'
+    old = np.memmap(path, dtype=dtype, mode='r', shape=(n_rows, n_timestamps))
+    with open(tmp_path, 'wb') as f:
+        for start in range(0, n_rows, chunk_rows):
+            f.write(np.ascontiguousarray(old[start:start + chunk_rows], dtype=new_dtype).tobytes())
+    del old
+    os.replace(tmp_path, path)
+
+class RecordStore:
+    """
+    Columnar storage of the records of a dataset.
+
+    Instead of one dict per record (series, pandas row, SAX string, level,
+    group), the store keeps:
+    - series: contiguous (n_records, n_timestamps) matrix;
+    - row_index: position of each record in the source frame, used to read
+      the other attributes (e.g. the sensitive one) only when writing a release;
+    - level, code, group: integer arrays with the SAX level, the SAX codes of
+      the P-subgroup pattern and the group of each record.
+
+    Groups are then plain index arrays into the store.
+
+    Out of core (see from_csv with workdir) there is no source frame: series,
+    level/code/group and the factorized attribute columns are memory-mapped
+    files in workdir, and attributes maps each column to (codes, categories).
+    """
+    def __init__(self, series, frame=None, time_cols=None, row_index=None, n_segments=4,
+                 attributes=None, workdir=None):
+        self.series = series
+        self.frame = frame
+        self.attributes = attributes or {}
+        self.workdir = workdir
+        self.time_cols = list(time_cols) if time_cols is not None else [f'H{i+1}' for i in range(series.shape[1])]
+        n = series.shape[0]
+        self.row_index = np.arange(n) if row_index is None else np.asarray(row_index)
+        self.level = self._allocate('level', (n,), np.int16)
+        self.code = self._allocate('code', (n, n_segments), np.uint8)
+        self.group = self._allocate('group', (n,), np.int64)
+        self.group[:] = -1
+        self._fingerprint = None
+
+    def _allocate(self, name, shape, dtype):
+        if self.workdir is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(self.workdir, f'{name}.npy'),
+                                         mode='w+', dtype=dtype, shape=shape)
+
+    @classmethod
+    def from_frame(cls, df, time_cols=None, n_segments=4):
+        """Build a store from a DataFrame; the time columns become the series matrix."""
+        time_cols = select_time_columns(df.columns, time_cols)
+        series = np.ascontiguousarray(df[time_cols].values)
+        return cls(series, frame=df, time_cols=time_cols, n_segments=n_segments)
+
+    @classmethod
+    def from_csv(cls, path, time_cols=None, n_segments=4, workdir=None, chunk_rows=STORE_CHUNK_ROWS, dtype=None):
+        """
+        Load a CSV dataset.
+
+        Without workdir the file is read in memory (from_frame). With workdir it
+        is read chunk_rows rows at a time: the series are appended to a
+        memory-mapped matrix and every other non-identifier column is factorized
+        into integer codes on disk (only its distinct values stay in memory).
+        Chunks hold at most MAX_CHUNK_CELLS series values, so long series are
+        read fewer rows at a time.
+
+        Args:
+            time_cols: Time column selection (see select_time_columns).
+            dtype: dtype of the series matrix (default: the common type of all
+                   chunks; rows already written are converted when a later
+                   chunk needs a wider one, e.g. integers followed by floats).
+        """
+        if workdir is None:
+            return cls.from_frame(pd.read_csv(path), time_cols, n_segments)
+
+        header = pd.read_csv(path, nrows=0).columns
+        time_cols = select_time_columns(header, time_cols)
+        columns = [c for c in header if c not in time_cols and c not in EXPLICIT_IDENTIFIERS]
+        chunk_rows = rows_per_chunk(len(time_cols), chunk_rows)
+
+        os.makedirs(workdir, exist_ok=True)
+        series_path = os.path.join(workdir, 'series.bin')
+        lookups = {col: {} for col in columns}
+        code_files = {col: open(os.path.join(workdir, f'attr_{col}.bin'), 'wb') for col in columns}
+        n = 0
+        infer_dtype = dtype is None
+        series_file = open(series_path, 'wb')
+        try:
+            for chunk in pd.read_csv(path, chunksize=chunk_rows):
+                values = chunk[time_cols].to_numpy()
+                if dtype is None:
+                    dtype = values.dtype
+                elif not np.can_cast(values.dtype, dtype):
+                    if not infer_dtype or values.dtype.kind not in 'biuf':
+                        raise ValueError(f"Series values of type {values.dtype} do not fit {np.dtype(dtype)}; pass dtype=float")
+                    # blocco più largo dei precedenti (es. float/NaN dopo soli interi): converto le righe già scritte
+                    series_file.close()
+                    new_dtype = np.result_type(dtype, values.dtype)
+                    _convert_series_file(series_path, n, len(time_cols), dtype, new_dtype, chunk_rows)
+                    dtype = new_dtype
+                    series_file = open(series_path, 'ab')
+                series_file.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+                for col in columns:
+                    lookup = lookups[col]
+                    for value in pd.unique(chunk[col]):
+                        lookup.setdefault(value, len(lookup))
+                    codes = chunk[col].map(lookup).to_numpy(dtype=np.int32)
+                    code_files[col].write(codes.tobytes())
+                n += len(chunk)
+        finally:
+            series_file.close()
+        for f in code_files.values():
+            f.close()
+        if n == 0:
+            raise ValueError(f"No records in {path}")
+
+        series = np.memmap(series_path, dtype=dtype, mode='r', shape=(n, len(time_cols)))
+        attributes = {}
+        for col in columns:
+            codes = np.memmap(os.path.join(workdir, f'attr_{col}.bin'), dtype=np.int32, mode='r', shape=(n,))
+            categories = np.empty(len(lookups[col]), dtype=object)
+            categories[:] = list(lookups[col])
+            attributes[col] = (codes, categories)
+        return cls(series, time_cols=time_cols, n_segments=n_segments,
+                   attributes=attributes, workdir=workdir)
+
+    def __len__(self):
+        return self.series.shape[0]
+
+    def fingerprint(self):
+        """
+        Content hash of the series matrix and the time columns (hex string),
+        computed once per store; identifies the dataset in cached artifacts.
+        """
+        if self._fingerprint is None:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(repr((self.time_cols, self.series.shape, str(self.series.dtype))).encode())
+            step = rows_per_chunk(self.series.shape[1], STORE_CHUNK_ROWS)
+            for start in range(0, len(self), step):
+                h.update(np.ascontiguousarray(self.series[start:start + step]).tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def attribute(self, col, idx=None):
+        """Values of a non-time attribute for the records idx (default: all)."""
+        rows = self.row_index if idx is None else self.row_index[idx]
+        if col in self.attributes:
+            codes, categories = self.attributes[col]
+            return categories[codes[rows]]
+        return self.frame[col].to_numpy()[rows]
+
+    def attribute_codes(self, col):
+        """
+        Integer codes and categories of an attribute over all records
+        (categories in order of first occurrence, -1 for missing values).
+        """
+        if col in self.attributes:
+            codes, categories = self.attributes[col]
+            return np.asarray(codes[self.row_index]), categories
+        codes, categories = pd.factorize(self.frame[col].to_numpy()[self.row_index])
+        return codes, np.asarray(categories, dtype=object)
+
+    def attribute_columns(self, exclude=EXPLICIT_IDENTIFIERS):
+        """Non-time columns of the source frame, without the explicit identifiers."""
+        if self.frame is None:
+            return [c for c in self.attributes if c not in exclude]
+        return [c for c in self.frame.columns if c not in self.time_cols and c not in exclude]
+
+    def rows(self, idx):
+        """Source frame rows of the records idx (explicit identifiers dropped)."""
+        df = self.frame.iloc[self.row_index[idx]]
+        return df.drop(columns=[c for c in EXPLICIT_IDENTIFIERS if c in df.columns])
@@ -0,0 +1,316 @@
+import os
+import sys
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+# Recupero la cartella dove si trova questo file
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from sax_utils import sax_codes_to_strings, pattern_loss_batch
+from record_store import rows_per_chunk
+
+# Rows written per chunk by Release.to_csv / to_npz / to_parquet (fewer for
+# long series, see record_store.rows_per_chunk)
+RELEASE_CHUNK_ROWS = 100_000
+
+# Release formats, by file extension
+RELEASE_FORMATS = {'.csv': 'csv', '.npz': 'npz', '.parquet': 'parquet'}
+
+# Pattern code of '*' (no pattern) and of the padding of shorter patterns
+PATTERN_WILDCARD = 255
+
+def pattern_codes(patterns, width):
+    """(n, width) uint8 codes of SAX strings ('a' = 0); '*' and padding are PATTERN_WILDCARD."""
+    codes = np.full((len(patterns), width), PATTERN_WILDCARD, dtype=np.uint8)
+    for i, pattern in enumerate(patterns):
+        for j, char in enumerate(pattern[:width]):
+            if char != '*':
+                codes[i, j] = ord(char) - 97
+    return codes
+
+def pattern_strings(codes):
+    """Inverse of pattern_codes: SAX strings, '*' for rows without a pattern."""
+    codes = np.atleast_2d(codes)
+    wildcard = codes == PATTERN_WILDCARD
+    out = sax_codes_to_strings(np.where(wildcard, 0, codes))
+    return ['*' if wildcard[i].all() else word[:int(np.argmax(wildcard[i]))] if wildcard[i].any() else word
+            for i, word in enumerate(out)]
+
+def format_intervals(lowers, uppers, as_int=True):
+    """
+    "[lower-upper]" strings of a (n_groups, n_timestamps) envelope matrix.
+
+    Args:
+        lowers, uppers (np.array): Envelope bounds, one row per group.
+        as_int (bool): Truncate the bounds to integers (int()) before formatting;
+                       otherwise the values are printed as they are.
+    """
+    lowers, uppers = np.atleast_2d(lowers), np.atleast_2d(uppers)
+    if as_int:
+        lowers, uppers = lowers.astype(np.int64), uppers.astype(np.int64)
+    out = np.char.add(np.char.add("[", lowers.astype(str)), "-")
+    return np.char.add(np.char.add(out, uppers.astype(str)), "]")
+
+class Release:
+    """
+    Anonymized release: the groups of a RecordStore with their envelopes.
+
+    Every envelope (and its VL) is computed once per group and broadcast to
+    the members by indexing; rows are only materialized chunk by chunk when
+    the release is written.
+
+    Args:
+        store (RecordStore): Records of the dataset.
+        members (list of np.array): Record indices of every group, in release order.
+        lowers, uppers (np.array): (n_groups, n_timestamps) envelope bounds.
+        patterns, levels (sequence, optional): Pattern and level of every group.
+            When omitted, each record keeps its own P-subgroup pattern and level
+            from store.code / store.level.
+    """
+    def __init__(self, store, members, lowers, uppers, patterns=None, levels=None):
+        self.store = store
+        self.sizes = np.array([len(m) for m in members], dtype=np.int64)
+        self.order = np.concatenate(members) if len(members) else np.array([], dtype=np.int64)
+        # gruppo di ogni riga della release
+        self.record_group = np.repeat(np.arange(len(members)), self.sizes)
+        n = store.series.shape[1]
+        self.lowers = np.asarray(lowers).reshape(len(members), n)
+        self.uppers = np.asarray(uppers).reshape(len(members), n)
+        self.patterns = None if patterns is None else np.asarray(patterns, dtype=object)
+        self.levels = None if levels is None else np.asarray(levels, dtype=np.int64)
+
+    @classmethod
+    def from_clusters(cls, store, members, patterns=None, levels=None):
+        """Release whose envelopes are computed from the member series."""
+        n = store.series.shape[1]
+        lowers = np.empty((len(members), n), dtype=store.series.dtype)
+        uppers = np.empty((len(members), n), dtype=store.series.dtype)
+        for g, idx in enumerate(members):
+            cluster = store.series[idx]
+            lowers[g], uppers[g] = cluster.min(axis=0), cluster.max(axis=0)
+        return cls(store, members, lowers, uppers, patterns, levels)
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def n_groups(self):
+        return len(self.sizes)
+
+    def group_vl(self):
+        """Instant Value Loss of every group (as calculate_envelope_and_vl)."""
+        n = self.lowers.shape[1]
+        if n == 0:
+            return np.zeros(self.n_groups)
+        return np.sqrt(np.sum((self.uppers - self.lowers) ** 2, axis=1) / n)
+
+    def record_patterns(self, rows):
+        """Pattern of the release rows `rows` (positions in release order)."""
+        if self.patterns is not None:
+            return self.patterns[self.record_group[rows]]
+        return np.asarray(sax_codes_to_strings(self.store.code[self.order[rows]]), dtype=object)
+
+    def record_levels(self, rows):
+        """Level of the release rows `rows`."""
+        if self.levels is not None:
+            return self.levels[self.record_group[rows]]
+        return self.store.level[self.order[rows]].astype(np.int64)
+
+    def _chunks(self, chunk_rows):
+        """Release rows in chunks of at most chunk_rows rows and MAX_CHUNK_CELLS series values."""
+        step = rows_per_chunk(self.lowers.shape[1], chunk_rows)
+        for start in range(0, len(self), step):
+            yield np.arange(start, min(start + step, len(self)))
+
+    def pattern_loss(self, chunk_rows=RELEASE_CHUNK_ROWS):
+        """Total Pattern Loss over the records; levels below 3 retain no pattern (PL = 1)."""
+        total = 0.0
+        for rows in self._chunks(chunk_rows):
+            levels = self.record_levels(rows)
+            has_pattern = levels >= 3
+            total += np.count_nonzero(~has_pattern)
+            if has_pattern.any():
+                rows = rows[has_pattern]
+                total += pattern_loss_batch(self.store.series[self.order[rows]],
+                                            self.record_patterns(rows), levels[has_pattern]).sum()
+        return total
+
+    def iter_frames(self, attribute_columns, group_ids=None, as_int=True, chunk_rows=RELEASE_CHUNK_ROWS):
+        """
+        Yield the release as DataFrames of at most chunk_rows rows, with columns
+        GroupID, the interval columns, attribute_columns and Pattern.
+        group_ids are the labels of the groups (default: 1..n_groups).
+        """
+        intervals = format_intervals(self.lowers, self.uppers, as_int)
+        if group_ids is None:
+            group_ids = np.arange(1, self.n_groups + 1)
+        group_ids = np.asarray(group_ids)
+        for rows in self._chunks(chunk_rows):
+            groups = self.record_group[rows]
+            frame = {'GroupID': group_ids[groups]}
+            for t, col in enumerate(self.store.time_cols):
+                frame[col] = intervals[groups, t]
+            for col in attribute_columns:
+                frame[col] = self.store.attribute(col, self.order[rows])
+            frame['Pattern'] = self.record_patterns(rows)
+            yield pd.DataFrame(frame)
+
+    def to_csv(self, path, attribute_columns, group_ids=None, as_int=True, chunk_rows=RELEASE_CHUNK_ROWS):
+        """Stream the release to a CSV file, chunk_rows rows at a time."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        columns = ['GroupID'] + list(self.store.time_cols) + list(attribute_columns) + ['Pattern']
+        with open(path, 'w', newline='') as f:
+            pd.DataFrame(columns=columns).to_csv(f, index=False)
+            for frame in self.iter_frames(attribute_columns, group_ids, as_int, chunk_rows):
+                frame.to_csv(f, index=False, header=False)
+
+    def _binary_columns(self, attribute_columns, group_ids, as_int):
+        """
+        (name, dtype, values(rows)) of every column of a binary release:
+        GroupID, numeric bounds H{i}_lo / H{i}_hi, the attribute columns
+        (strings as int32 codes plus a '<col>__categories' table), pattern codes
+        P1..Pw (uint8) and Level.
+        """
+        group_ids = np.arange(1, self.n_groups + 1) if group_ids is None else np.asarray(group_ids)
+        lowers, uppers = self.lowers, self.uppers
+        if as_int:
+            lowers, uppers = lowers.astype(np.int64), uppers.astype(np.int64)
+        columns = [('GroupID', np.int64, lambda rows: group_ids[self.record_group[rows]])]
+        for t, col in enumerate(self.store.time_cols):
+            columns.append((f'{col}_lo', lowers.dtype, lambda rows, t=t: lowers[self.record_group[rows], t]))
+            columns.append((f'{col}_hi', uppers.dtype, lambda rows, t=t: uppers[self.record_group[rows], t]))
+        tables = {}
+        for col in attribute_columns:
+            codes, categories = self.store.attribute_codes(col)
+            if all(isinstance(c, str) for c in categories):
+                tables[f'{col}__categories'] = np.asarray(categories, dtype=str)
+                codes = codes[self.order]
+                columns.append((col, np.int32, lambda rows, codes=codes: codes[rows]))
+            else:
+                values = pd.to_numeric(pd.Series(self.store.attribute(col, self.order))).to_numpy()
+                columns.append((col, values.dtype, lambda rows, values=values: values[rows]))
+        if self.patterns is not None:
+            width = max([len(p) for p in self.patterns] + [1])
+            group_codes = pattern_codes(self.patterns, width)
+            pattern_of = lambda rows: group_codes[self.record_group[rows]]
+        else:
+            width = self.store.code.shape[1]
+            pattern_of = lambda rows: self.store.code[self.order[rows]]
+        for j in range(width):
+            columns.append((f'P{j+1}', np.uint8, lambda rows, j=j: pattern_of(rows)[:, j]))
+        columns.append(('Level', np.int16, lambda rows: self.record_levels(rows).astype(np.int16)))
+        return columns, tables
+
+    def to_npz(self, path, attribute_columns, group_ids=None, as_int=True, compress=True,
+               chunk_rows=RELEASE_CHUNK_ROWS):
+        """
+        Write the release as a .npz archive of typed columns (readable with
+        np.load or read_release). Every column is streamed into the archive
+        chunk by chunk, deflate-compressed when compress is True.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        columns, tables = self._binary_columns(attribute_columns, group_ids, as_int)
+        compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(path, 'w', compression=compression, allowZip64=True) as archive:
+            for name, dtype, values in columns:
+                with archive.open(f'{name}.npy', 'w', force_zip64=True) as f:
+                    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                              'fortran_order': False, 'shape': (len(self),)}
+                    np.lib.format.write_array_header_2_0(f, header)
+                    for rows in self._chunks(chunk_rows):
+                        f.write(np.ascontiguousarray(values(rows), dtype=dtype).tobytes())
+            for name, table in tables.items():
+                with archive.open(f'{name}.npy', 'w') as f:
+                    np.lib.format.write_array(f, table)
+
+    def to_parquet(self, path, attribute_columns, group_ids=None, as_int=True, compression='zstd',
+                   chunk_rows=RELEASE_CHUNK_ROWS):
+        """
+        Write the release as Parquet (requires pyarrow), one row group per
+        chunk; string attributes are dictionary-encoded.
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet releases need pyarrow (pip install pyarrow); use the .npz format otherwise")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        columns, tables = self._binary_columns(attribute_columns, group_ids, as_int)
+        writer = None
+        try:
+            for rows in self._chunks(chunk_rows):
+                arrays = {}
+                for name, dtype, values in columns:
+                    array = pa.array(np.asarray(values(rows), dtype=dtype))
+                    if f'{name}__categories' in tables:
+                        array = pa.DictionaryArray.from_arrays(array, pa.array(tables[f'{name}__categories']),
+                                                               mask=np.asarray(values(rows)) < 0)
+                    arrays[name] = array
+                table = pa.table(arrays)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema, compression=compression)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def write(self, path, attribute_columns, group_ids=None, as_int=True, chunk_rows=RELEASE_CHUNK_ROWS):
+        """Write the release in the format given by the extension of path (.csv, .npz, .parquet)."""
+        fmt = RELEASE_FORMATS.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise ValueError(f"Unknown release format for {path}; use one of {sorted(RELEASE_FORMATS)}")
+        writer = {'csv': self.to_csv, 'npz': self.to_npz, 'parquet': self.to_parquet}[fmt]
+        writer(path, attribute_columns, group_ids=group_ids, as_int=as_int, chunk_rows=chunk_rows)
+
+# "[lower-upper]" cell of a CSV release (bounds may be negative or decimal)
+_NUMBER = r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_INTERVAL = rf'^\[\s*({_NUMBER})\s*-\s*({_NUMBER})\s*\]$'
+
+def parse_intervals(cells):
+    """Lower and upper bounds of a sequence of "[lower-upper]" strings."""
+    cells = pd.Series(cells, dtype=object).astype(str)
+    bounds = cells.str.extract(_INTERVAL)
+    if bounds.isna().any().any():
+        raise ValueError(f"Malformed interval: {cells[bounds.isna().any(axis=1)].iloc[0]!r}")
+    return bounds[0].astype(float).to_numpy(), bounds[1].astype(float).to_numpy()
+
+def read_release(path):
+    """
+    Load a release as a DataFrame with numeric H{i}_lo / H{i}_hi bound columns,
+    whatever its format: CSV interval strings are parsed, .npz / Parquet columns
+    are read as they are (string attributes decoded from their categories).
+    """
+    fmt = RELEASE_FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt == 'csv':
+        df = pd.read_csv(path)
+        out = {}
+        for col in df.columns:
+            values = df[col]
+            if len(values) and not pd.api.types.is_numeric_dtype(values) and values.astype(str).str.startswith('[').all():
+                out[f'{col}_lo'], out[f'{col}_hi'] = parse_intervals(values)
+            else:
+                out[col] = values.to_numpy()
+        return pd.DataFrame(out)
+    if fmt == 'npz':
+        with np.load(path, allow_pickle=False) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        out = {}
+        for name, values in arrays.items():
+            if name.endswith('__categories'):
+                continue
+            categories = arrays.get(f'{name}__categories')
+            if categories is not None:
+                values = pd.Categorical.from_codes(values, categories=categories)
+            out[name] = values
+        return pd.DataFrame(out)
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet releases needs pyarrow (pip install pyarrow)")
+        return pq.read_table(path).to_pandas()
+    raise ValueError(f"Unknown release format for {path}; use one of {sorted(RELEASE_FORMATS)}")
@@ -1,4 +1,8 @@
+import os
+
 import numpy as np
+from functools import lru_cache
+from statistics import NormalDist
 
 def z_normalization(series):
     """
@@ -28,11 +32,10 @@ def paa(series, n_segments):
         # Simple reshaping if divisible
         return np.mean(series.reshape(n_segments, -1), axis=1)
     else:
-        # Handling non-divisible lengths (more complex, but standard PAA)
-        # For simplicity in this project (H1..H8), we usually use n_segments that divides length or roughly equal
-        # Let's try a simple split approach using array_split
-        splits = np.array_split(series, n_segments)
-        return np.array([np.mean(segment) for segment in splits])
+        # Handling non-divisible lengths (standard PAA): segments as in
+        # np.array_split, all summed in one pass (O(n) also for long series)
+        starts, lengths = paa_segment_bounds(n, n_segments)
+        return np.add.reduceat(series.astype(float), starts) / lengths
 
 # Breakpoints for N(0,1) from SAX literature
 # Keys are alphabet sizes
@@ -58,6 +61,53 @@ SAX_BREAKPOINTS = {
     20: [-1.64, -1.28, -1.04, -0.84, -0.67, -0.52, -0.39, -0.25, -0.13, 0.0, 0.13, 0.25, 0.39, 0.52, 0.67, 0.84, 1.04, 1.28, 1.64]
 }
 
+# iSAX-style nested breakpoints for power-of-two cardinalities (2, 4, ..., 256).
+# Up to 16 symbols they coincide with SAX_BREAKPOINTS, whose tables for 2, 4, 8
+# and 16 are already nested; every doubling keeps the previous breakpoints and
+# adds the N(0,1) quantiles at the odd multiples of 1/cardinality.
+ISAX_MAX_BITS = 8
+
+def _build_isax_breakpoints(max_bits):
+    tables = {}
+    normal = NormalDist()
+    for bits in range(1, max_bits + 1):
+        cardinality = 2 ** bits
+        if cardinality in SAX_BREAKPOINTS:
+            tables[cardinality] = list(SAX_BREAKPOINTS[cardinality])
+        else:
+            odd = [normal.inv_cdf(i / cardinality) for i in range(1, cardinality, 2)]
+            tables[cardinality] = sorted(tables[cardinality // 2] + odd)
+    return tables
+
+_ISAX_BREAKPOINTS = _build_isax_breakpoints(ISAX_MAX_BITS)
+
+# Alfabeti accettati dalle funzioni SAX: quelli di SAX_BREAKPOINTS (che resta la
+# tabella della letteratura) più le cardinalità iSAX oltre 20
+_ALPHABET_BREAKPOINTS = {**_ISAX_BREAKPOINTS, **SAX_BREAKPOINTS}
+
+def isax_levels(max_cardinality, min_level=3):
+    """
+    Ladder of iSAX cardinalities from max_cardinality down to the smallest
+    power of two >= min_level, halving at every step.
+    """
+    bits = int(max_cardinality).bit_length() - 1
+    if max_cardinality < 2 or 2 ** bits != max_cardinality or bits > ISAX_MAX_BITS:
+        raise ValueError(f"iSAX cardinality must be a power of two between 2 and {2 ** ISAX_MAX_BITS}, got {max_cardinality}")
+    levels = [max_cardinality]
+    while levels[-1] // 2 >= min_level:
+        levels.append(levels[-1] // 2)
+    return levels
+
+def isax_demote(codes, from_cardinality, to_cardinality):
+    """
+    Derive the codes of a coarser iSAX cardinality from finer ones with a bit shift.
+    With nested breakpoints this equals encoding the series at to_cardinality.
+    """
+    shift = int(from_cardinality).bit_length() - int(to_cardinality).bit_length()
+    if shift < 0:
+        raise ValueError(f"Cannot promote iSAX codes from {from_cardinality} to {to_cardinality} symbols")
+    return np.right_shift(codes, shift)
+
 # Cerca la funzione ts_to_sax
 def ts_to_sax(series, level, n_segments=4): 
     """
@@ -70,12 +120,12 @@ def ts_to_sax(series, level, n_segments=4):
     paa_rep = paa(zn_series, n_segments)
     
     # Discretization
-    if level not in SAX_BREAKPOINTS:
+    if level not in _ALPHABET_BREAKPOINTS:
         # per livello 1
         if level < 3: return "a" * n_segments
         raise ValueError(f"Alphabet size {level} unsupported")
         
-    breakpoints = SAX_BREAKPOINTS[level]
+    breakpoints = _ALPHABET_BREAKPOINTS[level]
     
     sax_string = []
     for val in paa_rep:
@@ -84,53 +134,411 @@ def ts_to_sax(series, level, n_segments=4):
         
     return "".join(sax_string)
 
+def z_normalization_batch(data):
+    """
+    Row-wise Z-normalization of a (n_records, n_timestamps) matrix.
+    Rows with standard deviation below 1e-6 become rows of zeros,
+    as in z_normalization.
+    """
+    data = np.asarray(data, dtype=float)
+    mean = np.mean(data, axis=1, keepdims=True)
+    std = np.std(data, axis=1, keepdims=True)
+    flat = std < 1e-6
+    zn = (data - mean) / np.where(flat, 1.0, std)
+    zn[flat[:, 0]] = 0.0
+    return zn
+
+def paa_segment_bounds(length, n_segments):
+    """
+    Start index and length of every PAA segment for a series of the given
+    length. Boundaries match paa() (np.array_split for non-divisible lengths).
+    """
+    if n_segments > length:
+        raise ValueError(f"Cannot reduce {length} points to {n_segments} segments")
+    base, extra = divmod(length, n_segments)
+    lengths = np.full(n_segments, base, dtype=np.int64)
+    lengths[:extra] += 1
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return starts, lengths
+
+def paa_batch(data, n_segments):
+    """
+    Row-wise PAA of a (n_records, n_timestamps) matrix.
+    Returns a (n_records, n_segments) matrix of segment means.
+    """
+    data = np.asarray(data, dtype=float)
+    n_records, length = data.shape
+
+    if length == n_segments:
+        return data
+
+    if length % n_segments == 0:
+        return np.mean(data.reshape(n_records, n_segments, -1), axis=2)
+
+    # Segmenti di lunghezza diversa: somme per segmento in un solo passaggio
+    starts, lengths = paa_segment_bounds(length, n_segments)
+    return np.add.reduceat(data, starts, axis=1) / lengths
+
+def paa_to_sax_codes(paa_matrix, level):
+    """
+    Discretize a PAA matrix into integer SAX symbols (0 = 'a') at the given
+    alphabet size. Levels below 3 without breakpoints map to all 'a'.
+    """
+    paa_matrix = np.asarray(paa_matrix)
+    if level not in _ALPHABET_BREAKPOINTS:
+        if level < 3:
+            return np.zeros(paa_matrix.shape, dtype=np.uint8)
+        raise ValueError(f"Alphabet size {level} unsupported")
+    return np.searchsorted(_ALPHABET_BREAKPOINTS[level], paa_matrix).astype(np.uint8)
+
+def ts_to_sax_batch(data, level, n_segments=4, chunk_size=None, n_jobs=1):
+    """
+    Convert a (n_records, n_timestamps) matrix of time series to SAX codes.
+    Vectorized equivalent of calling ts_to_sax on every row.
+
+    Args:
+        data (array-like): Time series matrix, one series per row.
+        level (int): Alphabet size.
+        n_segments (int): Number of PAA segments (SAX word length).
+        chunk_size (int, optional): Encode the rows in chunks of this size,
+            bounding the size of the float intermediates.
+        n_jobs (int): Number of threads used to encode the chunks.
+
+    Returns:
+        np.array: (n_records, n_segments) uint8 matrix, symbol i = chr(97 + i).
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    n_records = data.shape[0]
+
+    def encode(block):
+        return paa_to_sax_codes(paa_batch(z_normalization_batch(block), n_segments), level)
+
+    if not chunk_size or n_records <= chunk_size:
+        return encode(data)
+
+    codes = np.empty((n_records, n_segments), dtype=np.uint8)
+    starts = range(0, n_records, chunk_size)
+
+    def encode_chunk(start):
+        codes[start:start + chunk_size] = encode(data[start:start + chunk_size])
+
+    if n_jobs > 1:
+        # NumPy rilascia il GIL nei kernel, quindi i thread lavorano in parallelo
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(encode_chunk, starts))
+    else:
+        for start in starts:
+            encode_chunk(start)
+    return codes
+
+def sax_codes_to_strings(codes):
+    """Convert a (n_records, n_segments) SAX code matrix to a list of SAX strings."""
+    codes = np.atleast_2d(codes)
+    if codes.shape[1] == 0:
+        return [""] * codes.shape[0]
+    # chr(97 + idx) for every symbol, read back as UCS4 strings (also past 'z')
+    chars = np.ascontiguousarray(codes.astype("<u4") + 97).view(f"<U{codes.shape[1]}")
+    return chars.ravel().tolist()
+
+def pack_sax_codes(codes, alphabet_size):
+    """
+    Pack each row of a SAX code matrix into a single integer key.
+
+    Every symbol takes ceil(log2(alphabet_size)) bits, so equal words give
+    equal keys and the key order is the lexicographic word order. Words that
+    do not fit in 64 bits are returned as fixed-size byte strings instead
+    (still sortable and comparable by np.unique).
+    """
+    codes = np.atleast_2d(codes)
+    n_segments = codes.shape[1]
+    bits = max(1, int(alphabet_size - 1).bit_length())
+    if bits * n_segments > 64:
+        codes = np.ascontiguousarray(codes, dtype=np.uint8)
+        return codes.view(np.dtype((np.void, n_segments))).ravel()
+    keys = np.zeros(codes.shape[0], dtype=np.uint64)
+    for s in range(n_segments):
+        keys = (keys << np.uint64(bits)) | codes[:, s].astype(np.uint64)
+    return keys
+
+def group_sax_codes(codes, alphabet_size):
+    """
+    Group records with the same SAX word in one vectorized pass.
+
+    Returns (group_ids, order, starts, sizes): group_ids[i] is the group of
+    record i, and the records of group g are order[starts[g]:starts[g] + sizes[g]].
+    Groups are numbered by first occurrence and members keep their input
+    order, exactly like appending records to a dict of lists keyed by word.
+    """
+    keys = pack_sax_codes(codes, alphabet_size)
+    if len(keys) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty, empty
+    _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    # rinumero i gruppi per prima occorrenza
+    by_first = np.argsort(first)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[by_first] = np.arange(len(first))
+    group_ids = rank[inverse.ravel()]
+    order = np.argsort(group_ids, kind='stable')
+    sizes = counts[by_first]
+    starts = np.cumsum(sizes) - sizes
+    return group_ids, order, starts, sizes
+
+class SaxCodeCache:
+    """
+    Multi-resolution SAX codes of a fixed set of series.
+
+    The z-normalized PAA matrix does not depend on the alphabet size, so it is
+    computed once; the codes (and SAX strings) of each level are then filled
+    lazily on first request and queried by record index afterwards.
+
+    With chunk_rows the series are read chunk_rows at a time (e.g. from a
+    np.memmap); with workdir the PAA matrix and the codes of every level are
+    kept in memory-mapped files in that directory instead of RAM.
+
+    encoded counts the rows actually encoded so far (every record of each
+    level filled), not the lookups served from the cache.
+    """
+    def __init__(self, data, n_segments=4, chunk_rows=None, workdir=None):
+        self.n_segments = n_segments
+        self.chunk_rows = chunk_rows
+        self.workdir = workdir
+        if chunk_rows is None and workdir is None:
+            self.paa = paa_batch(z_normalization_batch(np.atleast_2d(data)), n_segments)
+        else:
+            n_records = data.shape[0]
+            self.paa = self._allocate('paa', (n_records, n_segments), np.float64)
+            for start in range(0, n_records, chunk_rows or n_records):
+                stop = start + (chunk_rows or n_records)
+                self.paa[start:stop] = paa_batch(z_normalization_batch(data[start:stop]), n_segments)
+        self._codes = {}
+        self._words = {}
+        self.encoded = 0
+
+    @classmethod
+    def from_paa(cls, paa):
+        """Cache over an already computed z-normalized PAA matrix (e.g. a subset of another cache's paa)."""
+        cache = cls.__new__(cls)
+        cache.n_segments = paa.shape[1]
+        cache.chunk_rows = None
+        cache.workdir = None
+        cache.paa = paa
+        cache._codes = {}
+        cache._words = {}
+        cache.encoded = 0
+        return cache
+
+    def _allocate(self, name, shape, dtype):
+        if self.workdir is None:
+            return np.empty(shape, dtype=dtype)
+        path = os.path.join(self.workdir, f'sax_{name}.bin')
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def __len__(self):
+        return self.paa.shape[0]
+
+    def codes(self, level):
+        """(n_records, n_segments) uint8 SAX codes at the given alphabet size."""
+        if level not in self._codes:
+            if self.chunk_rows is None and self.workdir is None:
+                self._codes[level] = paa_to_sax_codes(self.paa, level)
+            else:
+                n_records = self.paa.shape[0]
+                codes = self._allocate(f'codes_{level}', self.paa.shape, np.uint8)
+                step = self.chunk_rows or n_records
+                for start in range(0, n_records, step):
+                    codes[start:start + step] = paa_to_sax_codes(self.paa[start:start + step], level)
+                self._codes[level] = codes
+            self.encoded += self.paa.shape[0]
+        return self._codes[level]
+
+    def words(self, level):
+        """SAX strings at the given alphabet size, one per record."""
+        if level not in self._words:
+            self._words[level] = sax_codes_to_strings(self.codes(level))
+        return self._words[level]
+
+    def cube(self, levels):
+        """(n_records, len(levels), n_segments) code cube for the given levels."""
+        return np.stack([self.codes(level) for level in levels], axis=1)
+
+def _build_centroid_table(breakpoints):
+    """
+    Centroid of every Gaussian bin of an alphabet.
+    Simple midpoint approximation (clamped at +/- 3 sigma).
+    """
+    extended_bps = np.array([-3] + list(breakpoints) + [3], dtype=float)
+    return (extended_bps[:-1] + extended_bps[1:]) / 2
+
+# Centroid lookup tables, built once at import. Keys are alphabet sizes
+SAX_CENTROIDS = {size: _build_centroid_table(bps) for size, bps in _ALPHABET_BREAKPOINTS.items()}
+
+def _build_symbol_distance_table(breakpoints):
+    """
+    MINDIST lookup table of an alphabet: cell (r, c) is 0 for equal or
+    adjacent symbols, otherwise the gap beta_{max(r,c)-1} - beta_{min(r,c)}
+    between the two bins.
+    """
+    breakpoints = np.asarray(breakpoints, dtype=float)
+    symbols = np.arange(len(breakpoints) + 1)
+    r, c = np.meshgrid(symbols, symbols, indexing='ij')
+    lo, hi = np.minimum(r, c), np.maximum(r, c)
+    far = hi - lo > 1
+    table = np.zeros(r.shape)
+    table[far] = breakpoints[hi[far] - 1] - breakpoints[lo[far]]
+    return table
+
+# Symbol distance lookup tables for MINDIST, built once at import
+SAX_DIST_TABLES = {size: _build_symbol_distance_table(bps) for size, bps in _ALPHABET_BREAKPOINTS.items()}
+
+def mindist_codes(query_codes, candidate_codes, alphabet_size, original_length):
+    """
+    MINDIST lower bound between one SAX word and many, as code arrays.
+
+    For every candidate word C, MINDIST(Q, C) <= Euclidean distance between the
+    z-normalized series of Q and any series of length original_length whose
+    PAA falls in the bins of C (e.g. the reconstruction of C).
+    Segments of different length are weighted by their number of points.
+
+    Returns:
+        np.array: one lower bound per row of candidate_codes.
+    """
+    table = SAX_DIST_TABLES[alphabet_size]
+    candidate_codes = np.atleast_2d(candidate_codes)
+    _, lengths = paa_segment_bounds(original_length, candidate_codes.shape[1])
+    dist = table[np.asarray(query_codes)[None, :], candidate_codes]
+    return np.sqrt(np.sum(lengths * dist ** 2, axis=1))
+
+def mindist(word_a, word_b, alphabet_size, original_length):
+    """MINDIST lower bound between two SAX strings of the same alphabet size."""
+    a = np.array([ord(char) - 97 for char in word_a])
+    b = np.array([ord(char) - 97 for char in word_b])
+    return float(mindist_codes(a, b, alphabet_size, original_length)[0])
+
+def nearest_pattern(series, patterns, levels):
+    """
+    Find the pattern whose SAX reconstruction is closest (Euclidean) to the
+    z-normalized series, skipping candidates whose MINDIST lower bound already
+    exceeds the best distance found so far.
+
+    Args:
+        series (array-like): Raw time series.
+        patterns (sequence): Candidate SAX strings.
+        levels (sequence): Alphabet size of each candidate.
+
+    Returns:
+        tuple: (best_index, best_distance, n_evaluated); ties go to the
+               lowest index. best_index is -1 if there are no candidates.
+    """
+    zn = z_normalization(series)
+    length = len(zn)
+    levels = np.asarray(levels)
+    bounds = np.zeros(len(patterns))
+
+    # Lower bound di tutti i candidati, un batch per livello
+    for level in np.unique(levels):
+        idx = np.flatnonzero(levels == level)
+        cand = np.array([[ord(char) - 97 for char in patterns[i]] for i in idx])
+        query = paa_to_sax_codes(paa_batch(zn.reshape(1, -1), cand.shape[1]), int(level))[0]
+        bounds[idx] = mindist_codes(query, cand, int(level), length)
+
+    best_index, best_dist, n_evaluated = -1, float('inf'), 0
+    for i in np.argsort(bounds, kind='stable'):
+        if bounds[i] > best_dist:
+            break
+        d = float(np.linalg.norm(zn - sax_to_values(patterns[i], int(levels[i]), length)))
+        n_evaluated += 1
+        if d < best_dist or (d == best_dist and i < best_index):
+            best_index, best_dist = int(i), d
+    return best_index, best_dist, n_evaluated
+
+def sax_codes_to_values(codes, alphabet_size, original_length):
+    """
+    Reconstruct a (n_records, n_segments) SAX code matrix into a
+    (n_records, original_length) matrix of z-normalized values.
+    Each segment spans the same timestamps as in paa(); codes outside the
+    alphabet map to 0.
+    """
+    if alphabet_size not in SAX_CENTROIDS:
+        raise ValueError(f"Alphabet size {alphabet_size} not supported.")
+    codes = np.atleast_2d(codes)
+    centroids = SAX_CENTROIDS[alphabet_size]
+    valid = codes < len(centroids)
+    values = np.where(valid, centroids[np.where(valid, codes, 0)], 0.0)
+    if codes.shape[1] == original_length:
+        return values
+    _, lengths = paa_segment_bounds(original_length, codes.shape[1])
+    return np.repeat(values, lengths, axis=1)
+
 def sax_to_values(sax_string, alphabet_size, original_length):
     """
     Reconstruct a time series (z-normalized) from a SAX string.
     Maps each symbol to the centroid of its Gaussian bin.
     """
-    if alphabet_size not in SAX_BREAKPOINTS:
+    if alphabet_size not in SAX_CENTROIDS:
         raise ValueError(f"Alphabet size {alphabet_size} not supported.")
-        
-    breakpoints = SAX_BREAKPOINTS[alphabet_size]
-    
-    # Simple midpoint approximation (clamped at +/- 3 sigma)
-    # This rebuilds the 'reconstructed' values based on the SAX string
-    extended_bps = [-3] + list(breakpoints) + [3]
-    
-    values = []
-    for char in sax_string:
-        idx = ord(char) - 97
-        if 0 <= idx < len(extended_bps) - 1:
-            low = extended_bps[idx]
-            high = extended_bps[idx+1]
-            centroid = (low + high) / 2
-            values.append(centroid)
-        else:
-            # Should not happen if char is valid
-            values.append(0)
-            
-    # Since n_segments might be < original_length, we need to expand PAA
-    values = np.array(values)
-    if len(values) != original_length:
-        # Repeat values to match original length
-        # Assuming equal sized segments (approx)
-        return np.repeat(values, np.ceil(original_length / len(values)))[:original_length]
-    return values
+    # 'a' -> 0, 'b' -> 1, ...; caratteri non validi diventano codici fuori alfabeto
+    codes = np.array([ord(char) - 97 for char in sax_string], dtype=np.int64)
+    codes[codes < 0] = len(SAX_CENTROIDS[alphabet_size])
+    return sax_codes_to_values(codes, alphabet_size, original_length)[0]
 
 def calculate_feature_vector(series):
     """
     Construct the feature vector p(Q) as the set of all differentials
     between every pair of attributes: q_i - q_j.
+    Kept for reference: it has O(n^2) entries, and Pattern Loss no longer
+    materializes it.
     """
     series = np.array(series)
-    n = len(series)
-    features = []
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                features.append(series[i] - series[j])
-    return np.array(features)
+    diff = series[:, None] - series[None, :]
+    return diff[~np.eye(len(series), dtype=bool)]
+
+def _centered_norm(x):
+    """
+    Center a series (or each row of a matrix) and return (centered, norm).
+
+    For the differential feature vectors: sum_{i!=j} (x_i - x_j)(y_i - y_j)
+    = 2n * sum((x - mean_x)(y - mean_y)), so dot products and norms of p(Q)
+    follow from the centered series in O(n). Constant series get norm 0.
+    """
+    x = np.asarray(x, dtype=float)
+    centered = x - np.mean(x, axis=-1, keepdims=True)
+    norm = np.sqrt(np.sum(centered ** 2, axis=-1))
+    return centered, np.where(np.ptp(x, axis=-1) == 0, 0.0, norm)
+
+def _cosine_loss(dot_product, norm_orig, norm_rec):
+    """1 - cosine similarity, with the zero-vector conventions of Pattern Loss."""
+    dot_product, norm_orig, norm_rec = np.broadcast_arrays(dot_product, norm_orig, norm_rec)
+    zero_orig = norm_orig == 0
+    zero_rec = norm_rec == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loss = 1.0 - dot_product / (norm_orig * norm_rec)
+    # If both are zero (flat series), they are identical -> Loss 0.
+    # If only one is zero, similarity is undefined -> Loss 1.
+    loss = np.where(zero_orig | zero_rec, 1.0, loss)
+    return np.where(zero_orig & zero_rec, 0.0, loss)
+
+@lru_cache(maxsize=4096)
+def _reconstruction_stats(sax_string, alphabet_size, original_length):
+    """
+    Centered reconstruction of one (pattern, level) and its norm, cached.
+    The reconstruction is constant on every PAA segment, so it is kept as one
+    value per segment: the cache stays O(n_segments) for any series length.
+    """
+    values = sax_to_values(sax_string, alphabet_size, len(sax_string))
+    _, lengths = paa_segment_bounds(original_length, len(values))
+    centered = values - np.dot(lengths, values) / original_length
+    norm = 0.0 if np.ptp(values) == 0 else float(np.sqrt(np.dot(lengths, centered ** 2)))
+    centered.flags.writeable = False
+    return centered, norm
+
+def _segment_sums(x, n_segments):
+    """Sum of every PAA segment of a series (or of each row of a matrix)."""
+    starts, _ = paa_segment_bounds(x.shape[-1], n_segments)
+    return np.add.reduceat(x, starts, axis=-1)
 
 def calculate_pattern_loss(series, sax_string, alphabet_size):
     """
@@ -139,38 +547,63 @@ def calculate_pattern_loss(series, sax_string, alphabet_size):
     
     PL(Q, P) = CosineDistance(p(Q), p*(Q))
              = 1 - CosineSimilarity
+
+    The cosine is computed in closed form from the centered series
+    (see _centered_norm), without building the O(n^2) feature vectors:
+    O(n) in the series length.
     """
     # Original Z-normalized series
     zn = z_normalization(series)
+    orig, norm_orig = _centered_norm(zn)
     
     # Reconstructed series from SAX
-    rec = sax_to_values(sax_string, alphabet_size, len(series))
+    rec, norm_rec = _reconstruction_stats(sax_string, alphabet_size, len(zn))
     
-    # Feature Vectors
-    fv_orig = calculate_feature_vector(zn)
-    fv_rec = calculate_feature_vector(rec)
-    
-    # Cosine Similarity
-    # sim = (A . B) / (||A|| * ||B||)
-    
-    dot_product = np.dot(fv_orig, fv_rec)
-    norm_orig = np.linalg.norm(fv_orig)
-    norm_rec = np.linalg.norm(fv_rec)
-    
-    if norm_orig == 0 or norm_rec == 0:
-        # If one vector is zero, similarity is undefined (or 0).
-        # Loss is max (1.0 or high?)
-        # If both are zero (flat series), they are identical -> Loss 0.
-        if norm_orig == 0 and norm_rec == 0:
-            return 0.0
-        return 1.0
-        
-    cosine_sim = dot_product / (norm_orig * norm_rec)
-    
-    # Cosine Distance
-    # Strictly, distance = 1 - similarity
-    # Similarity is in [-1, 1]. Distance in [0, 2].
-    # Usually normalized to [0,1] or just raw distance.
-    # Paper implies distance.
-    
-    return 1.0 - cosine_sim
+    # Cosine Distance: strictly, distance = 1 - similarity, in [0, 2].
+    # rec is constant per segment: the dot product only needs the segment sums
+    return float(_cosine_loss(np.dot(_segment_sums(orig, len(rec)), rec), norm_orig, norm_rec))
+
+def pattern_loss_batch(data, patterns, levels):
+    """
+    Pattern Loss of many series against their (pattern, level) assignments.
+
+    Args:
+        data (array-like): (n_records, n_timestamps) matrix of raw series.
+                           A single 1-D series is scored against every pattern.
+        patterns (sequence): SAX string assigned to each record.
+        levels (sequence): Alphabet size of each pattern.
+
+    Returns:
+        np.array: PL value of every record, as calculate_pattern_loss.
+    """
+    data = np.asarray(data, dtype=float)
+    single = data.ndim == 1
+    orig, norm_orig = _centered_norm(z_normalization_batch(np.atleast_2d(data)))
+    length = orig.shape[1]
+
+    # Statistiche di ricostruzione una volta per ogni (pattern, level) distinto
+    key_index = {}
+    rows = np.empty(len(patterns), dtype=np.int64)
+    for i, key in enumerate(zip(patterns, levels)):
+        rows[i] = key_index.setdefault(key, len(key_index))
+    if not key_index:
+        return np.zeros(0)
+    stats = [_reconstruction_stats(p, int(lvl), length) for p, lvl in key_index]
+    norm_rec = np.array([n for _, n in stats])
+    widths = np.array([len(c) for c, _ in stats])
+
+    # Una somma per segmento di ogni serie, per ogni numero di segmenti
+    dot_product = np.empty(len(patterns))
+    for width in np.unique(widths):
+        keys = np.flatnonzero(widths == width)
+        rec = np.stack([stats[k][0] for k in keys])
+        sel = np.flatnonzero(np.isin(rows, keys))
+        local = np.searchsorted(keys, rows[sel])
+        seg = _segment_sums(orig, int(width))
+        if single:
+            dot_product[sel] = rec[local] @ seg[0]
+        else:
+            dot_product[sel] = np.einsum('ij,ij->i', seg[sel], rec[local])
+    if single:
+        norm_orig = norm_orig[0]
+    return _cosine_loss(dot_product, norm_orig, norm_rec[rows])
@@ -0,0 +1,165 @@
+import pandas as pd
+import numpy as np
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Recupero la cartella dove si trova questo file
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Se non è già presente nella lista di ricerca, la aggiungo
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from kapra_anonymization import run_kapra_anonymization, DEFAULT_N_SEGMENTS
+from naive_anonymization import run_naive_anonymization
+from record_store import RecordStore, EXPLICIT_IDENTIFIERS, select_time_columns
+from parallel_utils import share_array, attach_array
+
+# Runner, level parameter and whether the runner memoizes its K-independent
+# stages (p_group_cache) for each algorithm
+ALGORITHMS = {
+    'kapra': (run_kapra_anonymization, 'SAX_LEVEL', True),
+    'naive': (run_naive_anonymization, 'MAX_LEVEL', False),
+}
+
+def parameter_grid(**values):
+    """All combinations of the given parameter values, in nested-loop order (last parameter fastest)."""
+    keys = list(values)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values.values())]
+
+def load_dataset(data_path=None, time_cols=None):
+    """
+    Parse a dataset once for a sweep: series matrix, time columns and every
+    non-identifier attribute factorized into (codes, categories).
+    """
+    if data_path is None:
+        data_path = os.path.join(current_dir, '../docs/data/dataset_raw.csv')
+    df = pd.read_csv(data_path)
+    time_cols = select_time_columns(df.columns, time_cols)
+    series = np.ascontiguousarray(df[time_cols].values)
+    attributes = {}
+    for col in df.columns:
+        if col in time_cols or col in EXPLICIT_IDENTIFIERS:
+            continue
+        codes, categories = pd.factorize(df[col].to_numpy())
+        attributes[col] = (codes.astype(np.int32), np.asarray(categories, dtype=object))
+    return series, time_cols, attributes
+
+def _make_store(series, time_cols, attributes, params):
+    # store nuovo per ogni task (level/code/group vengono sovrascritti a ogni run),
+    # serie e codici degli attributi sono viste sugli array condivisi
+    return RecordStore(series, time_cols=time_cols, attributes=attributes,
+                       n_segments=params.get('N_SEGMENTS', DEFAULT_N_SEGMENTS))
+
+def sweep_tasks(algorithm, grid):
+    """
+    Split a grid into tasks (lists of grid positions). For algorithms with
+    memoized stages, configurations that differ only in K share a task, so
+    their K-independent stages run once; otherwise every configuration is a task.
+    """
+    if not ALGORITHMS[algorithm][2]:
+        return [[i] for i in range(len(grid))]
+    tasks = {}
+    for i, params in enumerate(grid):
+        key = tuple(sorted((k, repr(v)) for k, v in params.items() if k != 'K'))
+        tasks.setdefault(key, []).append(i)
+    return list(tasks.values())
+
+def _run_task(algorithm, configs, series, time_cols, attributes, output_dir, output_format):
+    # uno store e una cache delle P-group per task, riusati per ogni K
+    store = _make_store(series, time_cols, attributes, configs[0])
+    p_group_cache = {} if ALGORITHMS[algorithm][2] else None
+    return [_run_config(algorithm, params, store, output_dir, output_format, p_group_cache)
+            for params in configs]
+
+def _run_config(algorithm, params, store, output_dir, output_format, p_group_cache=None):
+    runner, level_param, memoized = ALGORITHMS[algorithm]
+    output_path = None
+    if output_dir is not None:
+        # un file per configurazione: nessuna sovrascrittura tra processi
+        name = f"{algorithm}_K{params['K']}_P{params['P']}_L{params[level_param]}.{output_format}"
+        output_path = os.path.join(output_dir, name)
+    extra = {'p_group_cache': p_group_cache} if memoized else {}
+    try:
+        return runner(**params, verbose=False, store=store, output_path=output_path,
+                      write_release=output_dir is not None, **extra)
+    except Exception as e:
+        print(f"\nError with {params}: {e}")
+        return None
+
+# Dataset condiviso del processo worker (impostato da _init_worker)
+_worker_dataset = {}
+
+def _init_worker(series_spec, time_cols, attribute_specs, categories):
+    """Inizializzazione dei worker: aggancio serie e codici degli attributi in memoria condivisa."""
+    shms = []
+    shm, series = attach_array(series_spec)
+    shms.append(shm)
+    attributes = {}
+    for col, spec in attribute_specs.items():
+        shm, codes = attach_array(spec)
+        shms.append(shm)
+        attributes[col] = (codes, categories[col])
+    _worker_dataset.update(series=series, time_cols=time_cols, attributes=attributes, shms=shms)
+
+def _run_worker_task(algorithm, configs, output_dir, output_format):
+    d = _worker_dataset
+    return _run_task(algorithm, configs, d['series'], d['time_cols'], d['attributes'], output_dir, output_format)
+
+def run_sweep(algorithm, grid, data_path=None, time_cols=None, n_jobs=-1, output_dir=None, output_format='csv'):
+    """
+    Run an algorithm ('kapra' or 'naive') over a parameter grid.
+
+    The dataset is parsed once; with n_jobs > 1 (-1: all cores) the series and
+    the attribute codes are placed in shared memory and the configurations run
+    concurrently on a process pool. Without output_dir only the metrics are
+    computed; otherwise every configuration writes its own release file
+    (<algorithm>_K<k>_P<p>_L<level>.<output_format>) in output_dir.
+    KAPRA configurations that differ only in K run in one task (see
+    sweep_tasks): Phase 1 & 2 are computed once and only Phase 3 runs per K.
+
+    Returns the result dicts of the runner in grid order (failed
+    configurations are reported and skipped).
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown algorithm {algorithm!r}; expected one of {list(ALGORITHMS)}")
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    series, time_cols, attributes = load_dataset(data_path, time_cols)
+    tasks = sweep_tasks(algorithm, grid)
+    results = [None] * len(grid)
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            task_results = _run_task(algorithm, [grid[i] for i in task], series, time_cols, attributes,
+                                     output_dir, output_format)
+            for i, res in zip(task, task_results):
+                results[i] = res
+        return [r for r in results if r]
+
+    shms = []
+    try:
+        series_shm, series_spec = share_array(series)
+        shms.append(series_shm)
+        attribute_specs = {}
+        for col, (codes, _) in attributes.items():
+            shm, attribute_specs[col] = share_array(codes)
+            shms.append(shm)
+        categories = {col: cats for col, (_, cats) in attributes.items()}
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(series_spec, time_cols, attribute_specs, categories)) as pool:
+            futures = [pool.submit(_run_worker_task, algorithm, [grid[i] for i in task], output_dir, output_format)
+                       for task in tasks]
+            # risultati nell'ordine della griglia, non in quello di completamento
+            for task, future in zip(tasks, futures):
+                for i, res in zip(task, future.result()):
+                    results[i] = res
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return [r for r in results if r]
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from src.record_store import RecordStore
+from src.kapra_anonymization import run_kapra_anonymization
+from src import sweep
+from src.instrumentation import Instrumentation
+
+def _frame():
+    # due pattern da 3 record e un record isolato (soppresso con P=2)
+    a = [1, 2, 3, 4, 5, 6, 7, 8]
+    b = a[::-1]
+    c = [1, 8, 1, 8, 1, 8, 1, 8]
+    df = pd.DataFrame([a, a, a, b, b, b, c], columns=[f'H{i}' for i in range(1, 9)])
+    df['Performance_SD'] = 'Low'
+    return df
+
+def test_reused_store_drops_groups_of_previous_run():
+    store = RecordStore.from_frame(_frame())
+    run_kapra_anonymization(K=2, P=1, store=store, write_release=False, verbose=False)
+    reused = run_kapra_anonymization(K=3, P=2, store=store, write_release=False, verbose=False)
+
+    fresh_store = RecordStore.from_frame(_frame())
+    fresh = run_kapra_anonymization(K=3, P=2, store=fresh_store, write_release=False, verbose=False)
+
+    assert reused['VL'] == fresh['VL'] == 0.0
+    np.testing.assert_array_equal(store.group, fresh_store.group)
+    assert store.group[-1] == -1
+
+def test_sweep_task_reusing_store_across_p():
+    df = _frame()
+    series = df[[f'H{i}' for i in range(1, 9)]].to_numpy()
+    codes, categories = pd.factorize(df['Performance_SD'])
+    attributes = {'Performance_SD': (codes.astype(np.int32), np.asarray(categories, dtype=object))}
+    configs = [{'K': 2, 'P': 1, 'SAX_LEVEL': 8}, {'K': 3, 'P': 2, 'SAX_LEVEL': 8}]
+    # un solo store per tutte le configurazioni del task
+    results = sweep._run_task('kapra', configs, series, list(df.columns[:8]), attributes, None, 'csv')
+
+    fresh = run_kapra_anonymization(K=3, P=2, store=RecordStore.from_frame(df), write_release=False, verbose=False)
+    assert results[1]['VL'] == fresh['VL'] == 0.0
+
+def test_sax_encodings_count_rows_encoded_not_lookups():
+    ins = Instrumentation()
+    # iSAX: solo il livello più fine viene codificato, gli altri sono bit shift
+    run_kapra_anonymization(K=3, P=2, SAX_LEVEL=8, isax=True, store=RecordStore.from_frame(_frame()),
+                            write_release=False, verbose=False, instrumentation=ins)
+    assert ins.counters['sax_encodings'] == len(_frame())
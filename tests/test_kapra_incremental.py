@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.kapra_incremental import IncrementalKapra, start_incremental
+
+DATASET = os.path.join(os.path.dirname(__file__), '../docs/data/dataset_raw.csv')
+
+def _start(tmp_path, n=400):
+    df = pd.read_csv(DATASET)
+    df.iloc[:n].to_csv(tmp_path / 'history.csv', index=False)
+    state_path = str(tmp_path / 'state')
+    start_incremental(K=8, P=2, SAX_LEVEL=8, data_path=str(tmp_path / 'history.csv'),
+                      output_path=str(tmp_path / 'release.csv'), state_path=state_path, verbose=False)
+    return df, state_path
+
+def _release_frame(state):
+    release, group_ids = state.release()
+    frame = pd.concat(release.iter_frames(['Performance_SD'], group_ids), ignore_index=True)
+    return frame.sort_values(list(frame.columns)).reset_index(drop=True)
+
+def test_saved_state_reloads_appends_and_retractions(tmp_path):
+    df, state_path = _start(tmp_path)
+    state = IncrementalKapra.load(state_path)
+    state.append(df.iloc[400:500], verbose=False)
+    state.retract(df['ID'].iloc[::7].tolist(), verbose=False)
+    state.append(df.iloc[500:550], verbose=False)
+    state.save()
+
+    reloaded = IncrementalKapra.load(state_path)
+    pd.testing.assert_frame_equal(_release_frame(reloaded), _release_frame(state))
+    assert reloaded.k_count.sum() == 550 - len(df['ID'].iloc[:500:7]) - len(reloaded.buffer)
+
+def test_unsaved_changes_leave_the_state_untouched(tmp_path):
+    df, state_path = _start(tmp_path)
+    before = _release_frame(IncrementalKapra.load(state_path))
+    # append e retract senza save: log e tabelle su disco restano quelli di prima
+    state = IncrementalKapra.load(state_path)
+    state.append(df.iloc[400:500], verbose=False)
+    state.retract(df['ID'].iloc[:200:3].tolist(), verbose=False)
+    state.append(df.iloc[500:600], verbose=False)
+
+    pd.testing.assert_frame_equal(_release_frame(IncrementalKapra.load(state_path)), before)
+
+def test_retract_buffered_records(tmp_path):
+    df, state_path = _start(tmp_path)
+    state = IncrementalKapra.load(state_path)
+    _, report = state.append(df.iloc[400:407], max_growth=0.0, verbose=False)
+    buffered = np.asarray(state.log['ID'][state.buffer])
+    assert report['buffered'] == len(buffered) >= 2
+    _, report = state.retract(buffered[:2].tolist(), verbose=False)
+    assert report['removed_from_buffer'] == 2 and report['removed'] == 0
+    assert len(state.buffer) == len(buffered) - 2
+
+def test_id_index_keeps_few_runs(tmp_path):
+    df, state_path = _start(tmp_path, n=100)
+    state = IncrementalKapra.load(state_path)
+    for start in range(100, 400, 10):
+        state.append(df.iloc[start:start + 10], verbose=False)
+    assert len(state.ids.runs) <= int(np.log2(400)) + 1
+    rows = state.ids.lookup(df['ID'].iloc[:400])
+    np.testing.assert_array_equal(np.asarray(state.log['ID'][rows]), df['ID'].iloc[:400].to_numpy())
+
+def test_retract_merge_reports_the_widened_partner(tmp_path):
+    df, state_path = _start(tmp_path)
+    state = IncrementalKapra.load(state_path)
+    lower, upper = state.k_lower.copy(), state.k_upper.copy()
+    # il GroupID 1 scende sotto K: si fonde con un gruppo che la retract non ha toccato
+    members = state._members(0)
+    ids = np.asarray(state.log['ID'][members[:len(members) - state.K + 1]])
+    _, report = state.retract(ids.tolist(), verbose=False)
+
+    assert report['merges']
+    live = np.flatnonzero(state.k_count > 0)
+    widened = live[(state.k_lower[live] != lower[live]).any(axis=1) | (state.k_upper[live] != upper[live]).any(axis=1)]
+    assert report['changed_groups'] == (widened + 1).tolist()
+    assert all(kept in report['changed_groups'] for _, kept in report['merges'])
@@ -0,0 +1,21 @@
+import tracemalloc
+
+import numpy as np
+
+from src.kapra_utils import merge_cost_matrix
+
+def test_merge_cost_matrix_stays_within_memory_budget():
+    rng = np.random.default_rng(0)
+    lowers = rng.normal(size=(400, 64))
+    uppers = lowers + rng.random((400, 64))
+    max_bytes = 4 * 1024 * 1024
+    reference = merge_cost_matrix(lowers, uppers, max_bytes=1 << 40)
+
+    tracemalloc.start()
+    costs = merge_cost_matrix(lowers, uppers, max_bytes=max_bytes)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    np.testing.assert_array_equal(costs, reference)
+    # oltre al budget solo la matrice dei costi (400 x 400) e le copie delle righe del blocco
+    assert peak <= max_bytes + costs.nbytes + 1024 * 1024
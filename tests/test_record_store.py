@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.record_store import RecordStore
+
+def _csv(path):
+    # primo blocco di soli interi, poi float e un NaN
+    df = pd.DataFrame({'ID': range(1, 7), 'H1': [1, 2, 3, 4.5, np.nan, 6], 'H2': [7, 8, 9, 10, 11, 12.25],
+                       'Performance_SD': ['Low', 'High', 'Low', 'Medium', 'High', 'Low']})
+    df.iloc[:3].to_csv(path, index=False, float_format='%g')
+    df.iloc[3:].to_csv(path, index=False, header=False, mode='a')
+    return df
+
+def test_out_of_core_series_widen_to_later_float_chunks(tmp_path):
+    path = tmp_path / 'data.csv'
+    df = _csv(path)
+    store = RecordStore.from_csv(path, workdir=str(tmp_path / 'work'), chunk_rows=3)
+    in_memory = RecordStore.from_csv(path)
+
+    assert store.series.dtype == np.float64
+    np.testing.assert_array_equal(np.asarray(store.series), in_memory.series)
+    np.testing.assert_array_equal(np.asarray(store.series), df[['H1', 'H2']].to_numpy())
+    assert store.attribute('Performance_SD').tolist() == df['Performance_SD'].tolist()
+
+def test_out_of_core_explicit_dtype_still_rejects_wider_chunks(tmp_path):
+    path = tmp_path / 'data.csv'
+    _csv(path)
+    with pytest.raises(ValueError, match='dtype=float'):
+        RecordStore.from_csv(path, workdir=str(tmp_path / 'work'), chunk_rows=3, dtype=np.int64)
@@ -0,0 +1,15 @@
+import numpy as np
+
+from src.sax_utils import SAX_BREAKPOINTS, SaxCodeCache, isax_demote, ts_to_sax, sax_codes_to_strings
+
+def test_isax_cardinalities_leave_sax_breakpoints_alone():
+    assert sorted(SAX_BREAKPOINTS) == list(range(2, 21))
+
+def test_isax_levels_above_twenty_encode_and_demote():
+    rng = np.random.default_rng(0)
+    series = rng.normal(size=(50, 8))
+    cache = SaxCodeCache(series, n_segments=4)
+    codes = cache.codes(256)
+    assert codes.max() < 256
+    np.testing.assert_array_equal(isax_demote(codes, 256, 32), cache.codes(32))
+    assert ts_to_sax(series[0], 64) == sax_codes_to_strings(cache.codes(64)[:1])[0]